@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Stand-in for the `inter-server-sync` binary, used with mock_suma.py
+             to run the export and import scripts without a SUSE Manager.
+
+             `export` writes FAKE_ISS_PACKAGES package files of
+             FAKE_ISS_PACKAGE_SIZE bytes and an SQL dump into --outputDir, the
+             same layout for every run so the results can be compared. Half of
+             the packages have the same name and content in every channel, as
+             the packages shared by the channels of a product, for
+             export_dedup.py to find. `import` reads every file of --importDir.
+             Both sleep FAKE_ISS_SECONDS to stand for the database work, and
+             fail with exit code 1 for the channels matching FAKE_ISS_FAIL.
+
+             Point the scripts at it with SUMA_ISS_BIN=/path/to/fake_iss.py.
+
+Constants:
+             PACKAGES - Default package files per export (FAKE_ISS_PACKAGES).
+             PACKAGE_SIZE - Default size of a package file (FAKE_ISS_PACKAGE_SIZE).
+             SECONDS - Default duration of every run (FAKE_ISS_SECONDS).
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import argparse
+
+PACKAGES = 10
+PACKAGE_SIZE = 65536
+SECONDS = 0.0
+
+
+def package_data(name, size):
+    block = (name.encode() + b"\n") * (4096 // (len(name) + 1) + 1)
+    return (block * (size // len(block) + 1))[:size]
+
+
+def export(args):
+    packages = int(os.environ.get("FAKE_ISS_PACKAGES", PACKAGES))
+    size = int(os.environ.get("FAKE_ISS_PACKAGE_SIZE", PACKAGE_SIZE))
+    package_dir = os.path.join(args.outputDir, "packages")
+    os.makedirs(package_dir, exist_ok=True)
+    for index in range(packages):
+        name = f"mock-pkg{index}" if index % 2 == 0 else f"mock-{args.channels}-pkg{index}"
+        with open(os.path.join(package_dir, f"{name}-1.0-1.x86_64.rpm"), "wb") as f:
+            f.write(package_data(name, size))
+    with open(os.path.join(args.outputDir, "sql_statements.sql"), "w") as f:
+        f.write(f"-- channel {args.channels}, packagesOnlyAfter {args.packagesOnlyAfter}\n")
+
+
+def import_dir(args):
+    for root, _, files in os.walk(args.importDir):
+        for name in files:
+            with open(os.path.join(root, name), "rb") as f:
+                while f.read(1048576):
+                    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake inter-server-sync.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("--channels", default="")
+    parser.add_argument("--outputDir")
+    parser.add_argument("--importDir")
+    parser.add_argument("--packagesOnlyAfter")
+    # Accepted and ignored, as passed by the scripts
+    for option in ("--orgLimit", "--logLevel", "--xmlRpcUser", "--xmlRpcPassword"):
+        parser.add_argument(option)
+    args = parser.parse_args()
+
+    time.sleep(float(os.environ.get("FAKE_ISS_SECONDS", SECONDS)))
+    label = args.channels or os.path.basename(os.path.normpath(args.importDir or ""))
+    if os.environ.get("FAKE_ISS_FAIL") and fnmatch.fnmatch(label, os.environ["FAKE_ISS_FAIL"]):
+        print(f"ERROR: fake failure of {label}")
+        sys.exit(1)
+    if args.command == "export":
+        export(args)
+    else:
+        import_dir(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Local stand-in for the SUSE Manager XML-RPC API, used to run and
+             benchmark the export and import scripts without a live server.
+
+             The server generates a deterministic catalog: CHANNELS vendor
+             channels, one parent channel for every CHILDREN_PER_PARENT children,
+             each with PACKAGES packages and a few errata. Every call is delayed
+             by LATENCY seconds to mimic the round trip to a real server,
+             `system.multicall` is supported and costs a single delay.
+
+             Implemented calls: auth.login, auth.logout, api.systemVersion,
+             channel.listVendorChannels, channel.software.getDetails,
+             channel.software.getChannelLastBuildById,
+             channel.software.listAllPackages, channel.software.listErrata,
+             channel.software.syncRepo, packages.getDetails,
+             sync.content.listChannels, sync.content.listProducts and
+             sync.content.addChannels.
+
+             Any user name and password are accepted. Point the scripts at the
+             server with SUMA_URL=http://127.0.0.1:<port>/rpc/api.
+
+Usage:
+             ./mock_suma.py [--channels N] [--packages N] [--children N]
+                            [--latency SECONDS] [--package-size BYTES] [--port PORT]
+
+Constants:
+             CHANNELS - Default number of vendor channels.
+             PACKAGES - Default number of packages per channel.
+             CHILDREN_PER_PARENT - Default number of child channels per parent.
+             LATENCY - Default delay of every request, in seconds.
+             PORT - Default listening port, 0 picks a free one.
+             PACKAGE_SIZE - Default size reported by packages.getDetails, in bytes.
+"""
+
+import time
+import hashlib
+import argparse
+import datetime
+import threading
+from socketserver import ThreadingMixIn
+from xmlrpc.client import Fault
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+CHANNELS = 10
+PACKAGES = 100
+CHILDREN_PER_PARENT = 9
+LATENCY = 0.0
+PORT = 0
+PACKAGE_SIZE = 1048576
+ERRATA_PER_CHANNEL = 5
+VERSION = "4.3.0"
+
+
+class Catalog:
+    """The channels, packages and errata served by the mock."""
+
+    def __init__(self, channels=CHANNELS, packages=PACKAGES, children=CHILDREN_PER_PARENT,
+                 package_size=PACKAGE_SIZE):
+        self.channels = []
+        self.by_label = {}
+        self.by_id = {}
+        self.packages = packages
+        self.package_size = package_size
+        self.last_build = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.added = set()
+        parent = None
+        for index in range(channels):
+            if index % (children + 1) == 0:
+                parent = f"mock-product{index // (children + 1)}-pool-x86_64"
+                label, parent_label = parent, ""
+            else:
+                label, parent_label = f"{parent}-child{index % (children + 1)}", parent
+            channel = {"id": index + 1, "label": label, "name": label, "parent_label": parent_label,
+                       "packages": packages}
+            self.channels.append(channel)
+            self.by_label[label] = channel
+            self.by_id[channel["id"]] = channel
+
+    def channel(self, label):
+        try:
+            return self.by_label[label]
+        except KeyError:
+            raise Fault(-210, f"No such channel: {label}")
+
+    def package(self, channel, index):
+        # Channels of the same product share half of their packages, so the
+        # deduplication of the export has something to do.
+        shared = index % 2 == 0
+        name = f"mock-pkg{index}" if shared else f"mock-{channel['label']}-pkg{index}"
+        package_id = index + 1 if shared else channel["id"] * 1000000 + index + 1
+        return {
+            "id": package_id,
+            "name": name,
+            "version": "1.0",
+            "release": "1",
+            "epoch": "",
+            "arch_label": "x86_64",
+            "checksum": hashlib.sha256(name.encode()).hexdigest(),
+            "checksum_type": "sha256",
+            "last_modified": self.last_build,
+        }
+
+
+class MockApi:
+    """XML-RPC handlers, dispatched by their dotted method name."""
+
+    def __init__(self, catalog, latency=LATENCY):
+        self.catalog = catalog
+        self.latency = latency
+        self.sessions = set()
+        self._lock = threading.Lock()
+        self.handlers = {
+            "auth.login": self.login,
+            "auth.logout": self.logout,
+            "api.systemVersion": lambda: VERSION,
+            "channel.listVendorChannels": self.list_vendor_channels,
+            "channel.software.getDetails": self.get_details,
+            "channel.software.getChannelLastBuildById": self.last_build,
+            "channel.software.listAllPackages": self.list_all_packages,
+            "channel.software.listErrata": self.list_errata,
+            "channel.software.syncRepo": self.sync_repo,
+            "packages.getDetails": self.package_details,
+            "sync.content.listChannels": self.list_scc_channels,
+            "sync.content.listProducts": self.list_products,
+            "sync.content.addChannels": self.add_channels,
+        }
+
+    def _dispatch(self, method, params):
+        time.sleep(self.latency)
+        if method == "system.multicall":
+            return self.multicall(*params)
+        return self.call(method, params)
+
+    def call(self, method, params):
+        if method not in self.handlers:
+            raise Fault(-1, f"Could not find method: {method}")
+        if method not in ("auth.login", "api.systemVersion"):
+            key, params = params[0], params[1:]
+            if key not in self.sessions:
+                raise Fault(2950, "Either the session key is invalid or the session has expired")
+        return self.handlers[method](*params)
+
+    def multicall(self, calls):
+        results = []
+        for entry in calls:
+            try:
+                results.append([self.call(entry["methodName"], entry["params"])])
+            except Fault as e:
+                results.append({"faultCode": e.faultCode, "faultString": e.faultString})
+        return results
+
+    def login(self, user, password):
+        key = hashlib.sha1(f"{user}:{time.time()}".encode()).hexdigest()
+        with self._lock:
+            self.sessions.add(key)
+        return key
+
+    def logout(self):
+        return 1
+
+    def list_vendor_channels(self):
+        return [{"id": channel["id"], "label": channel["label"], "name": channel["name"],
+                 "packages": channel["packages"], "arch_name": "x86_64"} for channel in self.catalog.channels]
+
+    def get_details(self, label):
+        channel = self.catalog.channel(label)
+        return {"id": channel["id"], "label": label, "name": channel["name"],
+                "parent_channel_label": channel["parent_label"], "arch_label": "channel-x86_64"}
+
+    def last_build(self, channel_id):
+        if channel_id not in self.catalog.by_id:
+            raise Fault(-210, f"No such channel: {channel_id}")
+        return self.catalog.last_build
+
+    def changed_since(self, start_date):
+        last_build = datetime.datetime.strptime(self.catalog.last_build, "%Y-%m-%d %H:%M:%S")
+        return start_date is None or start_date <= last_build
+
+    def list_all_packages(self, label, start_date=None, end_date=None):
+        channel = self.catalog.channel(label)
+        if not self.changed_since(start_date):
+            return []
+        return [self.catalog.package(channel, index) for index in range(self.catalog.packages)]
+
+    def list_errata(self, label, start_date=None, end_date=None):
+        self.catalog.channel(label)
+        if not self.changed_since(start_date):
+            return []
+        return [{"id": index + 1, "advisory_name": f"MOCK-{label}-{index}", "advisory_type": "Bug Fix Advisory",
+                 "date": self.catalog.last_build} for index in range(ERRATA_PER_CHANNEL)]
+
+    def sync_repo(self, labels):
+        for label in labels if isinstance(labels, list) else [labels]:
+            self.catalog.channel(label)
+        return 1
+
+    def package_details(self, package_id):
+        return {"id": package_id, "size": str(self.catalog.package_size)}
+
+    def list_scc_channels(self):
+        return [{"label": channel["label"], "name": channel["name"], "parent": channel["parent_label"] or "BASE",
+                 "status": "installed" if channel["label"] in self.catalog.added else "available"}
+                for channel in self.catalog.channels]
+
+    def list_products(self):
+        products = {}
+        for channel in self.catalog.channels:
+            parent = channel["parent_label"] or channel["label"]
+            product = products.setdefault(parent, {
+                "friendly_name": f"Mock Product {parent.split('-')[1][len('product'):]} x86_64",
+                "arch": "x86_64", "status": "available", "channels": [], "extensions": []})
+            product["channels"].append({"label": channel["label"], "name": channel["name"], "optional": False})
+        return list(products.values())
+
+    def add_channels(self, label, mirror_url=""):
+        self.catalog.channel(label)
+        self.catalog.added.add(label)
+        return [label]
+
+
+class MockServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class RequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ("/rpc/api",)
+    protocol_version = "HTTP/1.1"  # Keep-alive, as the real server
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(channels=CHANNELS, packages=PACKAGES, children=CHILDREN_PER_PARENT, latency=LATENCY, port=PORT,
+                 package_size=PACKAGE_SIZE):
+    """Start the mock in a background thread, returns (server, url)."""
+    server = MockServer(("127.0.0.1", port), requestHandler=RequestHandler, allow_none=True,
+                        use_builtin_types=True, logRequests=False)
+    server.register_instance(MockApi(Catalog(channels, packages, children, package_size), latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/rpc/api"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock SUSE Manager XML-RPC API.")
+    parser.add_argument("--channels", type=int, default=CHANNELS)
+    parser.add_argument("--packages", type=int, default=PACKAGES, help="packages per channel")
+    parser.add_argument("--children", type=int, default=CHILDREN_PER_PARENT, help="child channels per parent")
+    parser.add_argument("--latency", type=float, default=LATENCY, help="delay of every request, in seconds")
+    parser.add_argument("--package-size", type=int, default=PACKAGE_SIZE, help="size of every package, in bytes")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+
+    server, url = start_server(args.channels, args.packages, args.children, args.latency, args.port,
+                               args.package_size)
+    print(f"Mock SUSE Manager listening on {url}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Times the export scripts end to end against mock_suma.py and
+             fake_iss.py, for 10, 100 and 1000 channels by default.
+
+             For every channel count a mock server is started and every
+             scenario runs in a fresh temporary base directory (SUMA_BASE_DIR),
+             so the caches, the state database and the exports of one run do
+             not leak into the next:
+
+               initial     - initial_export.py --parent '*', all channels.
+               daily       - last_update_export.py, all channels changed.
+               daily-noop  - last_update_export.py again, nothing changed.
+               daily-retry - last_update_export.py with the export of the
+                             first child channel failing (FAKE_ISS_FAIL), then
+                             again two days later, when the build of that new
+                             channel is outside the TARGET_DATE window. The
+                             second run has to export the failed channels,
+                             with the window of their first attempt.
+
+             The wall time and exit code of every script are measured here,
+             the API requests and calls are read from its run report (see
+             run_report.py). Compare the table, or the --output JSON, before
+             and after a change.
+
+Usage:
+             ./run_bench.py [--channels 10,100,1000] [--packages N]
+                            [--latency SECONDS] [--iss-seconds SECONDS]
+                            [--output FILE] [--keep]
+
+Constants:
+             CHANNEL_COUNTS - Default channel counts.
+             PACKAGES - Default packages per channel.
+             PACKAGE_SIZE - Size of the fake package files, in bytes.
+             LATENCY - Default delay of every API request, in seconds.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import sqlite3
+import datetime
+import argparse
+import tempfile
+import subprocess
+import mock_suma
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+EXPORT_SCRIPTS = os.path.join(os.path.dirname(BENCH_DIR), "export_scripts")
+CHANNEL_COUNTS = "10,100,1000"
+PACKAGES = 20
+PACKAGE_SIZE = 4096
+LATENCY = 0.002
+DAYS_LATER = 2
+FAIL_PATTERN = "*-child1"
+
+
+def days_later(catalog, base_dir):
+    """Move the builds and the recorded first export windows DAYS_LATER days back."""
+    last_build = datetime.datetime.strptime(catalog.last_build, "%Y-%m-%d %H:%M:%S")
+    catalog.last_build = (last_build - datetime.timedelta(days=DAYS_LATER)).strftime("%Y-%m-%d %H:%M:%S")
+    conn = sqlite3.connect(os.path.join(base_dir, "state", "export_state.db"))
+    conn.execute("UPDATE channel_window SET since = date(since, ?)", (f"-{DAYS_LATER} days",))
+    conn.commit()
+    conn.close()
+
+
+def retried(result, catalog):
+    expected = [label for label in catalog.by_label if fnmatch.fnmatch(label, FAIL_PATTERN)]
+    missing = [label for label in expected if label not in result["exported"]]
+    if missing:
+        return f"{len(missing)} failed channels not exported again: {', '.join(missing)}"
+    return None
+
+
+# (name, steps, check), a step is (script, arguments, measured run or None,
+# extra environment) or a function of the mock catalog and base directory
+SCENARIOS = (
+    ("initial", [("initial_export.py", ["--parent", "*"], "initial_export", {})], None),
+    ("daily", [("last_update_export.py", [], "daily_export", {})], None),
+    ("daily-noop", [("last_update_export.py", [], None, {}), ("last_update_export.py", [], "daily_export", {})],
+     None),
+    ("daily-retry", [("last_update_export.py", [], None, {"FAKE_ISS_FAIL": FAIL_PATTERN, "SUMA_RETRY_DELAY": "0"}),
+                     days_later, ("last_update_export.py", [], "daily_export", {})], retried),
+)
+
+
+def bench_environment(base_dir, url, packages, iss_seconds):
+    """Return the environment pointing the scripts at the mock and fake ISS."""
+    bin_dir = os.path.join(base_dir, "bin")
+    os.makedirs(bin_dir)
+    # The rsync user of the exports does not exist here
+    with open(os.path.join(bin_dir, "chown"), "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(os.path.join(bin_dir, "chown"), 0o755)
+    config_path = os.path.join(base_dir, "mgr-sync")
+    with open(config_path, "w") as f:
+        f.write("mgrsync.user = bench\nmgrsync.password = bench\n")
+
+    env = dict(os.environ)
+    env.update({
+        "PATH": bin_dir + os.pathsep + env.get("PATH", ""),
+        "SUMA_URL": url,
+        "SUMA_CONFIG": config_path,
+        "SUMA_BASE_DIR": base_dir,
+        "SUMA_ISS_BIN": os.path.join(BENCH_DIR, "fake_iss.py"),
+        "FAKE_ISS_PACKAGES": str(packages),
+        "FAKE_ISS_PACKAGE_SIZE": str(PACKAGE_SIZE),
+        "FAKE_ISS_SECONDS": str(iss_seconds),
+    })
+    return env
+
+
+def latest_report(base_dir, run):
+    report_dir = os.path.join(base_dir, "logs", "reports")
+    try:
+        names = sorted(name for name in os.listdir(report_dir) if name.endswith(f"-{run}.json"))
+    except OSError:
+        return {}
+    if not names:
+        return {}
+    with open(os.path.join(report_dir, names[-1]), "r") as f:
+        return json.load(f)
+
+
+def run_scenario(steps, env, base_dir, catalog):
+    """Run the steps of a scenario, returns the result of the measured one."""
+    for step in steps:
+        if callable(step):
+            step(catalog, base_dir)
+            continue
+        script, script_args, run, step_env = step
+        started = time.monotonic()
+        process = subprocess.run([sys.executable, os.path.join(EXPORT_SCRIPTS, script)] + script_args,
+                                 cwd=EXPORT_SCRIPTS, env=dict(env, **step_env), stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        seconds = time.monotonic() - started
+        if run is None:
+            continue
+        report = latest_report(base_dir, run)
+        api = report.get("api", {})
+        return {
+            "seconds": round(seconds, 3),
+            "exit_code": process.returncode,
+            "channels": len(report.get("channels", {})),
+            "failed": report.get("failed", 0),
+            "api_requests": sum(stats["requests"] for stats in api.values()),
+            "api_calls": sum(stats["calls"] for stats in api.values()),
+            "api_seconds": round(sum(stats["seconds"] for stats in api.values()), 3),
+            "output": process.stdout[-2000:] if process.returncode else "",
+            "exported": [label for label, channel in report.get("channels", {}).items() if channel["exit_code"] == 0],
+        }
+
+
+def print_results(results):
+    print(f"{'Channels':>8} {'Scenario':<11} {'Seconds':>9} {'Exit':>4} {'Exported':>8} "
+          f"{'Requests':>8} {'Calls':>7} {'API s':>8}")
+    for result in results:
+        print(f"{result['channel_count']:>8} {result['scenario']:<11} {result['seconds']:>9.2f} "
+              f"{result['exit_code']:>4} {result['channels']:>8} {result['api_requests']:>8} "
+              f"{result['api_calls']:>7} {result['api_seconds']:>8.2f}")
+    for result in results:
+        if result["output"]:
+            print(f"\n{result['scenario']} with {result['channel_count']} channels failed:\n{result['output']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the export scripts against the mock SUSE Manager.")
+    parser.add_argument("--channels", default=CHANNEL_COUNTS, help="comma separated channel counts")
+    parser.add_argument("--packages", type=int, default=PACKAGES, help="packages per channel")
+    parser.add_argument("--latency", type=float, default=LATENCY, help="delay of every API request, in seconds")
+    parser.add_argument("--iss-seconds", type=float, default=0.0, help="duration of every fake ISS run")
+    parser.add_argument("--output", metavar="FILE", help="also write the results as JSON to FILE")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary base directories")
+    args = parser.parse_args()
+
+    results = []
+    for channel_count in [int(count) for count in args.channels.split(",")]:
+        server, url = mock_suma.start_server(channel_count, args.packages, latency=args.latency,
+                                             package_size=PACKAGE_SIZE)
+        try:
+            catalog = server.instance.catalog
+            for scenario, steps, check in SCENARIOS:
+                base_dir = tempfile.mkdtemp(prefix=f"suma-bench-{channel_count}-{scenario}-")
+                last_build = catalog.last_build
+                try:
+                    env = bench_environment(base_dir, url, args.packages, args.iss_seconds)
+                    result = run_scenario(steps, env, base_dir, catalog)
+                finally:
+                    catalog.last_build = last_build
+                    if not args.keep:
+                        shutil.rmtree(base_dir, ignore_errors=True)
+                error = check(result, catalog) if check else None
+                del result["exported"]
+                if error:
+                    result.update({"exit_code": result["exit_code"] or 1, "output": error + "\n" + result["output"]})
+                result.update({"channel_count": channel_count, "scenario": scenario})
+                results.append(result)
+                print(f"{channel_count} channels, {scenario}: {result['seconds']:.2f}s", flush=True)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    print()
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    sys.exit(1 if any(result["exit_code"] for result in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
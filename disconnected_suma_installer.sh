@@ -34,7 +34,7 @@ organize_files() {
   local target_dir=$1
   # Create directory trees
   mkdir -p /mnt/logs
-  mkdir -p /mnt/export/{initial,updates,scripts}
+  mkdir -p /mnt/export/{generations,scripts}
 
   # Copy files to their respective directories
   cp -a "${target_dir}/export_scripts/." /mnt/scripts/
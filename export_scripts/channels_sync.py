@@ -1,36 +1,158 @@
 #!/usr/bin/env python3
 
 """
-Description: 
+Description:
               This script is used to manage channels on a SUMA server.
               It reads channel names from a 'channels.txt' file, adds
-              them using 'mgr-sync' without synchronization until all
-              channels are added and then syncs the selected channels.
+              them without synchronization until all channels are added
+              and then syncs the selected channels.
+
+              The channels are added through the API in one session,
+              `sync.content.addChannels` calls sent in multicall batches,
+              parent channels before their children. Every label is checked
+              against the SCC channel list (`sync.content.listChannels`,
+              cached for CHANNEL_CACHE_TTL seconds) before anything is changed,
+              channels already installed are skipped. The status of every
+              channel is kept in STATE_FILE, a re-run after a failure only
+              handles the channels not done yet. A channel done in an earlier
+              run that the server no longer reports as installed (removed in
+              the meantime) is added again. Once all channels are added
+              the repository sync of the added channels is scheduled with
+              `channel.software.syncRepo`.
 
 Instructions:
              1. Define your channels.txt file path
              2. Set the list of channels to sync, one line per channel.
              3. chmod +x channels_sync.py and execute
+                ./channels_sync.py [channels.txt] [--no-sync] [--refresh]
+                Exits 1 when a channel could not be added or synced.
+
+Constants:
+             CHANNEL_CACHE - Cache of the SCC channel list.
+             CHANNEL_CACHE_TTL - Seconds the cached channel list is used.
+             STATE_FILE - Status of every channel of the last run.
 """
 
 import os
-import subprocess
+import time
+import argparse
+from xmlrpc.client import Fault
+import suma_api
+
+CHANNEL_CACHE = os.path.join(suma_api.CACHE_DIR, "scc_channels.json")
+CHANNEL_CACHE_TTL = 3600
+STATE_FILE = os.path.join(suma_api.CACHE_DIR, "channels_sync.json")
+DONE = ("added", "installed", "sync scheduled")
+
+
+def read_channels(channels_file):
+    """Return the labels of channels_file in order, without duplicates."""
+    labels = []
+    with open(channels_file, 'r') as file:
+        for line in file:
+            channel_name = line.split("#", 1)[0].strip()
+            if channel_name and channel_name not in labels:
+                labels.append(channel_name)
+    return labels
+
+
+def scc_channels(client, refresh=False):
+    """Return {label: channel} of the SCC channel list, cached."""
+    cache = suma_api.load_cache(CHANNEL_CACHE)
+    if refresh or not cache or time.time() - cache.get("fetched", 0) > CHANNEL_CACHE_TTL:
+        try:
+            cache = {"fetched": time.time(), "channels": client.call("sync.content.listChannels")}
+        except Fault as e:
+            print(f"Error: could not fetch the SCC channel list: {e.faultString}")
+            exit(1)
+        suma_api.save_cache(CHANNEL_CACHE, cache)
+    return {channel["label"]: channel for channel in cache["channels"]}
+
+
+def installed(channel):
+    return str(channel.get("status", "")).lower() == "installed"
+
+
+def sync_failed(state, label):
+    return state.get(label, "").startswith("sync failed")
+
+
+def add_channels(client, labels, state):
+    """Add labels in batches, records the status of each one in state."""
+    for label, result in zip(labels, suma_api.batch_call(client, "sync.content.addChannels",
+                                                         [(label, "") for label in labels], faults=True)):
+        if isinstance(result, Fault):
+            state[label] = f"add failed: {result.faultString}"
+        else:
+            state[label] = "added"
+
+
+def schedule_sync(client, labels, state):
+    try:
+        if client.call("channel.software.syncRepo", labels) != 1:
+            raise Fault(0, "syncRepo did not return 1")
+    except Fault as e:
+        for label in labels:
+            state[label] = f"sync failed: {e.faultString}"
+        return
+    for label in labels:
+        state[label] = "sync scheduled"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Add and sync the channels listed in a file.")
+    parser.add_argument("channels_file", nargs="?", default="channels.txt")
+    parser.add_argument("--no-sync", action="store_true", help="only add the channels")
+    parser.add_argument("--refresh", action="store_true", help="fetch the SCC channel list again")
+    args = parser.parse_args()
+
+    # Check if the channels file exists
+    if not os.path.isfile(args.channels_file):
+        print(f"Error: {args.channels_file} file not found.")
+        exit(1)
+    labels = read_channels(args.channels_file)
+    state = suma_api.load_cache(STATE_FILE)
+
+    with suma_api.connect() as client:
+        available = scc_channels(client, args.refresh)
+        unknown = [label for label in labels if label not in available]
+        if unknown:
+            print(f"Error: unknown channels, nothing was changed: {', '.join(unknown)}")
+            exit(1)
 
-# Define the path to the channels file
-channels_file = "channels.txt"
+        # The server decides what is installed, not the status of an old run
+        removed = [label for label in labels if state.get(label) in DONE and not installed(available[label])]
+        if removed and not args.refresh:
+            # The cached list may be older than the last run
+            available = scc_channels(client, refresh=True)
+            removed = [label for label in removed if not installed(available[label])]
+        for label in removed:
+            print(f"{label} is no longer installed, adding it again.")
+            del state[label]
+        for label in labels:
+            if installed(available[label]) and state.get(label) not in DONE:
+                state[label] = "installed"
+        pending = [label for label in labels if state.get(label) not in DONE and not sync_failed(state, label)]
+        # Parent channels first, a child can only be added once its parent is
+        parents = [label for label in pending if available[label].get("parent") in ("", "BASE", None, label)]
+        children = [label for label in pending if label not in parents]
+        for batch in (parents, children):
+            if batch:
+                add_channels(client, batch, state)
+                suma_api.save_cache(STATE_FILE, state)
 
-# Check if the channels file exists
-if not os.path.isfile(channels_file):
-    print("Error: channels.txt file not found.")
-    exit(1)
+        to_sync = [label for label in labels if state.get(label) == "added" or sync_failed(state, label)]
+        if to_sync and not args.no_sync:
+            schedule_sync(client, to_sync, state)
+            suma_api.save_cache(STATE_FILE, state)
 
-# Open and read the channels file
-with open(channels_file, 'r') as file:
-    for line in file:
-        channel_name = line.strip()
+    for label in labels:
+        print(f"{label}: {state.get(label, 'not added')}")
+    failed = [label for label in labels if state.get(label) not in DONE]
+    if failed:
+        print(f"{len(failed)} of {len(labels)} channels failed, run the script again to retry them.")
+        exit(1)
 
-        if channel_name:
-            subprocess.run(['mgr-sync', 'add', 'channel', channel_name, '--no-sync'])
 
-# Sync channels from the SCC
-subprocess.run(['mgr-sync', 'refresh', '--refresh-channels'])
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Description: Optional bundling of the channel exports into compressed chunks.
+
+             A large initial export is tens of thousands of small files, which
+             rsync (or a copy to removable media) transfers one by one. With
+             BUNDLE_ENABLED every channel export is packed as soon as its
+             `inter-server-sync export` finished, while the other channels are
+             still exporting: the channel directory is streamed through
+             `tar | zstd` and the compressed stream is cut into CHUNK_SIZE
+             files, written one after the other as the stream is produced.
+
+               bundles/<kind>/<label>/index.json
+               bundles/<kind>/<label>/00000.tar.zst.part, 00001..., ...
+
+             index.json lists the chunks in order with their size and SHA-256.
+             The chunks are plain files, so they can be transferred with rsync
+             or copied to media without hardlink or large file support, and
+             import_bundle.py unpacks them again before the import. Once the
+             manifest was written (it still lists the loose files, the importer
+             verifies the unpacked content against it) the loose directories
+             of bundled channels are removed from the generation.
+
+Constants:
+             BUNDLE_ENABLED - Bundle the channel exports, off by default.
+             BUNDLE_DIR - Name of the bundle directory in the generation.
+             CHUNK_SIZE - Size of each chunk file in bytes.
+             ZSTD_LEVEL - zstd compression level.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import subprocess
+
+BUNDLE_ENABLED = False
+BUNDLE_DIR = "bundles"
+CHUNK_SIZE = 1024 * 1024 * 1024  # Below the 4 GiB file size limit of FAT32 media
+ZSTD_LEVEL = 3
+INDEX_NAME = "index.json"
+BLOCK_SIZE = 1024 * 1024
+
+
+def bundle_path(generation_dir, kind, label):
+    return os.path.join(generation_dir, BUNDLE_DIR, kind, label)
+
+
+def write_chunks(stream, bundle_dir, chunk_size):
+    """Cut stream into chunk files, returns [[name, size, sha256]]."""
+    chunks = []
+    block = stream.read(min(BLOCK_SIZE, chunk_size))
+    while block:
+        name = f"{len(chunks):05d}.tar.zst.part"
+        digest = hashlib.sha256()
+        size = 0
+        with open(os.path.join(bundle_dir, name), "wb") as f:
+            while block:
+                f.write(block)
+                digest.update(block)
+                size += len(block)
+                if size >= chunk_size:
+                    break
+                block = stream.read(min(BLOCK_SIZE, chunk_size - size))
+        chunks.append([name, size, digest.hexdigest()])
+        block = stream.read(min(BLOCK_SIZE, chunk_size))
+    return chunks
+
+
+def bundle_channel(generation_dir, kind, label, chunk_size=CHUNK_SIZE, level=ZSTD_LEVEL):
+    """Pack generation_dir/<kind>/<label> into chunks, returns the index.
+
+    Raises OSError or subprocess.CalledProcessError when tar or zstd fail.
+    """
+    channel_dir = os.path.join(generation_dir, kind, label)
+    bundle_dir = bundle_path(generation_dir, kind, label)
+    tmp_dir = os.path.join(os.path.dirname(bundle_dir), f".{label}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    tar = subprocess.Popen(["tar", "-cf", "-", "-C", channel_dir, "."], stdout=subprocess.PIPE)
+    zstd = subprocess.Popen(["zstd", "-q", "-T0", f"-{level}", "-c"], stdin=tar.stdout, stdout=subprocess.PIPE)
+    tar.stdout.close()
+    try:
+        chunks = write_chunks(zstd.stdout, tmp_dir, chunk_size)
+    finally:
+        zstd.stdout.close()
+        for process, command in ((zstd, "zstd"), (tar, "tar")):
+            if process.wait() != 0:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise subprocess.CalledProcessError(process.returncode, command)
+
+    index = {"kind": kind, "label": label, "format": "tar+zstd", "chunk_size": chunk_size, "chunks": chunks}
+    with open(os.path.join(tmp_dir, INDEX_NAME), "w") as f:
+        json.dump(index, f, indent=1)
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.rename(tmp_dir, bundle_dir)
+    return index
+
+
+def bundled_channels(generation_dir):
+    """Return (kind, label) of every complete bundle in the generation."""
+    channels = []
+    root = os.path.join(generation_dir, BUNDLE_DIR)
+    for kind in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        for label in sorted(os.listdir(os.path.join(root, kind))):
+            if not label.startswith(".") and os.path.exists(os.path.join(root, kind, label, INDEX_NAME)):
+                channels.append((kind, label))
+    return channels
+
+
+def drop_bundled(generation_dir):
+    """Remove the loose directories of bundled channels, returns how many."""
+    channels = bundled_channels(generation_dir)
+    for kind, label in channels:
+        shutil.rmtree(os.path.join(generation_dir, kind, label), ignore_errors=True)
+    return len(channels)
@@ -0,0 +1,144 @@
+"""
+Description: Content addressed deduplication of the exported packages.
+
+             The same RPM is often exported into several channel directories
+             (Pool/Updates channels, modules shared between products). After
+             the exports finished every package file is looked up by size and
+             SHA-256, one copy of each duplicated package is kept in
+             POOL_DIR/<2 hex>/<sha256> and the copies in the channel
+             directories are replaced:
+
+               hardlink - by hardlinks to the pool file, `rsync -H` then
+                          transfers the content once.
+               manifest - not at all, they are only listed in the manifest.
+                          Used for media that can not hold hardlinks.
+
+             Every deduplicated file is listed in MANIFEST_NAME as
+             `<sha256>  <path>` (sha256sum format, paths relative to the export
+             directory), import.sh uses it to put missing files back in place
+             before running `inter-server-sync import`. Pool files no longer
+             listed in the manifest are removed.
+
+Constants:
+             DEDUP_MODE - 'hardlink' or 'manifest'.
+             POOL_DIR - Name of the pool directory inside the export directory.
+             MANIFEST_NAME - Name of the manifest inside the export directory.
+             DEDUP_SUFFIXES - File name endings that are deduplicated.
+"""
+
+import os
+import hashlib
+from collections import defaultdict
+
+DEDUP_MODE = "hardlink"
+POOL_DIR = "pool"
+MANIFEST_NAME = "dedup.manifest"
+DEDUP_SUFFIXES = (".rpm", ".drpm", ".deb")
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pool_path(export_dir, digest):
+    return os.path.join(export_dir, POOL_DIR, digest[:2], digest)
+
+
+def scan_pool(export_dir):
+    """Return ({(dev, inode): sha256}, {sizes}) of the files already in the pool."""
+    inodes = {}
+    sizes = set()
+    for root, _, files in os.walk(os.path.join(export_dir, POOL_DIR)):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            inodes[(st.st_dev, st.st_ino)] = name
+            sizes.add(st.st_size)
+    return inodes, sizes
+
+
+def removed_entries(export_dir):
+    """Manifest lines of files removed by an earlier run in manifest mode.
+
+    They are kept as long as their channel directory still exists.
+    """
+    try:
+        with open(os.path.join(export_dir, MANIFEST_NAME), "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return []
+    entries = []
+    for line in lines:
+        path = line.split(None, 1)[1].strip()
+        channel_dir = os.path.join(export_dir, *path.split(os.sep)[:2])
+        if not os.path.exists(os.path.join(export_dir, path)) and os.path.isdir(channel_dir):
+            entries.append(line)
+    return entries
+
+
+def package_files(export_dir, channel_dirs):
+    """Group the package files below channel_dirs by size."""
+    by_size = defaultdict(list)
+    for channel_dir in channel_dirs:
+        for root, _, files in os.walk(os.path.join(export_dir, channel_dir)):
+            for name in files:
+                if name.endswith(DEDUP_SUFFIXES):
+                    path = os.path.join(root, name)
+                    by_size[os.path.getsize(path)].append(path)
+    return by_size
+
+
+def link_to_pool(path, target):
+    tmp_path = f"{path}.dedup"
+    os.link(target, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def prune_pool(export_dir, referenced):
+    for root, _, files in os.walk(os.path.join(export_dir, POOL_DIR)):
+        for name in files:
+            if name not in referenced:
+                os.remove(os.path.join(root, name))
+
+
+def dedup_tree(export_dir, channel_dirs=("initial", "updates"), mode=DEDUP_MODE):
+    """Deduplicate the packages below export_dir, returns (files, bytes saved)."""
+    known, pool_sizes = scan_pool(export_dir)
+    manifest = removed_entries(export_dir)
+    deduplicated = saved = 0
+
+    for size, paths in package_files(export_dir, channel_dirs).items():
+        if len(paths) < 2 and size not in pool_sizes:
+            continue
+        by_digest = defaultdict(list)
+        for path in paths:
+            st = os.stat(path)
+            digest = known.get((st.st_dev, st.st_ino)) or file_digest(path)
+            by_digest[digest].append(path)
+
+        for digest, copies in by_digest.items():
+            target = pool_path(export_dir, digest)
+            if len(copies) < 2 and not os.path.exists(target):
+                continue
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.link(copies[0], target)
+            target_ino = os.stat(target).st_ino
+            for path in copies:
+                manifest.append(f"{digest}  {os.path.relpath(path, export_dir)}\n")
+                already_pooled = os.stat(path).st_ino == target_ino
+                if mode == "manifest":
+                    os.remove(path)
+                elif not already_pooled:
+                    link_to_pool(path, target)
+                if not already_pooled:
+                    deduplicated += 1
+                    saved += size
+
+    with open(os.path.join(export_dir, MANIFEST_NAME), "w") as f:
+        f.writelines(sorted(manifest))
+    prune_pool(export_dir, {line.split()[0] for line in manifest})
+    return deduplicated, saved
@@ -0,0 +1,191 @@
+"""
+Description: Generation based layout of the export directory.
+
+             Every export run writes into its own dated generation instead of
+             wiping and refilling the same directories:
+
+               /mnt/export/generations/<YYYYmmdd-HHMMSS>/{initial,updates,pool}
+               /mnt/export/current -> generations/<latest published>
+
+             A run writes into a hidden `.<name>` directory which is renamed and
+             becomes the target of the `current` symlink once the run finished,
+             both atomically, so a transfer never sees a half written
+             generation. Only the last KEEP_GENERATIONS generations are kept.
+             Older generations stay on disk untouched, so the importer can
+             transfer each new one with `rsync --link-dest` against the previous
+             generation and unchanged files cost nothing.
+
+             Every generation only holds what changed since the previous one,
+             a generation removed before it was imported is lost for good. The
+             importer (import.sh) uploads an acknowledgement to ACKS_DIR/<name>
+             for every imported generation. Once it did so, generations not
+             acknowledged yet are kept beyond KEEP_GENERATIONS until they are.
+
+             While a run writes its hidden generation it holds an flock on
+             `.<name>.running` next to it and touches that file every
+             HEARTBEAT_INTERVAL seconds. The importer only waits for exports
+             with a fresh heartbeat file. A run that crashed, was killed or
+             failed before publishing loses its lock, the next run discards its
+             hidden generation.
+
+Constants:
+             GENERATIONS_DIR - Name of the generations directory.
+             CURRENT_LINK - Name of the symlink to the latest generation.
+             KEEP_GENERATIONS - Number of generations kept.
+             ACKS_DIR - Directory receiving the acknowledgements of the importer.
+             HEARTBEAT_INTERVAL - Seconds between two touches of the heartbeat file.
+"""
+
+import os
+import fcntl
+import shutil
+import datetime
+import threading
+
+GENERATIONS_DIR = "generations"
+CURRENT_LINK = "current"
+KEEP_GENERATIONS = 7
+ACKS_DIR = "acks"
+HEARTBEAT_INTERVAL = 60
+RUNNING_SUFFIX = ".running"
+
+# Heartbeat file and stop event of the generations written by this process
+_running = {}
+
+
+def list_generations(export_dir):
+    """Return the generation names, oldest first."""
+    try:
+        names = os.listdir(os.path.join(export_dir, GENERATIONS_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if not name.startswith("."))
+
+
+def heartbeat(path, stop):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+def discard_stale(export_dir):
+    """Remove the hidden generations whose run does not hold its lock anymore."""
+    generations_dir = os.path.join(export_dir, GENERATIONS_DIR)
+    try:
+        names = os.listdir(generations_dir)
+    except FileNotFoundError:
+        return
+    hidden = {name[:-len(RUNNING_SUFFIX)] if name.endswith(RUNNING_SUFFIX) else name
+              for name in names if name.startswith(".")}
+    for name in sorted(hidden):
+        running_path = os.path.join(generations_dir, name + RUNNING_SUFFIX)
+        with open(running_path, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if os.path.isdir(os.path.join(generations_dir, name)):
+                print(f"Discarding the unfinished generation {name[1:]} of an export that did not complete.")
+                shutil.rmtree(os.path.join(generations_dir, name), ignore_errors=True)
+            os.remove(running_path)
+
+
+def new_generation(export_dir):
+    """Create and return the hidden directory of a new, unpublished generation."""
+    discard_stale(export_dir)
+    name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    generation_dir = os.path.join(export_dir, GENERATIONS_DIR, f".{name}")
+    # Locked before the directory exists, so no other run takes it for stale
+    os.makedirs(os.path.dirname(generation_dir), exist_ok=True)
+    running_path = generation_dir + RUNNING_SUFFIX
+    running = open(running_path, "a")
+    fcntl.flock(running, fcntl.LOCK_EX)
+    os.makedirs(generation_dir)
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(running_path, stop), daemon=True).start()
+    _running[generation_dir] = (running, stop)
+    return generation_dir
+
+
+def finish_generation(generation_dir):
+    """Stop the heartbeat of a generation and release its lock."""
+    if generation_dir not in _running:
+        return
+    running, stop = _running.pop(generation_dir)
+    stop.set()
+    try:
+        os.remove(generation_dir + RUNNING_SUFFIX)
+    except OSError:
+        pass
+    running.close()
+
+
+def current_generation(export_dir):
+    link = os.path.join(export_dir, CURRENT_LINK)
+    if not os.path.islink(link):
+        return None
+    return os.path.basename(os.readlink(link))
+
+
+def publish(export_dir, generation_dir):
+    """Make generation_dir visible and point current at it, returns its new path."""
+    name = os.path.basename(generation_dir).lstrip(".")
+    published_dir = os.path.join(export_dir, GENERATIONS_DIR, name)
+    os.rename(generation_dir, published_dir)
+    finish_generation(generation_dir)
+    link = os.path.join(export_dir, CURRENT_LINK)
+    tmp_link = f"{link}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join(GENERATIONS_DIR, name), tmp_link)
+    os.replace(tmp_link, link)
+    return published_dir
+
+
+def discard(generation_dir):
+    shutil.rmtree(generation_dir, ignore_errors=True)
+    finish_generation(generation_dir)
+
+
+def acks_dir(export_dir):
+    """Create and return the directory the importer acknowledges generations in."""
+    path = os.path.join(export_dir, ACKS_DIR)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def unacknowledged(export_dir):
+    """Return the published generations the importer did not acknowledge yet.
+
+    Empty while no acknowledgement was ever received, so importers that do
+    not acknowledge keep the plain KEEP_GENERATIONS behaviour. Generations
+    older than the first acknowledgement were imported before it existed.
+    """
+    try:
+        acks = set(os.listdir(os.path.join(export_dir, ACKS_DIR)))
+    except FileNotFoundError:
+        return set()
+    if not acks:
+        return set()
+    return {name for name in list_generations(export_dir) if name not in acks and name > min(acks)}
+
+
+def prune(export_dir, keep=KEEP_GENERATIONS, pending=None):
+    """Remove the oldest generations, the current and the pending ones are kept.
+
+    pending defaults to the generations not acknowledged by the importer.
+    """
+    pending = unacknowledged(export_dir) if pending is None else pending
+    current = current_generation(export_dir)
+    generations = list_generations(export_dir)
+    kept = []
+    for name in generations[:max(len(generations) - keep, 0)]:
+        if name in pending:
+            kept.append(name)
+        elif name != current:
+            # The (empty) acknowledgement stays, it tells where the importer started
+            shutil.rmtree(os.path.join(export_dir, GENERATIONS_DIR, name), ignore_errors=True)
+    if kept:
+        print(f"Keeping {len(kept)} old generations not imported yet: {', '.join(kept)}")
@@ -0,0 +1,116 @@
+"""
+Description: Keeps the exports from starving the live SUSE Manager server.
+
+             Every `inter-server-sync export` is started with a lower CPU
+             (nice NICE_LEVEL) and I/O priority (ionice class IONICE_CLASS,
+             level IONICE_LEVEL), so Taskomatic and the web UI keep precedence.
+
+             The number of exports running at the same time adapts to the
+             server: every CHECK_INTERVAL seconds the load average (per CPU)
+             and the number of PostgreSQL client connections are read. Above
+             LOAD_LIMIT or CONNECTION_LIMIT no new export is started until
+             fewer run than before (at least MIN_WORKERS keep going so the run
+             still progresses), below IDLE_RATIO of both limits one more export
+             is allowed again, up to the configured number of workers. Running
+             exports are never interrupted.
+
+             The PostgreSQL connections are counted from the process titles of
+             the backends (`postgres: <user> <database> <host> <state>`), no
+             database credentials are needed.
+
+Constants:
+             NICE_LEVEL - nice value of the exports, 0 disables it.
+             IONICE_CLASS - ionice class (1 realtime, 2 best-effort, 3 idle),
+                            0 disables it.
+             IONICE_LEVEL - ionice level within the best-effort class, 0-7.
+             LOAD_LIMIT - 1 minute load average per CPU above which the
+                          exports back off.
+             CONNECTION_LIMIT - PostgreSQL client connections above which the
+                                exports back off.
+             IDLE_RATIO - Share of both limits below which the exports ramp up.
+             MIN_WORKERS - Exports kept running while backing off.
+             CHECK_INTERVAL - Seconds between two checks.
+"""
+
+import os
+import time
+import shutil
+
+NICE_LEVEL = 10
+IONICE_CLASS = 2
+IONICE_LEVEL = 7
+LOAD_LIMIT = 1.5
+CONNECTION_LIMIT = 150
+IDLE_RATIO = 0.5
+MIN_WORKERS = 1
+CHECK_INTERVAL = 30
+
+
+def throttled(command):
+    """Prefix command with ionice and nice, when they are installed."""
+    prefix = []
+    if IONICE_CLASS and shutil.which("ionice"):
+        prefix += ["ionice", "-c", str(IONICE_CLASS)]
+        if IONICE_CLASS == 2:
+            prefix += ["-n", str(IONICE_LEVEL)]
+    if NICE_LEVEL and shutil.which("nice"):
+        prefix += ["nice", "-n", str(NICE_LEVEL)]
+    return prefix + list(command)
+
+
+def load_per_cpu():
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def postgres_connections():
+    """Count the PostgreSQL client backends of this server."""
+    count = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/cmdline", "rb") as f:
+                title = f.read().replace(b"\0", b" ").decode(errors="replace").split()
+        except OSError:
+            continue
+        # Background processes have short titles ('postgres: checkpointer'),
+        # client backends name their user, database, host and state.
+        if title and title[0] == "postgres:" and len(title) >= 5:
+            count += 1
+    return count
+
+
+class Governor:
+    """Number of exports allowed to run, adjusted to the load of the server."""
+
+    def __init__(self, max_workers, on_change=None):
+        self.max_workers = max_workers
+        self.allowed = max_workers
+        self.on_change = on_change
+        self.backoffs = 0
+        self.lowest = max_workers
+        self._checked = 0
+
+    def check(self):
+        """Return the number of exports allowed now, re-evaluated every CHECK_INTERVAL."""
+        if time.monotonic() - self._checked < CHECK_INTERVAL:
+            return self.allowed
+        self._checked = time.monotonic()
+        load, connections = load_per_cpu(), postgres_connections()
+        allowed = self.allowed
+        if load > LOAD_LIMIT or connections > CONNECTION_LIMIT:
+            allowed = max(MIN_WORKERS, self.allowed - 1)
+        elif load < LOAD_LIMIT * IDLE_RATIO and connections < CONNECTION_LIMIT * IDLE_RATIO:
+            allowed = min(self.max_workers, self.allowed + 1)
+        if allowed != self.allowed:
+            if allowed < self.allowed:
+                self.backoffs += 1
+                self.lowest = min(self.lowest, allowed)
+            if self.on_change:
+                self.on_change(f"Load {load:.2f} per CPU, {connections} database connections, "
+                               f"parallel exports limited to {allowed}.")
+            self.allowed = allowed
+        return self.allowed
+
+    def stats(self):
+        return {"backoffs": self.backoffs, "lowest_workers": self.lowest}
@@ -0,0 +1,116 @@
+"""
+Description: Streaming log handling for the export subprocesses.
+
+             The output of `inter-server-sync export` is read line by line as
+             it is produced and written to the daily log with a timestamp and
+             the channel it belongs to, so memory stays flat even with
+             `logLevel=debug` on large initial exports and channels exported
+             side by side can be told apart:
+
+               2024-05-01 00:12:03 [sle-product-sles15-sp5-updates-x86_64] ...
+
+             The daily log rotates once it reaches LOG_MAX_BYTES, keeping
+             LOG_BACKUPS rotated files, and logs older than LOG_KEEP_DAYS are
+             removed at the start of a run. The last ERROR_LINES lines that look
+             like errors are kept in a ring buffer for the summary printed at
+             the end of a run.
+
+             A process still running after its timeout is killed, its exit code
+             is then TIMEOUT_EXIT.
+
+Constants:
+             LOG_MAX_BYTES - Size at which the daily log is rotated.
+             LOG_BACKUPS - Number of rotated files kept per daily log.
+             LOG_KEEP_DAYS - Age in days after which logs are removed.
+             ERROR_LINES - Number of error lines kept for the summary.
+             TIMEOUT_EXIT - Exit code of a process killed after its timeout,
+                            the same as timeout(1).
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+LOG_MAX_BYTES = 100 * 1024 * 1024
+LOG_BACKUPS = 5
+LOG_KEEP_DAYS = 30
+ERROR_LINES = 20
+ERROR_WORDS = ("error", "fatal", "panic", "failed")
+TIMEOUT_EXIT = 124
+
+
+def open_log(log_file_path):
+    """Return the logger writing to log_file_path, shared by all threads."""
+    logger = logging.getLogger(f"disconnected_suma.{log_file_path}")
+    if not logger.handlers:
+        handler = RotatingFileHandler(log_file_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter("%(asctime)s [%(channel)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def write(logger, message, channel="-"):
+    logger.info(message, extra={"channel": channel})
+
+
+def error_buffer():
+    """Ring buffer of the last ERROR_LINES error lines of a run."""
+    return deque(maxlen=ERROR_LINES)
+
+
+def is_error(line):
+    line = line.lower()
+    return any(word in line for word in ERROR_WORDS)
+
+
+def run_logged(command, logger, channel, errors, timeout=None):
+    """Run command, streaming its output to the log, returns the exit code.
+
+    The process is killed after timeout seconds, TIMEOUT_EXIT is returned then.
+    """
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               text=True, errors="replace")
+    timed_out = threading.Event()
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, lambda: (timed_out.set(), process.kill()))
+        timer.daemon = True
+        timer.start()
+    with process.stdout:
+        for line in process.stdout:
+            line = line.rstrip()
+            if not line:
+                continue
+            write(logger, line, channel)
+            if is_error(line):
+                errors.append(f"{channel}: {line}")
+    returncode = process.wait()
+    if timer is not None:
+        timer.cancel()
+    if timed_out.is_set():
+        write(logger, f"Killed after the timeout of {timeout}s.", channel)
+        errors.append(f"{channel}: killed after the timeout of {timeout}s")
+        return TIMEOUT_EXIT
+    return returncode
+
+
+def prune_logs(log_dir, keep_days=LOG_KEEP_DAYS):
+    """Remove the log files in log_dir older than keep_days."""
+    cutoff = time.time() - keep_days * 86400
+    for name in os.listdir(log_dir):
+        path = os.path.join(log_dir, name)
+        if ".log" in name and os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+
+
+def print_summary(errors):
+    if errors:
+        print(f"Last {len(errors)} error lines:")
+        for line in errors:
+            print(f"  {line}")
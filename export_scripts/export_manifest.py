@@ -0,0 +1,152 @@
+"""
+Description: Transfer manifest written at the end of every export run.
+
+             MANIFEST_NAME lists every exported channel of the generation, its
+             parent channel and the path, size and SHA-256 of each of its files. When KEY_FILE
+             exists the manifest is signed with an HMAC-SHA256 of its content,
+             stored in SIGNATURE_NAME. The manifest is written before the
+             packages are deduplicated, which does not change any content.
+             COMPLETE_MARKER holds the SHA-256 of the manifest, it is written
+             last and tells the importer the generation is complete. The
+             manifest names the previous published generation, the importer
+             refuses to skip over one it never imported.
+
+             The importer (import_manifest.py) verifies the files against the
+             manifest and only imports channels whose content is complete.
+
+             The content manifest of the generation (package_index.CONTENT_NAME,
+             the packages and errata of every exported channel on this server)
+             is listed in the manifest with its size and SHA-256, so it is
+             covered by the signature. verify_import.py checks the import
+             server against it.
+
+Constants:
+             KEY_FILE - Shared signing key, the same file must exist on the
+                        import server. Create it with
+                        `openssl rand -hex 32 > /root/.disconnected_suma.key`.
+             MANIFEST_NAME - Name of the manifest in the generation directory.
+             SIGNATURE_NAME - Name of the signature file.
+             COMPLETE_MARKER - Name of the completion marker.
+             CHANNEL_KINDS - Generation subdirectories holding channel exports.
+"""
+
+import os
+import hmac
+import json
+import hashlib
+import datetime
+from xmlrpc.client import Fault
+from export_dedup import file_digest
+import export_generations
+import package_index
+
+KEY_FILE = "/root/.disconnected_suma.key"
+MANIFEST_NAME = "manifest.json"
+SIGNATURE_NAME = "manifest.json.sig"
+COMPLETE_MARKER = "COMPLETE"
+CHANNEL_KINDS = ("initial", "updates")
+
+
+def channel_entry(generation_dir, kind, label, parent=None, digests=None):
+    """Describe the files of one exported channel, digests caches by inode."""
+    digests = {} if digests is None else digests
+    files = []
+    for root, _, names in os.walk(os.path.join(generation_dir, kind, label)):
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            inode = (st.st_dev, st.st_ino)
+            if inode not in digests:
+                digests[inode] = file_digest(path)
+            files.append([os.path.relpath(path, generation_dir), st.st_size, digests[inode]])
+    return {"kind": kind, "label": label, "parent": parent, "files": sorted(files)}
+
+
+def exported_channels(generation_dir):
+    """Return (kind, label) of every channel directory in the generation."""
+    channels = []
+    for kind in CHANNEL_KINDS:
+        kind_dir = os.path.join(generation_dir, kind)
+        if os.path.isdir(kind_dir):
+            channels.extend((kind, label) for label in sorted(os.listdir(kind_dir)))
+    return channels
+
+
+def sign(data):
+    with open(KEY_FILE, "rb") as f:
+        key = f.read().strip()
+    return hmac.new(key, data, hashlib.sha256).hexdigest()
+
+
+def write_manifest(generation_dir, parents=None, digests=None):
+    """Write the manifest and its signature, returns the number of channels.
+
+    parents maps channel labels to their parent label, the importer uses it to
+    import parent channels before their children. digests are the SHA-256 of
+    files already hashed, by (dev, inode), see export_ready.ready_digests().
+    """
+    parents = parents or {}
+    digests = {} if digests is None else digests
+    channels = [channel_entry(generation_dir, kind, label, parents.get(label), digests)
+                for kind, label in exported_channels(generation_dir)]
+    published = export_generations.list_generations(os.path.dirname(os.path.dirname(generation_dir)))
+    manifest = {
+        "version": 1,
+        "generation": os.path.basename(generation_dir).lstrip("."),
+        "previous": published[-1] if published else None,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "channels": channels,
+    }
+    content_path = os.path.join(generation_dir, package_index.CONTENT_NAME)
+    if os.path.exists(content_path):
+        manifest["content"] = [package_index.CONTENT_NAME, os.path.getsize(content_path), file_digest(content_path)]
+    save_manifest(generation_dir, manifest)
+    return len(channels)
+
+
+def write_content(generation_dir, client, labels, packages_only_after=None, started=None):
+    """Write the content manifest of the exported channels, returns the number of channels.
+
+    packages_only_after maps labels to the packagesOnlyAfter of their export.
+    A channel exported with a date in the future (the parents of
+    initial_export.py) holds no packages, the import server keeps the packages
+    it has, so only its metadata is recorded. With a date in the past the
+    import server ends up with all packages, as without one. The packages and
+    errata modified since started, when the exports started, are only
+    listed as late.
+
+    The generation is still usable without it, only the verification after
+    the import is skipped.
+    """
+    today = datetime.date.today().isoformat()
+    metadata_only = {label for label, since in (packages_only_after or {}).items() if since and since[:10] > today}
+    try:
+        with client:
+            return package_index.write_content(os.path.join(generation_dir, package_index.CONTENT_NAME),
+                                               client, labels, metadata_only, started)
+    except (Fault, OSError) as e:
+        print(f"Warning: could not write the content manifest: {e}")
+        return 0
+
+
+def read_manifest(generation_dir):
+    with open(os.path.join(generation_dir, MANIFEST_NAME), "r") as f:
+        return json.load(f)
+
+
+def save_manifest(generation_dir, manifest):
+    """Write manifest and, when KEY_FILE exists, its signature."""
+    data = json.dumps(manifest, indent=1).encode()
+    with open(os.path.join(generation_dir, MANIFEST_NAME), "wb") as f:
+        f.write(data)
+    if os.path.exists(KEY_FILE):
+        with open(os.path.join(generation_dir, SIGNATURE_NAME), "w") as f:
+            f.write(sign(data) + "\n")
+
+
+def mark_complete(generation_dir):
+    """Write the completion marker, the last file written to a generation."""
+    with open(os.path.join(generation_dir, MANIFEST_NAME), "rb") as f:
+        manifest_digest = hashlib.sha256(f.read()).hexdigest()
+    with open(os.path.join(generation_dir, COMPLETE_MARKER), "w") as f:
+        f.write(manifest_digest + "\n")
@@ -0,0 +1,129 @@
+"""
+Description: Estimates the size and duration of an export before it starts.
+
+             For every selected channel the packages and errata that will be
+             exported are listed through the API (only those changed since the
+             packagesOnlyAfter date of the channel), the package sizes are
+             looked up with `packages.getDetails` in multicall batches and
+             cached in the export state database. Packages shared by several
+             channels are counted once, as export_dedup.py stores them once.
+
+             The expected wall time comes from the throughput of the previous
+             runs (see run_report.py). Before exporting, the estimate plus
+             PLAN_HEADROOM is compared with the free space of the export
+             filesystem, the export scripts refuse to start when it does not
+             fit. Run them with `--plan` to only print the estimate.
+
+Constants:
+             PLAN_HEADROOM - Extra space required on top of the estimate, for
+                             the SQL dumps and metadata of the export.
+             THROUGHPUT_REPORTS - Number of previous run reports averaged.
+"""
+
+import os
+import shutil
+import datetime
+import export_state
+import run_report
+import suma_api
+
+PLAN_HEADROOM = 0.1
+THROUGHPUT_REPORTS = 10
+
+
+def start_date(packages_only_after):
+    """Parse a packagesOnlyAfter value, 'YYYY-MM-DD' or 'YYYY-MM-DD hh:mm:ss'."""
+    if not packages_only_after:
+        return None
+    if " " in packages_only_after:
+        return datetime.datetime.strptime(packages_only_after, "%Y-%m-%d %H:%M:%S")
+    return datetime.datetime.strptime(packages_only_after, "%Y-%m-%d")
+
+
+def channel_contents(client, channels):
+    """Return [(packages, errata)] for [(label, packagesOnlyAfter or None)]."""
+    now = datetime.datetime.now()
+    args = []
+    for label, since in channels:
+        start = start_date(since)
+        args.append((label,) if start is None else (label, min(start, now)))
+    packages = suma_api.batch_call(client, "channel.software.listAllPackages", args)
+    errata = suma_api.batch_call(client, "channel.software.listErrata", args)
+    # A packagesOnlyAfter date in the future exports the channel without packages
+    return [([], []) if start_date(since) and start_date(since) > now else content
+            for (_, since), content in zip(channels, zip(packages, errata))]
+
+
+def package_sizes(client, state, package_ids):
+    """Return {package id: size in bytes}, fetching only the unknown sizes."""
+    sizes = export_state.package_sizes(state, package_ids)
+    missing = [package_id for package_id in package_ids if package_id not in sizes]
+    if missing:
+        details = suma_api.batch_call(client, "packages.getDetails", missing)
+        fetched = {package_id: int(detail.get("size") or 0) for package_id, detail in zip(missing, details)}
+        export_state.record_package_sizes(state, fetched)
+        sizes.update(fetched)
+    return sizes
+
+
+def throughput(runs):
+    """Bytes per second of the recent reports of runs, None without history."""
+    total_bytes = total_seconds = 0
+    for run in runs:
+        for report in run_report.load_reports(run)[-THROUGHPUT_REPORTS:]:
+            if report.get("bytes") and report.get("seconds"):
+                total_bytes += report["bytes"]
+                total_seconds += report["seconds"]
+    return total_bytes / total_seconds if total_seconds else None
+
+
+def make_plan(client, state, channels, runs, contents=None):
+    """Estimate the export of [(label, packagesOnlyAfter or None)].
+
+    runs are the run report names whose throughput is used for the duration,
+    contents the channel_contents() of channels when already fetched.
+    """
+    if contents is None:
+        contents = channel_contents(client, channels)
+    unique = {package["id"] for channel_packages, _ in contents for package in channel_packages}
+    sizes = package_sizes(client, state, sorted(unique))
+
+    plan = {"channels": {}, "packages": len(unique), "bytes": sum(sizes.values())}
+    for (label, since), (channel_packages, channel_errata) in zip(channels, contents):
+        plan["channels"][label] = {
+            "since": since,
+            "packages": len(channel_packages),
+            "errata": len(channel_errata),
+            "bytes": sum(sizes.get(package["id"], 0) for package in channel_packages),
+        }
+    plan["files"] = plan["packages"] + len(channels)
+    plan["required"] = int(plan["bytes"] * (1 + PLAN_HEADROOM))
+    rate = throughput(runs)
+    plan["seconds"] = int(plan["bytes"] / rate) if rate else None
+    return plan
+
+
+def free_space(path):
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def fits(plan, path):
+    return plan["required"] <= free_space(path)
+
+
+def print_plan(plan, path):
+    mib = 1048576
+    print(f"{'Channel':<60} {'Packages':>9} {'Errata':>7} {'MiB':>9}")
+    for label, channel in sorted(plan["channels"].items()):
+        print(f"{label:<60} {channel['packages']:>9} {channel['errata']:>7} {channel['bytes'] // mib:>9}")
+    print(f"Unique packages: {plan['packages']}, files: about {plan['files']}")
+    print(f"Estimated size: {plan['bytes'] // mib} MiB, "
+          f"{plan['required'] // mib} MiB required with {int(PLAN_HEADROOM * 100)}% headroom")
+    if plan["seconds"] is None:
+        print("Estimated time: unknown, no previous run reports")
+    else:
+        print(f"Estimated time: {datetime.timedelta(seconds=plan['seconds'])}")
+    free = free_space(path)
+    print(f"Free space on {path}: {free // mib} MiB{'' if plan['required'] <= free else ', NOT ENOUGH'}")
@@ -0,0 +1,229 @@
+"""
+Description: Bounded worker pool used by the export scripts to run several
+             `inter-server-sync export` processes at the same time.
+
+             Jobs are started largest first (by package count) so the long
+             running channels do not end up as the tail of the run, and a child
+             channel is only started once its parent channel, when it is part of
+             the same run, has finished.
+
+             The output of every job is streamed to the daily log as it is
+             produced, each line tagged with its channel, and the last error
+             lines are kept for the summary (see export_log.py). The wall time,
+             size and exit code of every export are added to the run report
+             when one is passed (see run_report.py).
+
+             Jobs created with a bundle target are packed into compressed chunks
+             right after their export succeeded (see export_bundle.py), inside
+             the same worker, so bundling overlaps with the exports still
+             running.
+
+             Jobs created with a ready target get a ready marker as soon as
+             their export succeeded (see export_ready.py), the importer can
+             fetch the channel while the rest of the run is still exporting.
+
+             The exports run with a lower CPU and I/O priority and fewer of
+             them are started while the server is busy (see
+             export_governor.py), max_workers is the upper bound.
+
+             A failed export is retried up to MAX_ATTEMPTS times, from an empty
+             directory, after RETRY_DELAY seconds doubled on every attempt. The
+             other channels carry on in the meantime, only the children of the
+             channel wait for it. An export running longer than JOB_TIMEOUT is
+             killed and counts as failed. The children of a channel that still
+             failed are not exported, their result is PARENT_FAILED_EXIT: the
+             importer could not import them without their parent.
+
+Constants:
+             MAX_WORKERS - Default number of exports running at the same time.
+             MAX_ATTEMPTS - Attempts per channel export.
+             RETRY_DELAY - Seconds before the first retry, overridden by
+                           SUMA_RETRY_DELAY.
+             JOB_TIMEOUT - Seconds after which one attempt is killed.
+             PARENT_FAILED_EXIT - Result of a job skipped for its failed parent.
+"""
+
+import os
+import time
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import export_bundle
+import export_governor
+import export_log
+import export_ready
+import run_report
+
+MAX_WORKERS = 4
+MAX_ATTEMPTS = 3
+RETRY_DELAY = int(os.environ.get("SUMA_RETRY_DELAY", 60))
+JOB_TIMEOUT = 6 * 3600
+PARENT_FAILED_EXIT = 125
+
+
+def make_job(label, command_args, output_dir, size=0, parent=None, bundle=None, ready=None):
+    """Describe one channel export for run_exports().
+
+    bundle is (generation_dir, kind) when the export is to be bundled, ready
+    the same when a ready marker is to be written instead.
+    """
+    return {
+        "label": label,
+        "command": command_args,
+        "output_dir": output_dir,
+        "size": size,
+        "parent": parent,
+        "bundle": bundle,
+        "ready": ready,
+        "attempt": 1,
+        "not_before": 0,
+        "seconds": 0.0,
+    }
+
+
+def bundle_job(job, logger, errors):
+    """Bundle a finished export, returns the exit code of the job."""
+    generation_dir, kind = job["bundle"]
+    try:
+        index = export_bundle.bundle_channel(generation_dir, kind, job["label"])
+    except (OSError, subprocess.CalledProcessError) as e:
+        export_log.write(logger, f"Bundling failed: {e}", job["label"])
+        errors.append(f"{job['label']}: bundling failed: {e}")
+        return 1
+    export_log.write(logger, f"Bundled into {len(index['chunks'])} chunks.", job["label"])
+    return 0
+
+
+def mark_ready(job, logger):
+    """Write the ready marker of a finished export, a failure only delays the import."""
+    generation_dir, kind = job["ready"]
+    try:
+        export_ready.write_ready(generation_dir, kind, job["label"], job["parent"], job["parent_in_run"])
+    except OSError as e:
+        export_log.write(logger, f"Could not write the ready marker: {e}", job["label"])
+
+
+def run_job(job, logger, errors):
+    if job["attempt"] > 1:
+        # Start the retry from scratch, not on top of the failed attempt
+        shutil.rmtree(job["output_dir"], ignore_errors=True)
+    os.makedirs(job["output_dir"], exist_ok=True)
+    started = time.monotonic()
+    returncode = export_log.run_logged(export_governor.throttled(job["command"]), logger, job["label"], errors,
+                                       timeout=JOB_TIMEOUT)
+    if returncode == 0 and job["bundle"]:
+        returncode = bundle_job(job, logger, errors)
+    elif returncode == 0 and job["ready"]:
+        mark_ready(job, logger)
+    return returncode, time.monotonic() - started
+
+
+def log_result(logger, label, returncode, seconds, attempts=1):
+    tries = f" after {attempts} attempts" if attempts > 1 else ""
+    if returncode == 0:
+        export_log.write(logger, f"Export for channel {label} completed in {seconds:.1f}s{tries}.", label)
+    else:
+        export_log.write(logger, f"Export for channel {label} failed after {seconds:.1f}s with exit code {returncode}{tries}.", label)
+
+
+def retry_later(job, logger, returncode):
+    """Queue the job again after its backoff, False when it has no attempt left."""
+    if job["attempt"] >= MAX_ATTEMPTS:
+        return False
+    delay = RETRY_DELAY * 2 ** (job["attempt"] - 1)
+    export_log.write(logger, f"Export for channel {job['label']} failed with exit code {returncode} "
+                             f"(attempt {job['attempt']} of {MAX_ATTEMPTS}), retrying in {delay}s.", job["label"])
+    job["attempt"] += 1
+    job["not_before"] = time.monotonic() + delay
+    return True
+
+
+def skip_orphans(waiting, results, logger, report=None):
+    """Drop the waiting jobs whose parent (or its parent) failed, as failed."""
+    skipped = True
+    while skipped:
+        skipped = False
+        for job in list(waiting):
+            if results.get(job["parent"], 0) == 0:
+                continue
+            waiting.remove(job)
+            results[job["label"]] = PARENT_FAILED_EXIT
+            export_log.write(logger, f"Export for channel {job['label']} skipped, parent channel "
+                                     f"{job['parent']} failed.", job["label"])
+            if report is not None:
+                run_report.add_channel(report, job["label"], PARENT_FAILED_EXIT, 0.0, attempts=0)
+            skipped = True
+
+
+def next_jobs(waiting, results, labels, free_slots):
+    """Pop up to free_slots jobs whose parent is not still pending and whose backoff is over."""
+    ready = []
+    now = time.monotonic()
+    for job in list(waiting):
+        if len(ready) >= free_slots:
+            break
+        if job["parent"] in labels and job["parent"] not in results:
+            continue
+        if job["not_before"] > now:
+            continue
+        waiting.remove(job)
+        ready.append(job)
+    return ready
+
+
+def run_exports(jobs, log_file_path, max_workers=MAX_WORKERS, report=None, errors=None):
+    """Run the export jobs concurrently, returns {label: returncode}.
+
+    errors is the ring buffer collecting the last error lines of the run.
+    """
+    logger = export_log.open_log(log_file_path)
+    errors = export_log.error_buffer() if errors is None else errors
+    labels = {job["label"] for job in jobs}
+    for job in jobs:
+        job["parent_in_run"] = job["parent"] in labels
+    waiting = sorted(jobs, key=lambda job: job["size"], reverse=True)
+    results = {}
+    running = {}
+    governor = export_governor.Governor(max_workers, lambda message: export_log.write(logger, message))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            skip_orphans(waiting, results, logger, report)
+            for job in next_jobs(waiting, results, labels, max(governor.check() - len(running), 0)):
+                running[executor.submit(run_job, job, logger, errors)] = job
+            # Wake up to re-check the load and for retries due, even when no
+            # export finishes
+            now = time.monotonic()
+            timeout = min([export_governor.CHECK_INTERVAL] +
+                          [job["not_before"] - now for job in waiting if job["not_before"] > now])
+            if not running:
+                if waiting:
+                    time.sleep(timeout)
+                continue
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                try:
+                    returncode, seconds = future.result()
+                except OSError as e:
+                    export_log.write(logger, f"Error starting export: {e}", job["label"])
+                    errors.append(f"{job['label']}: {e}")
+                    results[job["label"]] = 1
+                    continue
+                job["seconds"] += seconds
+                if returncode != 0 and retry_later(job, logger, returncode):
+                    waiting.append(job)
+                    continue
+                results[job["label"]] = returncode
+                log_result(logger, job["label"], returncode, job["seconds"], job["attempt"])
+                if report is not None:
+                    run_report.add_channel(report, job["label"], returncode, job["seconds"], job["output_dir"],
+                                           attempts=job["attempt"])
+    if report is not None:
+        report["governor"] = governor.stats()
+    return results
+
+
+def exit_status(results):
+    """Aggregate exit status of a run, non-zero when any export failed."""
+    return 0 if all(code == 0 for code in results.values()) else 1
@@ -0,0 +1,85 @@
+"""
+Description: Per channel ready markers, written while the export still runs.
+
+             As soon as the export of a channel succeeded its marker is written
+             to READY_DIR/<kind>/<label>.json inside the (still hidden)
+             generation: the same channel entry as in the manifest, the path,
+             size and SHA-256 of each file and the parent channel, with
+             whether the parent is exported by the same run, signed with
+             KEY_FILE when it exists. The marker is renamed into place last, so
+             a marker that can be read describes a finished channel.
+
+             The importer (sync_orchestrator.py) polls the markers of the
+             running export and transfers, verifies and imports each channel
+             right away instead of waiting for the whole generation. The
+             manifest written at the end of the run reuses the digests of the
+             markers for the files whose size and modification time (kept in
+             the marker) did not change since, the files are only hashed once.
+
+             Bundled channels get no marker, they are only shipped as a whole
+             generation.
+
+Constants:
+             READY_DIR - Name of the marker directory inside the generation.
+"""
+
+import os
+import json
+import export_manifest
+
+READY_DIR = "ready"
+
+
+def marker_path(generation_dir, kind, label):
+    return os.path.join(generation_dir, READY_DIR, kind, f"{label}.json")
+
+
+def write_ready(generation_dir, kind, label, parent=None, parent_in_run=False):
+    """Describe and sign a finished channel export, returns the marker path."""
+    # Taken before hashing, a file changed in the meantime is hashed again by ready_digests()
+    mtimes = {}
+    for root, _, names in os.walk(os.path.join(generation_dir, kind, label)):
+        for name in names:
+            path = os.path.join(root, name)
+            mtimes[os.path.relpath(path, generation_dir)] = os.stat(path).st_mtime_ns
+    entry = export_manifest.channel_entry(generation_dir, kind, label, parent)
+    entry["mtimes"] = mtimes
+    # The importer has to wait for a parent exported by the same run
+    entry["parent_in_run"] = parent_in_run
+    data = json.dumps(entry, indent=1).encode()
+    path = marker_path(generation_dir, kind, label)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(export_manifest.KEY_FILE):
+        with open(f"{path}.sig", "w") as f:
+            f.write(export_manifest.sign(data) + "\n")
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(data)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def ready_digests(generation_dir):
+    """Return {(dev, inode): sha256} of the files listed in the ready markers.
+
+    Files whose size or modification time changed since their marker was
+    written are left out, so the manifest hashes them again.
+    """
+    digests = {}
+    for root, _, names in os.walk(os.path.join(generation_dir, READY_DIR)):
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(root, name), "r") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            mtimes = entry.get("mtimes", {})
+            for path, size, digest in entry["files"]:
+                try:
+                    st = os.stat(os.path.join(generation_dir, path))
+                except OSError:
+                    continue
+                if st.st_size == size and st.st_mtime_ns == mtimes.get(path):
+                    digests[(st.st_dev, st.st_ino)] = digest
+    return digests
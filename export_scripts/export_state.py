@@ -0,0 +1,185 @@
+"""
+Description: Local SQLite store of what has been exported per channel.
+
+             For every channel the last build (the raw
+             `getChannelLastBuildById` value) that was exported successfully
+             is recorded. The daily export compares it with the current build
+             of the channel, so a channel is exported exactly once per build
+             no matter how often, or how rarely, the export runs, and the
+             packagesOnlyAfter date is taken from the previous build instead
+             of a fixed window.
+
+             A channel first seen after the database was set up has no
+             previous build: the packagesOnlyAfter window of its first export
+             attempt is recorded and used until one of its exports succeeds,
+             so a failed first export is retried with the same window.
+
+             The size of every package looked up by the export planner is kept
+             as well, a package never changes its size, so each one is only
+             fetched from the API once (see export_plan.py).
+
+             Runs in which the export of a channel failed (after its retries)
+             are counted until it succeeds again. A channel that failed
+             QUARANTINE_AFTER runs in a row is quarantined: the daily export
+             leaves it out for QUARANTINE_HOURS after its last failure, then
+             tries it again, instead of retrying it every run.
+
+             With several import targets (see export_targets.py) the ledger
+             records, per target, the channels of every generation served to
+             it and when the target acknowledged their import.
+
+Constants:
+             STATE_DB - Path of the SQLite database.
+             QUARANTINE_AFTER - Failed runs in a row before a channel is
+                                quarantined.
+             QUARANTINE_HOURS - Hours a quarantined channel is left out.
+"""
+
+import os
+import sqlite3
+import datetime
+
+STATE_DB = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "state", "export_state.db")
+QUARANTINE_AFTER = 3
+QUARANTINE_HOURS = 72
+
+
+def open_state(path=STATE_DB):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_state (
+            label TEXT PRIMARY KEY,
+            last_build TEXT NOT NULL,
+            exported_at TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS package_size (
+            id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_failure (
+            label TEXT PRIMARY KEY,
+            failures INTEGER NOT NULL,
+            last_failure TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_window (
+            label TEXT PRIMARY KEY,
+            since TEXT NOT NULL
+        )""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS target_ledger (
+            target TEXT NOT NULL,
+            generation TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            served_at TEXT NOT NULL,
+            acked_at TEXT,
+            PRIMARY KEY (target, generation, channel)
+        )""")
+    conn.commit()
+    return conn
+
+
+def last_builds(conn):
+    """Return {label: last exported build} for all known channels."""
+    return dict(conn.execute("SELECT label, last_build FROM channel_state"))
+
+
+def record_export(conn, label, last_build):
+    exported_at = datetime.datetime.now().isoformat(timespec="seconds")
+    conn.execute("""
+        INSERT INTO channel_state (label, last_build, exported_at) VALUES (?, ?, ?)
+        ON CONFLICT(label) DO UPDATE SET last_build = excluded.last_build,
+                                         exported_at = excluded.exported_at""",
+                 (label, last_build, exported_at))
+    conn.execute("DELETE FROM channel_failure WHERE label = ?", (label,))
+    conn.execute("DELETE FROM channel_window WHERE label = ?", (label,))
+    conn.commit()
+
+
+def first_windows(conn):
+    """Return {label: packagesOnlyAfter} of the channels never exported successfully."""
+    return dict(conn.execute("SELECT label, since FROM channel_window"))
+
+
+def record_window(conn, label, since):
+    """Keep the packagesOnlyAfter of the first export attempt of label."""
+    conn.execute("INSERT OR IGNORE INTO channel_window (label, since) VALUES (?, ?)", (label, since))
+    conn.commit()
+
+
+def record_failure(conn, label):
+    """Count a failed run of label, returns its failed runs in a row."""
+    failed_at = datetime.datetime.now().isoformat(timespec="seconds")
+    conn.execute("""
+        INSERT INTO channel_failure (label, failures, last_failure) VALUES (?, 1, ?)
+        ON CONFLICT(label) DO UPDATE SET failures = failures + 1,
+                                         last_failure = excluded.last_failure""",
+                 (label, failed_at))
+    conn.commit()
+    return conn.execute("SELECT failures FROM channel_failure WHERE label = ?", (label,)).fetchone()[0]
+
+
+def quarantined(conn):
+    """Return {label: failed runs} of the channels currently quarantined."""
+    since = (datetime.datetime.now() - datetime.timedelta(hours=QUARANTINE_HOURS)).isoformat(timespec="seconds")
+    return dict(conn.execute("""
+        SELECT label, failures FROM channel_failure
+        WHERE failures >= ? AND last_failure > ?""", (QUARANTINE_AFTER, since)))
+
+
+def package_sizes(conn, package_ids):
+    """Return {package id: size} for the ids already known."""
+    sizes = {}
+    package_ids = list(package_ids)
+    for start in range(0, len(package_ids), 500):
+        batch = package_ids[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        sizes.update(conn.execute(f"SELECT id, size FROM package_size WHERE id IN ({placeholders})", batch))
+    return sizes
+
+
+def record_package_sizes(conn, sizes):
+    conn.executemany("INSERT OR REPLACE INTO package_size (id, size) VALUES (?, ?)", sizes.items())
+    conn.commit()
+
+
+def record_served(conn, target, generation, channels):
+    """Record the channels ('<kind>/<label>') of generation served to target."""
+    served_at = datetime.datetime.now().isoformat(timespec="seconds")
+    conn.executemany("""
+        INSERT OR IGNORE INTO target_ledger (target, generation, channel, served_at) VALUES (?, ?, ?, ?)""",
+                     [(target, generation, channel, served_at) for channel in channels])
+    conn.commit()
+
+
+def record_acked(conn, target, generation, channels):
+    """Mark the channels of generation as imported by target."""
+    acked_at = datetime.datetime.now().isoformat(timespec="seconds")
+    conn.executemany("""
+        UPDATE target_ledger SET acked_at = ?
+        WHERE target = ? AND generation = ? AND channel = ? AND acked_at IS NULL""",
+                     [(acked_at, target, generation, channel) for channel in channels])
+    conn.commit()
+
+
+def pending_deliveries(conn, target):
+    """Return {generation: [channels]} served to target and not acknowledged yet."""
+    pending = {}
+    for generation, channel in conn.execute("""
+            SELECT generation, channel FROM target_ledger
+            WHERE target = ? AND acked_at IS NULL ORDER BY generation, channel""", (target,)):
+        pending.setdefault(generation, []).append(channel)
+    return pending
+
+
+def build_day(last_build):
+    """Date part of a getChannelLastBuildById value, 'YYYY-MM-DD'."""
+    return last_build.split()[0]
+
+
+def build_time(last_build):
+    """Date and time of a getChannelLastBuildById value, 'YYYY-MM-DD hh:mm:ss'."""
+    return " ".join(last_build.split()[:2])
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Fan-out of one export to several disconnected SUSE Manager
+             servers. The channels are exported once, every import target
+             then gets its own view of each generation holding only the
+             channels it subscribes to:
+
+               /mnt/export/targets/<target>/generations/<run>/...
+               /mnt/export/targets/<target>/current -> generations/<run>
+               /mnt/export/targets/<target>/acks/<run>
+
+             A view is made of hardlinks to the files of the generation, so it
+             costs no space and no second export. It has its own manifest,
+             signature and COMPLETE marker listing only its channels, the
+             entries of dedup.manifest and the pool files of its channels and
+             their bundles. Generations without any subscribed channel are not
+             served to the target at all.
+
+             The subscriptions are read from TARGETS_FILE, one section per
+             target listing channel labels or glob patterns:
+
+               site-a:
+                 - sle-product-sles15-sp5-*
+                 - sle-module-*-sp5-*
+               site-b:
+                 - '*'
+
+             Without TARGETS_FILE nothing changes, the importer reads the
+             generations directly. With it the daily export only exports the
+             channels at least one target subscribes to.
+
+             Every served channel is recorded in the ledger of the export
+             state database. The importer of a target (import.sh with `target:`
+             in import.yaml) uploads the list of the channels it imported to
+             acks/<run> once a generation is done, the next export run records
+             them as acknowledged. Views with channels not acknowledged yet are
+             kept when the old views are pruned. `./export_targets.py status`
+             shows what every target still has to import.
+
+Usage:
+             ./export_targets.py status
+
+Constants:
+             TARGETS_FILE - Subscriptions of the import targets.
+             EXPORT_DIR - Export directory read by `status`.
+             TARGETS_DIR - Directory of the target views in the export directory.
+             ACKS_DIR - Directory receiving the acknowledgements of a target.
+"""
+
+import os
+import fnmatch
+import argparse
+import export_bundle
+import export_dedup
+import export_generations
+import export_manifest
+import export_state
+
+TARGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "targets.yaml")
+EXPORT_DIR = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "export")
+TARGETS_DIR = "targets"
+ACKS_DIR = "acks"
+
+
+def read_targets(path=TARGETS_FILE):
+    """Return {target: [patterns]}, empty when path does not exist."""
+    targets = {}
+    target = None
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.split("#", 1)[0].rstrip()
+                if not line.strip():
+                    continue
+                if not line.startswith((" ", "-")) and line.endswith(":"):
+                    target = line[:-1].strip()
+                    targets[target] = []
+                elif line.strip().startswith("-") and target is not None:
+                    targets[target].append(line.strip()[1:].strip().strip("'\""))
+    except FileNotFoundError:
+        return {}
+    return targets
+
+
+def subscribed(patterns, label):
+    return any(fnmatch.fnmatch(label, pattern) for pattern in patterns)
+
+
+def wanted(targets, labels):
+    """Return the labels at least one target subscribes to."""
+    return [label for label in labels if any(subscribed(patterns, label) for patterns in targets.values())]
+
+
+def target_dir(export_dir, target):
+    return os.path.join(export_dir, TARGETS_DIR, target)
+
+
+def link_tree(source, destination):
+    """Hardlink every file below source into destination."""
+    for root, _, names in os.walk(source):
+        relative = os.path.relpath(root, source)
+        os.makedirs(os.path.join(destination, relative), exist_ok=True)
+        for name in names:
+            os.link(os.path.join(root, name), os.path.join(destination, relative, name))
+
+
+def build_view(generation_dir, view_dir, channels):
+    """Write the view of generation_dir holding channels (manifest entries)."""
+    names = [f"{channel['kind']}/{channel['label']}" for channel in channels]
+    for name in names:
+        for source in (os.path.join(generation_dir, name),
+                       os.path.join(generation_dir, export_bundle.BUNDLE_DIR, name)):
+            if os.path.isdir(source):
+                link_tree(source, os.path.join(view_dir, os.path.relpath(source, generation_dir)))
+
+    dedup_manifest = os.path.join(generation_dir, export_dedup.MANIFEST_NAME)
+    if os.path.exists(dedup_manifest):
+        entries = []
+        with open(dedup_manifest, "r") as f:
+            for line in f:
+                digest, _, path = line.rstrip("\n").partition("  ")
+                if any(path.startswith(name + "/") for name in names):
+                    entries.append(line)
+                    pool_file = export_dedup.pool_path(view_dir, digest)
+                    if not os.path.exists(pool_file):
+                        os.makedirs(os.path.dirname(pool_file), exist_ok=True)
+                        os.link(export_dedup.pool_path(generation_dir, digest), pool_file)
+        with open(os.path.join(view_dir, export_dedup.MANIFEST_NAME), "w") as f:
+            f.writelines(entries)
+
+    manifest = export_manifest.read_manifest(generation_dir)
+    manifest["channels"] = channels
+    # The previous generation served to this target, not the previous export
+    published = export_generations.list_generations(os.path.dirname(os.path.dirname(view_dir)))
+    manifest["previous"] = published[-1] if published else None
+    if manifest.get("content"):
+        os.link(os.path.join(generation_dir, manifest["content"][0]), os.path.join(view_dir, manifest["content"][0]))
+    export_manifest.save_manifest(view_dir, manifest)
+    export_manifest.mark_complete(view_dir)
+
+
+def read_acks(export_dir, targets, state):
+    """Record the acknowledgements uploaded by the importers, then drop them."""
+    for target in targets:
+        acks_dir = os.path.join(target_dir(export_dir, target), ACKS_DIR)
+        if not os.path.isdir(acks_dir):
+            continue
+        for generation in os.listdir(acks_dir):
+            path = os.path.join(acks_dir, generation)
+            with open(path, "r") as f:
+                channels = [line.strip() for line in f if line.strip()]
+            export_state.record_acked(state, target, generation, channels)
+            os.remove(path)
+
+
+def fan_out(export_dir, generation_dir, targets=None):
+    """Serve a published generation to every target, returns the new directories.
+
+    The returned directories still need to be handed to the rsync user.
+    """
+    targets = read_targets() if targets is None else targets
+    if not targets:
+        return []
+    generation = os.path.basename(generation_dir)
+    manifest = export_manifest.read_manifest(generation_dir)
+    state = export_state.open_state()
+    created = []
+    try:
+        read_acks(export_dir, targets, state)
+        for target, patterns in sorted(targets.items()):
+            channels = [channel for channel in manifest["channels"] if subscribed(patterns, channel["label"])]
+            acks_dir = os.path.join(target_dir(export_dir, target), ACKS_DIR)
+            if not os.path.isdir(acks_dir):
+                os.makedirs(acks_dir)
+                created.append(acks_dir)
+            if not channels:
+                continue
+            hidden_dir = os.path.join(target_dir(export_dir, target), export_generations.GENERATIONS_DIR, f".{generation}")
+            try:
+                os.makedirs(hidden_dir)
+                build_view(generation_dir, hidden_dir, channels)
+            except OSError as e:
+                # The target gets the channels with the next generation
+                print(f"Warning: could not serve {generation} to {target}: {e}")
+                export_generations.discard(hidden_dir)
+                continue
+            created.append(export_generations.publish(target_dir(export_dir, target), hidden_dir))
+            export_state.record_served(state, target, generation,
+                                       [f"{channel['kind']}/{channel['label']}" for channel in channels])
+            # The acknowledgements were moved to the ledger, it tells which views are still needed
+            export_generations.prune(target_dir(export_dir, target),
+                                     pending=set(export_state.pending_deliveries(state, target)))
+    finally:
+        state.close()
+    return created
+
+
+def print_status(export_dir, targets):
+    state = export_state.open_state()
+    try:
+        read_acks(export_dir, targets, state)
+        for target in sorted(targets):
+            pending = export_state.pending_deliveries(state, target)
+            channels = sum(len(names) for names in pending.values())
+            print(f"{target}: {len(pending)} generations, {channels} channels not imported yet")
+            for generation, names in sorted(pending.items()):
+                print(f"  {generation}: {', '.join(names)}")
+    finally:
+        state.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fan-out of the exports to several import targets.")
+    parser.add_argument("command", choices=("status",))
+    parser.parse_args()
+    targets = read_targets()
+    if not targets:
+        print(f"No targets defined in {TARGETS_FILE}.")
+        return
+    print_status(EXPORT_DIR, targets)
+
+
+if __name__ == "__main__":
+    main()
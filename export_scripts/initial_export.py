@@ -10,16 +10,54 @@ Description: This script is used for the initial export of channels for the
              specified channel, by choosing which parent channel to export,
              and optionally exporting individual child channels.
 
-             The script logs each export operation to a daily log file and
-             changes the ownership of the exported files to a specific user and
-             group.
+             Without arguments the channels are chosen from an interactive menu.
+             For unattended runs they are listed instead, with --parent and
+             --child or in a selection file (--config), as labels or glob
+             patterns, e.g. a whole new service pack in one run:
+
+               parents:
+                 - sle-product-sles15-sp6-pool-x86_64
+               children:
+                 - sle-module-*-sp6-updates-x86_64
+
+             Only the channels in scope of the rules in channels.yaml are
+             offered and matched, see channel_catalog.py.
+
+             A selected parent is exported with all of its child channels,
+             selected children already covered by a selected parent are only
+             exported once. The channels are exported in parallel, up to
+             MAX_WORKERS at a time, parent channels before their children (see
+             export_pool.py), a failed export is retried with a growing delay
+             while the others carry on. The script exits non-zero when any
+             export still failed, the failures are counted in the export state
+             database (see export_state.py).
+
+             Each run writes into a new dated generation below
+             EXPORT_DIR/generations which is published through the
+             EXPORT_DIR/current symlink once complete, see export_generations.py.
+
+             The script streams the output of each export to a daily, size
+             capped log file (see export_log.py) and changes the ownership of
+             the exported files to a specific user and group. The build of every
+             exported channel is recorded in the export state database so
+             last_update_export.py continues from it.
+             With export_bundle.BUNDLE_ENABLED every channel export is packed
+             into compressed chunks right after it finished.
+             The time, size and exit code of every channel export and the API
+             calls made are written to a run report, see run_report.py.
+             The packages and errata of the exported channels are listed in the
+             content manifest of the generation, checked on the import server
+             by verify_import.py.
 
 Constants:
-             BASE_DIR - Base directory from which channels are exported.
+             BASE_DIR - Base directory from which channels are exported,
+                        SUMA_BASE_DIR in the environment overrides it.
+             ISS_BIN - inter-server-sync command, overridden by SUMA_ISS_BIN.
              RSYNC_USER - Username owning the exported files.
              RSYNC_GROUP - Group owning the exported files.
              LOG_DIR - Directory where logs are stored.
              TODAY - Today's date, used for naming the log file.
+             MAX_WORKERS - Number of channels exported at the same time.
 
 Instructions:
              1. THIS SCRIPT REQUIRES THE USE OF THE mgr-sync -s refresh
@@ -30,78 +68,68 @@ Instructions:
                 and group on your system.
              4. Run this script with sufficient permissions to access and modify
                 the specified directories and files.
+             5. Run `./initial_export.py --config new_sp.yaml` or
+                `./initial_export.py --parent 'sle-product-sles15-sp6-*'` to
+                export without the interactive menu.
+             6. Run `./initial_export.py --plan` to only print the estimated size
+                and duration of the selected export, see export_plan.py. An
+                export that would not fit on the export filesystem is refused.
 """
 
 import os
+import sys
 import shutil
+import fnmatch
+import argparse
 import datetime
 import subprocess
-import configparser
-import ssl
-import socket
-from xmlrpc.client import ServerProxy, Fault
+from xmlrpc.client import Fault
 import shlex
+import channel_catalog
+import export_bundle
+import export_dedup
+import export_generations
+import export_log
+import export_manifest
+import export_plan
+import export_ready
+import export_pool
+import export_state
+import export_targets
+import run_report
+import suma_api
 
 # Constants
-BASE_DIR = "/mnt"
-INITIAL_DIR = os.path.join(BASE_DIR, "export/initial")
-UPDATES_DIR = os.path.join(BASE_DIR, "export/updates")
+BASE_DIR = os.environ.get("SUMA_BASE_DIR", "/mnt")
+ISS_BIN = os.environ.get("SUMA_ISS_BIN", "inter-server-sync")
+EXPORT_DIR = os.path.join(BASE_DIR, "export")  # Generations are written below EXPORT_DIR/generations
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 RSYNC_USER = "rsyncuser"
 RSYNC_GROUP = "users"
 TODAY = datetime.datetime.now().strftime("%Y-%m-%d")
 FIXED_DATE = datetime.date(2050, 1, 1)  # Fixed 'packagesOnlyAfter' date
 COMMON_OPTIONS = {'orgLimit': '2', 'logLevel': 'error'}  # Common options for export commands
+MAX_WORKERS = 4  # Number of channels exported at the same time
 
 def setup_directories():
+    """Create the log directory and return the directory of a new generation."""
     os.makedirs(LOG_DIR, exist_ok=True)
-    shutil.rmtree(INITIAL_DIR, ignore_errors=True)
-    os.makedirs(INITIAL_DIR, exist_ok=True)
-    shutil.rmtree(UPDATES_DIR, ignore_errors=True)
-    os.makedirs(UPDATES_DIR, exist_ok=True)
+    return export_generations.new_generation(EXPORT_DIR)
 
 def setup_logging():
     log_file_path = os.path.join(LOG_DIR, f"{TODAY}-combined-export.log")
     return log_file_path
 
-def create_client():
-    config_path = os.path.expanduser('/root/.mgr-sync')
-    config = configparser.ConfigParser()
-    with open(config_path, 'r') as f:
-        config.read_string('[DEFAULT]\n' + f.read())
-    manager_login = config.get('DEFAULT', 'mgrsync.user')
-    manager_password = config.get('DEFAULT', 'mgrsync.password')
-    suma_fqdn = socket.getfqdn()
-    manager_url = f"https://{suma_fqdn}/rpc/api"
-    context = ssl.create_default_context()
-    client = ServerProxy(manager_url, context=context)
-    try:
-        key = client.auth.login(manager_login, manager_password)
-        return client, key
-    except Fault as e:
-        print(f"Error logging in: {e}")
-        exit(1)
-
 def command_options(options_dict):
     """Generate command line options string from dictionary."""
     return ' '.join([f"--{opt}='{val}'" for opt, val in options_dict.items()])
 
-def channel_hierarchy(client, key):
+def channels_in_scope(client):
+    """Return the catalog and the channels in scope of channels.yaml, see channel_catalog.py."""
     try:
-        channels = client.channel.listVendorChannels(key)
-        parent_child_map = {}
-        for channel in channels:
-            details = client.channel.software.getDetails(key, channel["label"])
-            parent_label = details.get('parent_channel_label')
-            if parent_label:
-                if parent_label not in parent_child_map:
-                    parent_child_map[parent_label] = []
-                parent_child_map[parent_label].append(channel["label"])
-            else:
-                parent_child_map[channel["label"]] = []
-        return parent_child_map
+        return channel_catalog.channels_in_scope(client)
     except Fault as e:
-        print(f"Error fetching channel hierarchy: {e}")
+        print(f"Error fetching the channel catalog: {e}")
         exit(1)
 
 def user_selection(parent_child_map):
@@ -159,39 +187,169 @@ def user_selection(parent_child_map):
         print("Invalid choice. Please restart the script and choose 1 or 2.")
         exit(1)
 
-def export_channel(client, key, channel, output_dir, log_file_path, options_str, packages_only_after=None):
-    os.makedirs(output_dir, exist_ok=True)
-    command = f"inter-server-sync export --channels='{channel}' --outputDir='{output_dir}' {options_str}"
+def read_selection(path):
+    """Read the 'parents:' and 'children:' pattern lists of a selection file."""
+    selection = {"parents": [], "children": []}
+    key = None
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split("#", 1)[0].rstrip()
+            if not line.strip():
+                continue
+            if not line.startswith((" ", "-")):
+                key = line.split(":", 1)[0].strip()
+            elif line.strip().startswith("-") and key in selection:
+                selection[key].append(line.strip()[1:].strip().strip("'\""))
+    return selection
+
+def declared_selection(parent_child_map, parent_patterns, child_patterns):
+    """Return the selection matching the patterns in the user_selection() format."""
+    child_parents = {child: parent for parent, children in parent_child_map.items() for child in children}
+    unmatched = [pattern for pattern in parent_patterns if not fnmatch.filter(parent_child_map, pattern)]
+    unmatched += [pattern for pattern in child_patterns if not fnmatch.filter(child_parents, pattern)]
+    if unmatched:
+        print(f"No channel matches: {', '.join(unmatched)}")
+        exit(1)
+
+    parents = sorted({parent for pattern in parent_patterns for parent in fnmatch.filter(parent_child_map, pattern)})
+    children = sorted({child for pattern in child_patterns for child in fnmatch.filter(child_parents, pattern)})
+    selected = [(parent, None) for parent in parents]
+    # Children of a selected parent are exported with it already
+    selected += [(child_parents[child], child) for child in children if child_parents[child] not in parents]
+    return selected
+
+def export_job(channel, kind, packages_only_after, generation_dir, options_str, size, parent):
+    output_dir = os.path.join(generation_dir, kind, channel)
+    command = f"{ISS_BIN} export --channels='{channel}' --outputDir='{output_dir}' {options_str}"
     if packages_only_after:
         command += f" --packagesOnlyAfter='{packages_only_after}'"
-    result = subprocess.run(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print(f"Error during export of {channel}: {result.stderr.decode('utf-8')}")
-    # Log to file
-    with open(log_file_path, "a") as log_file:
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-        log_file.write(f"{current_time} Export for channel {channel} completed.\n")
+    bundle = (generation_dir, kind) if export_bundle.BUNDLE_ENABLED else None
+    return export_pool.make_job(channel, shlex.split(command), output_dir, size=size, parent=parent, bundle=bundle,
+                                ready=(generation_dir, kind))
+
+def planned_exports(selected_channels, parent_child_map):
+    """Return (channel, kind, packagesOnlyAfter) for every channel to export."""
+    planned = []
+    for parent, child in selected_channels:
+        if child:
+            planned.append((child, "updates", None))
+        else:
+            planned.append((parent, "initial", FIXED_DATE.strftime('%Y-%m-%d')))
+            for child_channel in parent_child_map[parent]:
+                planned.append((child_channel, "updates", None))
+    seen = set()
+    return [entry for entry in planned if not (entry[0] in seen or seen.add(entry[0]))]
 
 def main():
-    setup_directories()
+    parser = argparse.ArgumentParser(description="Export new parent or child channels.")
+    parser.add_argument("--parent", action="append", default=[], metavar="PATTERN",
+                        help="parent channel label or glob, exported with all of its children")
+    parser.add_argument("--child", action="append", default=[], metavar="PATTERN",
+                        help="child channel label or glob")
+    parser.add_argument("--config", metavar="FILE",
+                        help="selection file listing 'parents:' and 'children:' patterns")
+    parser.add_argument("--plan", action="store_true",
+                        help="only print the estimated size and duration of the export")
+    args = parser.parse_args()
+    parent_patterns, child_patterns = list(args.parent), list(args.child)
+    if args.config:
+        selection = read_selection(args.config)
+        parent_patterns += selection["parents"]
+        child_patterns += selection["children"]
+
+    start_time = datetime.datetime.now()
+    report = run_report.new_report("initial_export")
+    state = export_state.open_state()
+    with suma_api.connect() as client:
+        catalog, labels = channels_in_scope(client)
+        channel_list = catalog.vendor_channels(labels)
+        build_dates = dict(zip(labels, suma_api.last_build_dates(client, channel_list)))
+        parent_child_map = catalog.hierarchy(labels)
+    if parent_patterns or child_patterns:
+        selected_channels = declared_selection(parent_child_map, parent_patterns, child_patterns)
+    else:
+        selected_channels = user_selection(parent_child_map)
+    planned = planned_exports(selected_channels, parent_child_map)
+    with client:
+        plan = export_plan.make_plan(client, state, [(channel, since) for channel, _, since in planned],
+                                     ["initial_export", "daily_export"])
+
+    if args.plan:
+        export_plan.print_plan(plan, EXPORT_DIR)
+        state.close()
+        return
+    if not export_plan.fits(plan, EXPORT_DIR):
+        export_plan.print_plan(plan, EXPORT_DIR)
+        print(f"Not enough free space on {EXPORT_DIR}, the export was not started.")
+        state.close()
+        sys.exit(1)
+
+    generation_dir = setup_directories()
+    export_log.prune_logs(LOG_DIR)
     log_file_path = setup_logging()
-    client, key = create_client()
-    parent_child_map = channel_hierarchy(client, key)
-    selected_channels = user_selection(parent_child_map)
+    logger = export_log.open_log(log_file_path)
+    errors = export_log.error_buffer()
+    report["plan"] = {"bytes": plan["bytes"], "packages": plan["packages"], "seconds": plan["seconds"]}
     options_str = command_options(COMMON_OPTIONS)
 
-    for parent, child in selected_channels:
-        if child:
-            export_channel(client, key, child, os.path.join(UPDATES_DIR, child), log_file_path, options_str)
+    # Export the channels side by side, a parent is started before its
+    # children, sized by its children as it exports no packages itself
+    parents = {child: parent for parent, children in parent_child_map.items() for child in children}
+    packages = {channel["label"]: channel.get("packages", 0) for channel in channel_list}
+    jobs = []
+    for channel, kind, since in planned:
+        size = packages.get(channel, 0) + sum(packages.get(child, 0) for child in parent_child_map.get(channel, []))
+        jobs.append(export_job(channel, kind, since, generation_dir, options_str, size, parents.get(channel)))
+    exports_started = datetime.datetime.now()
+    results = export_pool.run_exports(jobs, log_file_path, MAX_WORKERS, report, errors)
+
+    # Record the exported builds so the daily export only picks up newer ones,
+    # failed channels are dropped from the generation
+    for channel, kind, _ in planned:
+        if results.get(channel) == 0:
+            export_state.record_export(state, channel, build_dates[channel])
         else:
-            export_channel(client, key, parent, os.path.join(INITIAL_DIR, parent), log_file_path, options_str, FIXED_DATE.strftime('%Y-%m-%d'))
-            for child_channel in parent_child_map[parent]:
-                export_channel(client, key, child_channel, os.path.join(UPDATES_DIR, child_channel), log_file_path, options_str)
+            shutil.rmtree(os.path.join(generation_dir, kind, channel), ignore_errors=True)
+            if results.get(channel) != export_pool.PARENT_FAILED_EXIT:
+                export_state.record_failure(state, channel)
+    state.close()
+
+    if not any(code == 0 for code in results.values()):
+        export_generations.discard(generation_dir)
+    else:
+        # List and checksum the exported files for the importer, with the
+        # packages and errata the import server has to end up with
+        export_manifest.write_content(generation_dir, client,
+                                      [label for label, code in results.items() if code == 0],
+                                      {channel: since for channel, _, since in planned}, exports_started)
+        export_manifest.write_manifest(generation_dir, parents, export_ready.ready_digests(generation_dir))
+        export_bundle.drop_bundled(generation_dir)
+
+        # Keep a single copy of packages exported into several channels
+        deduplicated, saved = export_dedup.dedup_tree(generation_dir)
+        report["dedup"] = {"files": deduplicated, "bytes_saved": saved}
+        export_log.write(logger, f"Deduplicated {deduplicated} package files, {saved // 1048576} MiB saved.")
+        export_manifest.mark_complete(generation_dir)
+
+        # Change ownership of the generation and publish it as current
+        subprocess.run(['chown', '-R', f'{RSYNC_USER}.{RSYNC_GROUP}', generation_dir], check=True)
+        published_dir = export_generations.publish(EXPORT_DIR, generation_dir)
+        # Serve the generation to every import target, see export_targets.py
+        for path in export_targets.fan_out(EXPORT_DIR, published_dir):
+            subprocess.run(['chown', '-R', f'{RSYNC_USER}.{RSYNC_GROUP}', path], check=True)
+        # The importer acknowledges every imported generation, see export_generations.py
+        subprocess.run(['chown', f'{RSYNC_USER}.{RSYNC_GROUP}', export_generations.acks_dir(EXPORT_DIR)], check=True)
+        export_generations.prune(EXPORT_DIR)
+    run_report.write_report(report, client)
+    total_time = datetime.datetime.now() - start_time
+    export_log.write(logger, f"Total execution time: {total_time}")
 
-    subprocess.run(['chown', '-R', f'{RSYNC_USER}.{RSYNC_GROUP}', BASE_DIR], check=True)
-    total_time = datetime.datetime.now() - datetime.datetime.strptime(TODAY, "%Y-%m-%d")
-    with open(log_file_path, "a") as log_file:
-        log_file.write(f"Total execution time: {total_time}\n")
+    failed = [label for label, code in results.items() if code != 0]
+    print(f"Exported {len(results) - len(failed)} of {len(results)} channels.")
+    if failed:
+        print(f"Export failed for {len(failed)} of {len(results)} channels: {', '.join(failed)}")
+        export_log.print_summary(errors)
+    sys.exit(export_pool.exit_status(results))
 
 if __name__ == "__main__":
     main()
@@ -8,15 +8,38 @@ Description:
                 client to interface with a server for use in Airgapped Environments or
                 Disconnected SUMA.
 
-                It is designed to operate on a scheduled basis (daily), removing the
-                previous day's export data, and writing new export logs into designated
-                directories.
+                It is designed to operate on a scheduled basis (daily), writing each run
+                into a new dated generation below '/mnt/export/generations' that is
+                published through the '/mnt/export/current' symlink once complete, and
+                writing new export logs into designated directories. The last
+                KEEP_GENERATIONS generations are kept, see export_generations.py.
+
+                Channels are exported in parallel, up to MAX_WORKERS at a time, the
+                largest channels are started first and a child channel waits for its
+                parent channel when both are part of the run. A failed export is
+                retried with a growing delay while the other channels carry on (see
+                export_pool.py), the script exits non-zero when any channel export
+                still failed. A channel that failed several runs in a row is
+                quarantined and left out for a while, see export_state.py.
 
                 The concept behind the script is to use the API's to determine which
-                channels have been updated within the defined dates, and export only 
+                channels have been updated since their last export, and export only 
                 those channels, as such, this creates a more streamlined export/import
                 for Disconnected or Airgapped systems.
 
+                The last exported build of every channel is kept in a local SQLite
+                database ('/mnt/state/export_state.db'), a channel is exported once per
+                new build with packagesOnlyAfter set to the day of the previous build, so
+                a missed run is caught up by the next one and a second run on the same
+                day exports nothing new. Channels not yet in the database use the
+                TARGET_DATE window instead, until their first export succeeded.
+
+                With DELTA_MODE (the default) the API is asked which packages and
+                errata of a rebuilt channel changed since the previous build, a
+                metadata only rebuild is recorded without exporting the channel and
+                the others are exported with packagesOnlyAfter set to the exact time
+                of the previous build instead of its day.
+
 Instructions:
                 1. Ensure Python 3.x is installed on your system.
                 2. This script must be run with root privileges to manage file
@@ -29,13 +52,38 @@ Instructions:
                    space.
                 5. Customize the 'RSYNC_USER' and 'RSYNC_GROUP' in the script to match
                    the user and group names on your system.
-                6. Schedule this script using a cron job or another scheduler for daily 
+                6. Adjust 'MAX_WORKERS' to the number of exports the server can run at
+                   the same time.
+                7. Schedule this script using a cron job or another scheduler for daily 
                    execution.
 
 Intended Usage:
                 - Scheduled daily exports of software channel data.
-                - Logging of export operations in '/mnt/logs'.
-                - Exports are stored in '/mnt/export/updates'.
+                - `./last_update_export.py --plan` prints the channels that would be
+                  exported with their estimated size and duration, see
+                  export_plan.py. A run that would not fit on the export
+                  filesystem is refused.
+                - `./last_update_export.py --include-quarantined` also exports the
+                  quarantined channels.
+                - Logging of export operations in '/mnt/logs', the output of every
+                  export is streamed into a size capped daily log with the channel
+                  on each line and logs older than 30 days are removed, see
+                  export_log.py. A JSON and Prometheus
+                  report of every run in '/mnt/logs/reports', see run_report.py.
+                - Exports are stored in '/mnt/export/generations/<run>/updates'.
+                - With export_bundle.BUNDLE_ENABLED every channel is packed into
+                  zstd compressed chunks in '/mnt/export/generations/<run>/bundles'.
+                - Only the channels in scope of the rules in channels.yaml are
+                  looked at, see channel_catalog.py.
+                - With several import targets (export_targets.py) only their
+                  channels are exported and each target gets a view of the
+                  generation in '/mnt/export/targets/<target>'.
+                - The packages and errata of the exported channels are listed in
+                  '/mnt/export/generations/<run>/content.idx.gz', the import
+                  server is checked against it with verify_import.py.
+                - Packages exported into several channels are stored once in
+                  '/mnt/export/generations/<run>/pool' and hardlinked, see
+                  export_dedup.py.
                 - This script is intended for systems administrators managing software
                   channel updates for Airgapped Environments.
 
@@ -43,80 +91,237 @@ Ensure the server and paths are correctly configured and accessible before runni
 """
 
 import os
+import argparse
 import subprocess
 import datetime
-from xmlrpc.client import ServerProxy
-import ssl
-import socket
-import configparser
 import shutil
 import shlex
+import sys
+import channel_catalog
+import export_bundle
+import export_dedup
+import export_generations
+import export_log
+import export_manifest
+import export_plan
+import export_ready
+import export_pool
+import export_state
+import export_targets
+import run_report
+import suma_api
 
 # Configuration Variables
-BASE_DIR = "/mnt"  # Define base directory where the exports will be.
-OUTPUT_DIR = os.path.join(BASE_DIR, "export/updates")
+BASE_DIR = os.environ.get("SUMA_BASE_DIR", "/mnt")  # Define base directory where the exports will be.
+ISS_BIN = os.environ.get("SUMA_ISS_BIN", "inter-server-sync")  # inter-server-sync command, overridden for benchmarks
+EXPORT_DIR = os.path.join(BASE_DIR, "export")  # Generations are written below EXPORT_DIR/generations
 LOG_DIR = os.path.join(BASE_DIR, "logs")
 TODAY = datetime.date.today()
-TARGET_DATE = TODAY - datetime.timedelta(days=1)  # Define the number of days back for export, 1 day by default
+TARGET_DATE = TODAY - datetime.timedelta(days=1)  # Define the number of days back for channels not yet in the state database, 1 day by default
 RSYNC_USER = "rsyncuser"  # Define rsync user
 RSYNC_GROUP = "users"     # Define rsync group
+MAX_WORKERS = 4           # Define the number of channels exported at the same time
+DELTA_MODE = True         # Only export channels whose packages or errata changed, see select_changed()
 
-def setup_directories(base_path, output_path, log_path):
-    if not os.path.exists(base_path):
-        os.makedirs(base_path, exist_ok=True)
-    if not os.path.exists(log_path):
-        os.makedirs(log_path, exist_ok=True)
-    if os.path.exists(output_path):
-        shutil.rmtree(output_path)
-    os.makedirs(output_path, exist_ok=True)
+def setup_directories(base_path, export_path, log_path):
+    """Create the directories and return the output directory of a new generation."""
+    os.makedirs(base_path, exist_ok=True)
+    os.makedirs(log_path, exist_ok=True)
+    generation_dir = export_generations.new_generation(export_path)
+    return generation_dir
 
 def setup_logging(LOG_DIR, TODAY):
     log_file_path = os.path.join(LOG_DIR, f"{TODAY}-daily_export.log")
     return log_file_path
 
-def create_client():
-    config_path = os.path.expanduser('/root/.mgr-sync')
-    config = configparser.ConfigParser()
-    with open(config_path, 'r') as f:
-        config.read_string('[DEFAULT]\n' + f.read())
-    manager_login = config.get('DEFAULT', 'mgrsync.user')
-    manager_password = config.get('DEFAULT', 'mgrsync.password')
-    suma_fqdn = socket.getfqdn()
-    manager_url = f"https://{suma_fqdn}/rpc/api"
-    context = ssl.create_default_context()
-    client = ServerProxy(manager_url, context=context)
-    return client, client.auth.login(manager_login, manager_password)
-
-# Setup Directories and Logging
-setup_directories(BASE_DIR, OUTPUT_DIR, LOG_DIR)
-log_file_path = setup_logging(LOG_DIR, TODAY)
-
-# Create XML-RPC Client
-client, key = create_client()
-
-# Process channels
-channel_list = client.channel.listVendorChannels(key)
-for channel in channel_list:
-    build_date, channel_label = client.channel.software.getChannelLastBuildById(key, channel["id"]).split()[0], channel["label"]
-    build_date = datetime.datetime.strptime(build_date, "%Y-%m-%d").date()
-
-    if TARGET_DATE <= build_date <= TODAY:
-        channel_OUTPUT_DIR = os.path.join(OUTPUT_DIR, channel_label)
-        os.makedirs(channel_OUTPUT_DIR, exist_ok=True)
-        options_dict = {
-            "outputDir": channel_OUTPUT_DIR,
-            "orgLimit": "2",  # Define the default Organization, 2 by default assuming there is only 1, if multiple set this to the one you assign for exporting.
-            "logLevel": "error",  # Set as 'error' by default but change to 'debug' for detailed logging
-            "packagesOnlyAfter": TARGET_DATE.strftime('%Y-%m-%d')
-        }
-        options = ' '.join([f"--{opt}='{val}'" for opt, val in options_dict.items()])
-        command = f"inter-server-sync export --channels='{channel_label}' {options}"
-        command_args = shlex.split(command)
-        with open(log_file_path, "a") as log_file:
-            subprocess.run(command_args, stdout=log_file, stderr=subprocess.STDOUT, check=True)
-            current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-            completion_message = f"{current_time} Export for channel {channel_label} completed.\n"
-            log_file.write(completion_message)
-
-# Change ownership of the output directory
-subprocess.run(["chown", "-R", f"{RSYNC_USER}:{RSYNC_GROUP}", OUTPUT_DIR], check=True)
+def select_channels(client, state, dry_run=False):
+    """Return (channel, current build, packagesOnlyAfter) for the channels to export.
+
+    A channel is exported when its build differs from the last exported build
+    recorded in the state database. Channels not yet in the database are
+    exported with the TARGET_DATE window, kept until they were exported once
+    (see export_state.record_window). Only while the database is still empty,
+    on the first run, the channels built before TARGET_DATE are recorded as
+    they are without an export, unless dry_run is set.
+    """
+    selected = []
+    exported = export_state.last_builds(state)
+    windows = export_state.first_windows(state)
+    first_run = not exported and not windows
+    # Only the channels in scope of channels.yaml, see channel_catalog.py
+    catalog, labels = channel_catalog.channels_in_scope(client)
+    channel_list = catalog.vendor_channels(labels)
+    build_dates = suma_api.last_build_dates(client, channel_list)
+    for channel, last_build in zip(channel_list, build_dates):
+        channel_label = channel["label"]
+        if channel_label in exported:
+            if exported[channel_label] != last_build:
+                if DELTA_MODE:
+                    since = export_state.build_time(exported[channel_label])
+                else:
+                    since = export_state.build_day(exported[channel_label])
+                selected.append((channel, last_build, since))
+            continue
+        if channel_label in windows:
+            # Not exported successfully yet, retried with its first window
+            selected.append((channel, last_build, windows[channel_label]))
+            continue
+        build_date = datetime.datetime.strptime(export_state.build_day(last_build), "%Y-%m-%d").date()
+        if first_run and not TARGET_DATE <= build_date <= TODAY:
+            if not dry_run:
+                export_state.record_export(state, channel_label, last_build)
+            continue
+        since = TARGET_DATE.strftime('%Y-%m-%d')
+        selected.append((channel, last_build, since))
+        if not dry_run:
+            export_state.record_window(state, channel_label, since)
+    return selected
+
+def select_changed(client, state, selected, dry_run=False):
+    """Drop the channels without new packages or errata since packagesOnlyAfter.
+
+    A new build without new packages or errata is a metadata only rebuild, the
+    build is recorded (unless dry_run is set) without exporting the channel.
+    Returns the remaining channels and their export_plan.channel_contents().
+    """
+    contents = export_plan.channel_contents(client, [(channel["label"], since) for channel, _, since in selected])
+    changed = []
+    for entry, (packages, errata) in zip(selected, contents):
+        channel, last_build, since = entry
+        if packages or errata:
+            changed.append((entry, (packages, errata)))
+        else:
+            print(f"Skipping {channel['label']}, no new packages or errata since {since}")
+            if not dry_run:
+                export_state.record_export(state, channel["label"], last_build)
+    return [entry for entry, _ in changed], [content for _, content in changed]
+
+def export_job(channel, parent_label, packages_only_after, output_dir, bundle=None, ready=None):
+    channel_label = channel["label"]
+    channel_OUTPUT_DIR = os.path.join(output_dir, channel_label)
+    options_dict = {
+        "outputDir": channel_OUTPUT_DIR,
+        "orgLimit": "2",  # Define the default Organization, 2 by default assuming there is only 1, if multiple set this to the one you assign for exporting.
+        "logLevel": "error",  # Set as 'error' by default but change to 'debug' for detailed logging
+        "packagesOnlyAfter": packages_only_after
+    }
+    options = ' '.join([f"--{opt}='{val}'" for opt, val in options_dict.items()])
+    command = f"{ISS_BIN} export --channels='{channel_label}' {options}"
+    return export_pool.make_job(channel_label, shlex.split(command), channel_OUTPUT_DIR,
+                                size=channel.get("packages", 0), parent=parent_label, bundle=bundle,
+                                ready=ready)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the channels updated since their last export.")
+    parser.add_argument("--plan", action="store_true",
+                        help="only print the estimated size and duration of the export")
+    parser.add_argument("--include-quarantined", action="store_true",
+                        help="also export the channels quarantined after repeated failures")
+    args = parser.parse_args()
+
+    report = run_report.new_report("daily_export")
+
+    # Create XML-RPC Client and select the channels changed since their last export
+    state = export_state.open_state()
+    with suma_api.connect() as client:
+        selected = select_channels(client, state, dry_run=args.plan)
+        quarantined = {} if args.include_quarantined else export_state.quarantined(state)
+        for channel, _, _ in selected:
+            if channel["label"] in quarantined:
+                print(f"Skipping {channel['label']}, quarantined after {quarantined[channel['label']]} failed runs")
+        selected = [entry for entry in selected if entry[0]["label"] not in quarantined]
+        # With several import targets only the channels one of them subscribes to
+        targets = export_targets.read_targets()
+        if targets:
+            subscribed = set(export_targets.wanted(targets, [channel["label"] for channel, _, _ in selected]))
+            selected = [entry for entry in selected if entry[0]["label"] in subscribed]
+        contents = None
+        if DELTA_MODE:
+            selected, contents = select_changed(client, state, selected, dry_run=args.plan)
+        parents = suma_api.channel_parents(client, [channel["label"] for channel, _, _ in selected])
+        plan = export_plan.make_plan(client, state, [(channel["label"], since) for channel, _, since in selected],
+                                     ["daily_export"], contents)
+
+    if args.plan:
+        export_plan.print_plan(plan, EXPORT_DIR)
+        state.close()
+        return
+    if not export_plan.fits(plan, EXPORT_DIR):
+        export_plan.print_plan(plan, EXPORT_DIR)
+        print(f"Not enough free space on {EXPORT_DIR}, the export was not started.")
+        state.close()
+        sys.exit(1)
+
+    # Setup Directories and Logging
+    generation_dir = setup_directories(BASE_DIR, EXPORT_DIR, LOG_DIR)
+    output_dir = os.path.join(generation_dir, "updates")
+    export_log.prune_logs(LOG_DIR)
+    log_file_path = setup_logging(LOG_DIR, TODAY)
+    logger = export_log.open_log(log_file_path)
+    errors = export_log.error_buffer()
+    report["plan"] = {"bytes": plan["bytes"], "packages": plan["packages"], "seconds": plan["seconds"]}
+    report["quarantined"] = sorted(quarantined)
+
+    # Process channels, several exports run side by side
+    bundle = (generation_dir, "updates") if export_bundle.BUNDLE_ENABLED else None
+    ready = (generation_dir, "updates")
+    jobs = [export_job(channel, parents[channel["label"]], since, output_dir, bundle, ready)
+            for channel, _, since in selected]
+    exports_started = datetime.datetime.now()
+    results = export_pool.run_exports(jobs, log_file_path, MAX_WORKERS, report, errors)
+
+    # Record the exported builds, failed channels are dropped from the
+    # generation and picked up again next run
+    newly_quarantined = []
+    for channel, last_build, _ in selected:
+        if results.get(channel["label"]) == 0:
+            export_state.record_export(state, channel["label"], last_build)
+        else:
+            shutil.rmtree(os.path.join(output_dir, channel["label"]), ignore_errors=True)
+            # A channel skipped for its failed parent did not fail itself
+            if results.get(channel["label"]) == export_pool.PARENT_FAILED_EXIT:
+                continue
+            if export_state.record_failure(state, channel["label"]) == export_state.QUARANTINE_AFTER:
+                newly_quarantined.append(channel["label"])
+    state.close()
+
+    if not any(code == 0 for code in results.values()):
+        export_generations.discard(generation_dir)
+    else:
+        # List and checksum the exported files for the importer, with the
+        # packages and errata the import server has to end up with
+        export_manifest.write_content(generation_dir, client,
+                                      [label for label, code in results.items() if code == 0],
+                                      {channel["label"]: since for channel, _, since in selected},
+                                      exports_started)
+        export_manifest.write_manifest(generation_dir, parents, export_ready.ready_digests(generation_dir))
+        export_bundle.drop_bundled(generation_dir)
+
+        # Keep a single copy of packages exported into several channels
+        deduplicated, saved = export_dedup.dedup_tree(generation_dir)
+        report["dedup"] = {"files": deduplicated, "bytes_saved": saved}
+        export_log.write(logger, f"Deduplicated {deduplicated} package files, {saved // 1048576} MiB saved.")
+        export_manifest.mark_complete(generation_dir)
+
+        # Change ownership of the generation and publish it as current
+        subprocess.run(["chown", "-R", f"{RSYNC_USER}:{RSYNC_GROUP}", generation_dir], check=True)
+        published_dir = export_generations.publish(EXPORT_DIR, generation_dir)
+        # Serve the generation to every import target, see export_targets.py
+        for path in export_targets.fan_out(EXPORT_DIR, published_dir, targets):
+            subprocess.run(["chown", "-R", f"{RSYNC_USER}:{RSYNC_GROUP}", path], check=True)
+        # The importer acknowledges every imported generation, see export_generations.py
+        subprocess.run(["chown", f"{RSYNC_USER}:{RSYNC_GROUP}", export_generations.acks_dir(EXPORT_DIR)], check=True)
+        export_generations.prune(EXPORT_DIR)
+
+    run_report.write_report(report, client)
+    failed = [label for label, code in results.items() if code != 0]
+    print(f"Exported {len(results) - len(failed)} of {len(results)} channels.")
+    if failed:
+        print(f"Export failed for {len(failed)} of {len(results)} channels: {', '.join(failed)}")
+        export_log.print_summary(errors)
+    if newly_quarantined:
+        print(f"Quarantined after {export_state.QUARANTINE_AFTER} failed runs: {', '.join(newly_quarantined)}")
+    sys.exit(export_pool.exit_status(results))
+
+if __name__ == "__main__":
+    main()
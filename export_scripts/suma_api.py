@@ -0,0 +1,355 @@
+"""
+Description: Shared SUSE Manager XML-RPC API client used by the scripts.
+
+             SumaClient reads the credentials created by `mgr-sync -s refresh`,
+             logs in once and keeps the session key, logging in again when the
+             key gets close to SESSION_TTL or when the server reports the
+             session as expired. Connections use HTTP/1.1 keep-alive so one TLS
+             handshake serves many calls, and idle connections are kept in a
+             pool so concurrent callers each get their own connection without a
+             new login. Use the client as a context manager to log out cleanly.
+
+             API calls that have to be made once per channel are sent in
+             `system.multicall` batches of BATCH_SIZE calls, so a few hundred
+             vendor channels cost a handful of round trips instead of one each.
+             When the server does not support multicall the calls are spread
+             over WORKERS pooled connections running side by side instead.
+
+             The client counts the calls, requests, faults and response time of
+             every API method, api_stats() returns them for the run reports
+             (see run_report.py).
+
+             The channel hierarchy (child -> parent) is cached in
+             HIERARCHY_CACHE. A channel never changes its parent, so only
+             channels missing from the cache are looked up on later runs.
+
+             The server URL, the credentials file and the base directory of the
+             caches can be overridden with the SUMA_URL, SUMA_CONFIG and
+             SUMA_BASE_DIR environment variables, e.g. to run the scripts
+             against the mock server in bench/. Plain http:// URLs are
+             supported for that.
+
+             An identical copy of this file lives in both export_scripts and
+             import_scripts, keep them in sync.
+
+Constants:
+             CONFIG_PATH - mgr-sync credentials file.
+             SESSION_TTL - Seconds a session key is used before logging in again.
+             TIMEOUT - Socket timeout in seconds for API connections.
+             BATCH_SIZE - Number of calls sent in one multicall request.
+             WORKERS - Number of pooled connections used for concurrent calls.
+             CACHE_DIR - Directory holding the local API caches.
+"""
+
+import os
+import ssl
+import json
+import time
+import queue
+import socket
+import threading
+import configparser
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from xmlrpc.client import ServerProxy, Transport, SafeTransport, MultiCall, Fault
+
+CONFIG_PATH = os.environ.get("SUMA_CONFIG", "/root/.mgr-sync")
+SESSION_TTL = 3000  # SUMA expires idle sessions after an hour by default
+TIMEOUT = 300
+BATCH_SIZE = 100
+WORKERS = 8
+CACHE_DIR = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "cache")
+HIERARCHY_CACHE = os.path.join(CACHE_DIR, "channel_hierarchy.json")
+
+
+class KeepAliveMixin:
+    """Keeps the HTTP/1.1 connection of a transport open between calls."""
+
+    def __init__(self, *args, timeout=TIMEOUT, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+    def send_headers(self, connection, headers):
+        connection.putheader("Connection", "keep-alive")
+        super().send_headers(connection, headers)
+
+
+class KeepAliveTransport(KeepAliveMixin, SafeTransport):
+    """SafeTransport that keeps its HTTP/1.1 connection open between calls."""
+
+
+class KeepAliveHTTPTransport(KeepAliveMixin, Transport):
+    """Plain HTTP variant, only meant for a local mock server."""
+
+
+def manager_url():
+    if os.environ.get("SUMA_URL"):
+        return os.environ["SUMA_URL"]
+    suma_fqdn = socket.getfqdn()
+    return f"https://{suma_fqdn}/rpc/api"
+
+
+def new_proxy(url=None):
+    url = url or manager_url()
+    if url.startswith("http://"):
+        return ServerProxy(url, transport=KeepAliveHTTPTransport())
+    context = ssl.create_default_context()
+    return ServerProxy(url, transport=KeepAliveTransport(context=context))
+
+
+def read_credentials(config_path=CONFIG_PATH):
+    config = configparser.ConfigParser()
+    with open(config_path, 'r') as f:
+        config.read_string('[DEFAULT]\n' + f.read())
+    return config.get('DEFAULT', 'mgrsync.user'), config.get('DEFAULT', 'mgrsync.password')
+
+
+def resolve(target, method):
+    """Turn 'channel.software.getDetails' into the callable on target."""
+    return reduce(getattr, method.split("."), target)
+
+
+def session_expired(fault):
+    return "session" in fault.faultString.lower()
+
+
+class SumaClient:
+    """Logged in API session with a pool of keep-alive connections."""
+
+    def __init__(self, url=None, credentials=None, pool_size=WORKERS):
+        self.url = url or manager_url()
+        self.user, self.password = credentials or read_credentials()
+        self.multicall_supported = True
+        self._key = None
+        self._login_time = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = queue.LifoQueue()
+        self._login_proxy = None
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.logout()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool, at most pool_size are in use."""
+        with self._slots:
+            try:
+                proxy = self._idle.get_nowait()
+            except queue.Empty:
+                proxy = new_proxy(self.url)
+            try:
+                yield proxy
+            finally:
+                self._idle.put(proxy)
+
+    def login(self):
+        """Log in on a connection of its own, outside of the pool.
+
+        Callers of relogin() still hold their pooled connection, with all of
+        them waiting for a new key a pooled login would never get one. Only
+        called with _lock held, or before the client is shared.
+        """
+        if self._login_proxy is None:
+            self._login_proxy = new_proxy(self.url)
+        self._key = self._login_proxy.auth.login(self.user, self.password)
+        self._login_time = time.monotonic()
+        return self._key
+
+    @property
+    def key(self):
+        with self._lock:
+            if self._key is None or time.monotonic() - self._login_time > SESSION_TTL:
+                self.login()
+            return self._key
+
+    def relogin(self, stale_key):
+        with self._lock:
+            if self._key == stale_key:
+                self.login()
+            return self._key
+
+    def record(self, method, seconds, calls=1, faults=0):
+        """Account one request carrying calls calls of method."""
+        with self._stats_lock:
+            stats = self._stats.setdefault(method, {"calls": 0, "requests": 0, "faults": 0,
+                                                    "seconds": 0.0, "max_seconds": 0.0})
+            stats["calls"] += calls
+            stats["requests"] += 1
+            stats["faults"] += faults
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def api_stats(self):
+        """Return {method: {calls, requests, faults, seconds, max_seconds}}."""
+        with self._stats_lock:
+            return {method: {key: round(value, 3) if isinstance(value, float) else value
+                             for key, value in stats.items()}
+                    for method, stats in self._stats.items()}
+
+    def timed(self, proxy, method, key, *args):
+        started = time.monotonic()
+        try:
+            result = resolve(proxy, method)(key, *args)
+        except Fault:
+            self.record(method, time.monotonic() - started, faults=1)
+            raise
+        self.record(method, time.monotonic() - started)
+        return result
+
+    def call(self, method, *args):
+        """Call an API method, the session key is passed as first argument."""
+        key = self.key
+        with self.connection() as proxy:
+            try:
+                return self.timed(proxy, method, key, *args)
+            except Fault as e:
+                if not session_expired(e):
+                    raise
+                return self.timed(proxy, method, self.relogin(key), *args)
+
+    def logout(self):
+        if self._key is not None:
+            try:
+                with self.connection() as proxy:
+                    proxy.auth.logout(self._key)
+            except (Fault, OSError):
+                pass
+            self._key = None
+        while not self._idle.empty():
+            self._idle.get_nowait()("close")()
+        if self._login_proxy is not None:
+            self._login_proxy("close")()
+            self._login_proxy = None
+
+
+def connect(url=None):
+    """Return a logged in SumaClient, exits when the login is refused."""
+    client = SumaClient(url)
+    try:
+        client.login()
+    except Fault as e:
+        print(f"Error logging in: {e}")
+        exit(1)
+    return client
+
+
+def multicall(client, method, args_list):
+    key = client.key
+    with client.connection() as proxy:
+        calls = MultiCall(proxy)
+        for args in args_list:
+            resolve(calls, method)(key, *args)
+        started = time.monotonic()
+        try:
+            results = calls()
+        finally:
+            client.record(method, time.monotonic() - started, calls=len(args_list))
+        return results
+
+
+def fault_or_result(get):
+    try:
+        return get()
+    except Fault as e:
+        return e
+
+
+def threaded_call(client, method, args_list, faults=False):
+    def call(args):
+        if faults:
+            return fault_or_result(lambda: client.call(method, *args))
+        return client.call(method, *args)
+
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        return list(executor.map(call, args_list))
+
+
+def batch_call(client, method, args_list, faults=False):
+    """Call method once per entry of args_list, results are in the same order.
+
+    A fault of one call is raised, or with faults=True returned in place of
+    its result so the other calls can still be used.
+    """
+    args_list = [args if isinstance(args, (list, tuple)) else (args,) for args in args_list]
+    if not client.multicall_supported:
+        return threaded_call(client, method, args_list, faults)
+
+    results = []
+    for start in range(0, len(args_list), BATCH_SIZE):
+        batch = args_list[start:start + BATCH_SIZE]
+        try:
+            batch_results = multicall(client, method, batch)
+        except Fault:
+            # system.multicall itself was refused, faults of the individual
+            # calls are only raised below while reading the results.
+            client.multicall_supported = False
+            return results + threaded_call(client, method, args_list[start:], faults)
+        if faults:
+            results.extend(fault_or_result(lambda: batch_results[i]) for i in range(len(batch)))
+        else:
+            results.extend(batch_results)
+    return results
+
+
+def load_cache(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, data):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Warning: could not write cache {path}: {e}")
+
+
+def channel_parents(client, labels):
+    """Return {label: parent label or None} using the hierarchy cache."""
+    cache = load_cache(HIERARCHY_CACHE)
+    missing = [label for label in labels if label not in cache]
+    if missing:
+        details = batch_call(client, "channel.software.getDetails", missing)
+        for label, detail in zip(missing, details):
+            cache[label] = detail.get("parent_channel_label") or ""
+        save_cache(HIERARCHY_CACHE, cache)
+    return {label: cache[label] or None for label in labels}
+
+
+def channel_hierarchy(client, channels=None):
+    """Return the vendor channels as a parent -> [children] map."""
+    if channels is None:
+        channels = client.call("channel.listVendorChannels")
+    parents = channel_parents(client, [channel["label"] for channel in channels])
+    parent_child_map = {}
+    for channel in channels:
+        parent_label = parents[channel["label"]]
+        if parent_label:
+            parent_child_map.setdefault(parent_label, []).append(channel["label"])
+        else:
+            parent_child_map.setdefault(channel["label"], [])
+    return parent_child_map
+
+
+def last_build_dates(client, channels):
+    """Return the raw getChannelLastBuildById value for each channel."""
+    return batch_call(client, "channel.software.getChannelLastBuildById",
+                      [channel["id"] for channel in channels])
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Collects the inventory of a SUSE Manager server in one pass and
+             keeps it as a versioned JSON snapshot: the server version and, for
+             every vendor channel, its parent, last build date, package count
+             and a SHA-256 digest of its packages (name, version, release,
+             arch, checksum, see package_index.py). The build dates, the
+             hierarchy and the package lists are fetched side by side over
+             pooled connections, with multicall batches.
+
+             Listing the packages of every channel is by far the most
+             expensive part, it is only done for the queries that need the
+             packages: `snapshot`, `counts` and `diff`. The other queries
+             (last_update.py, last_updated.py, suma_info.py) only need the
+             version, hierarchy and build dates and collect a snapshot without
+             packages when the cache is stale.
+
+             The snapshot is cached in SNAPSHOT_PATH. Queries use the cached
+             snapshot while it is younger than SNAPSHOT_TTL seconds and only
+             collect a new one when it is stale, or when they need the packages
+             and the cached one has none. Copy the snapshot of the source
+             server next to the exports and `diff` compares it to the target
+             server without any API call.
+
+             An identical copy of this file lives in both export_scripts and
+             import_scripts, keep them in sync.
+
+Usage:
+             ./suma_inventory.py snapshot [--output FILE]
+                 Collect a new snapshot, also written to FILE when given.
+             ./suma_inventory.py builds | counts | info [--refresh]
+                 Print the last build date, package count or version and
+                 channels of every channel from the snapshot.
+             ./suma_inventory.py diff SOURCE [TARGET]
+                 Compare the SOURCE snapshot file to TARGET or to the snapshot
+                 of this server. Exits 1 when they differ.
+
+Constants:
+             SNAPSHOT_PATH - Cached snapshot of this server.
+             SNAPSHOT_TTL - Seconds a cached snapshot is used.
+             SNAPSHOT_SCHEMA - Version of the snapshot format.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import package_index
+import suma_api
+
+SNAPSHOT_PATH = os.path.join(suma_api.CACHE_DIR, "inventory.json")
+SNAPSHOT_TTL = 600
+SNAPSHOT_SCHEMA = 1
+
+
+def system_version(client):
+    """api.systemVersion, one of the few calls without a session key."""
+    with client.connection() as proxy:
+        return proxy.api.systemVersion()
+
+
+def package_summaries(client, labels):
+    """Return {label: (package count, digest)} of the given channels."""
+    summaries = {}
+    for label, keys in package_index.iter_channel_indexes(client, labels):
+        digest = hashlib.sha256(json.dumps(keys).encode()).hexdigest()
+        summaries[label] = (len(keys), digest)
+    return summaries
+
+
+def collect(client, packages=True):
+    """Collect a new snapshot of the server client is logged in to.
+
+    Without packages the package lists are not fetched, the snapshot has no
+    package count and digest per channel.
+    """
+    channel_list = client.call("channel.listVendorChannels")
+    labels = [channel["label"] for channel in channel_list]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        version = executor.submit(system_version, client)
+        build_dates = executor.submit(suma_api.last_build_dates, client, channel_list)
+        parents = executor.submit(suma_api.channel_parents, client, labels)
+        summaries = executor.submit(package_summaries, client, labels) if packages else None
+
+    channels = {}
+    for channel, last_build in zip(channel_list, build_dates.result()):
+        channels[channel["label"]] = {
+            "id": channel["id"],
+            "parent": parents.result()[channel["label"]],
+            "last_build": last_build,
+        }
+        if packages:
+            count, digest = summaries.result()[channel["label"]]
+            channels[channel["label"]].update(packages=count, digest=digest)
+    return {
+        "schema": SNAPSHOT_SCHEMA,
+        "host": socket.getfqdn(),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "timestamp": time.time(),
+        "version": version.result(),
+        "has_packages": packages,
+        "channels": channels,
+    }
+
+
+def has_packages(snapshot):
+    # Snapshots written before the packages became optional always had them
+    return snapshot.get("has_packages", True)
+
+
+def read_snapshot(path):
+    """Return the snapshot in path, raises ValueError for other schemas."""
+    with open(path, "r") as f:
+        snapshot = json.load(f)
+    if snapshot.get("schema") != SNAPSHOT_SCHEMA:
+        raise ValueError(f"{path} is not a version {SNAPSHOT_SCHEMA} inventory snapshot")
+    return snapshot
+
+
+def get_snapshot(refresh=False, ttl=SNAPSHOT_TTL, packages=False):
+    """Return the cached snapshot of this server, collecting one when stale.
+
+    With packages the snapshot has the package count and digest of every
+    channel, a cached snapshot without them is collected again.
+    """
+    if not refresh:
+        try:
+            snapshot = read_snapshot(SNAPSHOT_PATH)
+            if time.time() - snapshot["timestamp"] < ttl and (has_packages(snapshot) or not packages):
+                return snapshot
+        except (OSError, ValueError):
+            pass
+    with suma_api.connect() as client:
+        snapshot = collect(client, packages)
+    suma_api.save_cache(SNAPSHOT_PATH, snapshot)
+    return snapshot
+
+
+def diff(source, target):
+    """Return the differences of two snapshots as lines, empty when equal."""
+    lines = []
+    for snapshot in (source, target):
+        if not has_packages(snapshot):
+            raise ValueError(f"the snapshot of {snapshot['host']} has no package lists")
+    if source["version"] != target["version"]:
+        lines.append(f"version: {source['version']} on {source['host']}, {target['version']} on {target['host']}")
+    for label in sorted(set(source["channels"]) | set(target["channels"])):
+        if label not in target["channels"]:
+            lines.append(f"{label}: channel missing on {target['host']}")
+            continue
+        if label not in source["channels"]:
+            lines.append(f"{label}: channel not on {source['host']}")
+            continue
+        src, dst = source["channels"][label], target["channels"][label]
+        if src["packages"] != dst["packages"]:
+            lines.append(f"{label}: {src['packages']} packages on {source['host']}, {dst['packages']} on {target['host']}")
+        elif src["digest"] != dst["digest"]:
+            lines.append(f"{label}: same package count but different packages")
+        if src["last_build"] != dst["last_build"]:
+            lines.append(f"{label}: last build {src['last_build']} on {source['host']}, {dst['last_build']} on {target['host']}")
+    return lines
+
+
+def print_info(snapshot):
+    print("SUSE Manager Information\n")
+    print(f"SUSE Manager version: {snapshot['version']}\n")
+    print("List of Product Channels:")
+    print("\n".join(snapshot["channels"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cached inventory of a SUSE Manager server.")
+    parser.add_argument("--refresh", action="store_true", help="collect a new snapshot even if the cache is fresh")
+    commands = parser.add_subparsers(dest="command", required=True)
+    snapshot_parser = commands.add_parser("snapshot", help="collect a new snapshot")
+    snapshot_parser.add_argument("--output", metavar="FILE", help="also write the snapshot to FILE")
+    commands.add_parser("builds", help="last build date per channel")
+    commands.add_parser("counts", help="package count per channel")
+    commands.add_parser("info", help="server version and channels")
+    diff_parser = commands.add_parser("diff", help="compare two snapshots")
+    diff_parser.add_argument("source")
+    diff_parser.add_argument("target", nargs="?")
+    args = parser.parse_args()
+
+    if args.command == "diff":
+        try:
+            source = read_snapshot(args.source)
+            target = read_snapshot(args.target) if args.target else get_snapshot(args.refresh, packages=True)
+            lines = diff(source, target)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(2)
+        print("\n".join(lines) if lines else f"All {len(source['channels'])} channels match.")
+        sys.exit(1 if lines else 0)
+
+    snapshot = get_snapshot(refresh=args.refresh or args.command == "snapshot",
+                            packages=args.command in ("snapshot", "counts"))
+    if args.command == "snapshot":
+        if args.output:
+            suma_api.save_cache(os.path.abspath(args.output), snapshot)
+        print(f"Inventory of {len(snapshot['channels'])} channels collected.")
+    elif args.command == "builds":
+        for label, channel in snapshot["channels"].items():
+            print(channel["last_build"].split()[0] + " " + label)
+    elif args.command == "counts":
+        for label, channel in snapshot["channels"].items():
+            print(f"{str(channel['packages']).ljust(5)}\t{label}")
+    else:
+        print_info(snapshot)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Locally cached catalog of the vendor channels of a SUSE Manager
+             server: label, name, id, architecture, parent, package count and
+             the SUSE products a channel belongs to, indexed by label, parent,
+             architecture and product.
+
+             The catalog is kept in CATALOG_PATH and used as it is while it is
+             younger than CATALOG_TTL seconds. Refreshing it costs a single
+             `channel.listVendorChannels` call: the parents come from the
+             hierarchy cache of suma_api.py and `sync.content.listProducts` is
+             only called again when new channels showed up. Channels removed
+             from the server are dropped.
+
+             RULES_FILE limits the channels the scripts work on. Without it
+             every vendor channel is in scope, with it only the channels
+             matching an `include:` rule and none of the `exclude:` rules:
+
+               include:
+                 - sle-product-sles15-sp5-*
+                 - product:SUSE Linux Enterprise Server 15 SP5 *
+               exclude:
+                 - re:.*-debuginfo-(pool|updates)-.*
+                 - arch:aarch64
+
+             A rule matches the channel label, or with a `parent:`, `arch:` or
+             `product:` prefix the parent, architecture or product name of the
+             channel. The value is a glob, or with `re:` a regular expression
+             that has to match the whole value. The children of an included
+             channel are included with it, unless a rule excludes them.
+
+             last_update_export.py, initial_export.py and package_count.py only
+             look at the channels in scope, the others cost no API call and are
+             never exported.
+
+             An identical copy of this file lives in both export_scripts and
+             import_scripts, keep them in sync.
+
+Usage:
+             ./channel_catalog.py [--refresh] [--all] [RULE ...]
+             Lists the channels in scope of RULES_FILE, of the given include
+             RULEs instead, or every channel with --all.
+
+Constants:
+             CATALOG_PATH - Cached catalog of this server.
+             CATALOG_TTL - Seconds a cached catalog is used.
+             CATALOG_SCHEMA - Version of the catalog format.
+             RULES_FILE - Include and exclude rules, next to the scripts.
+"""
+
+import os
+import re
+import time
+import fnmatch
+import argparse
+from xmlrpc.client import Fault
+import suma_api
+
+CATALOG_PATH = os.path.join(suma_api.CACHE_DIR, "channel_catalog.json")
+CATALOG_TTL = 600
+CATALOG_SCHEMA = 1
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "channels.yaml")
+RULE_FIELDS = ("label", "parent", "arch", "product")
+
+
+def read_rules(path=RULES_FILE):
+    """Return {'include': [rules], 'exclude': [rules]}, both empty without path."""
+    rules = {"include": [], "exclude": []}
+    key = None
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                line = line.split("#", 1)[0].rstrip()
+                if not line.strip():
+                    continue
+                if not line.startswith((" ", "-")):
+                    key = line.split(":", 1)[0].strip()
+                elif line.strip().startswith("-") and key in rules:
+                    rules[key].append(line.strip()[1:].strip().strip("'\""))
+    except FileNotFoundError:
+        pass
+    return rules
+
+
+def product_names(products, names=None):
+    """Return {channel label: [product names]} of sync.content.listProducts."""
+    names = {} if names is None else names
+    for product in products:
+        channels = product.get("channels", []) + product.get("mandatory_channels", []) \
+            + product.get("optional_channels", [])
+        for channel in channels:
+            label = channel["label"] if isinstance(channel, dict) else channel
+            if product["friendly_name"] not in names.setdefault(label, []):
+                names[label].append(product["friendly_name"])
+        # Modules and extensions are listed below their base product
+        product_names(product.get("extensions", []), names)
+    return names
+
+
+def list_products(client):
+    try:
+        return product_names(client.call("sync.content.listProducts"))
+    except Fault as e:
+        # Servers without SCC access (ISS slaves) have no product list
+        print(f"Warning: could not list the products: {e}")
+        return {}
+
+
+def refresh(client, catalog=None):
+    """Return the catalog brought up to date with the server."""
+    known = catalog["channels"] if catalog else {}
+    channel_list = client.call("channel.listVendorChannels")
+    labels = [channel["label"] for channel in channel_list]
+    parents = suma_api.channel_parents(client, labels)
+    products = list_products(client) if any(label not in known for label in labels) else None
+
+    channels = {}
+    for channel in channel_list:
+        label = channel["label"]
+        if products is None:
+            channel_products = known[label]["products"]
+        else:
+            channel_products = products.get(label, [])
+        channels[label] = {
+            "id": channel["id"],
+            "label": label,
+            "name": channel.get("name", label),
+            "arch": channel.get("arch_name", ""),
+            "parent": parents[label],
+            "packages": channel.get("packages", 0),
+            "products": channel_products,
+        }
+    return {"schema": CATALOG_SCHEMA, "timestamp": time.time(), "channels": channels}
+
+
+def get_catalog(client, refresh_now=False, ttl=CATALOG_TTL):
+    """Return the ChannelCatalog of the server client is logged in to."""
+    catalog = suma_api.load_cache(CATALOG_PATH)
+    if catalog.get("schema") != CATALOG_SCHEMA:
+        catalog = None
+    if refresh_now or catalog is None or time.time() - catalog["timestamp"] >= ttl:
+        catalog = refresh(client, catalog)
+        suma_api.save_cache(CATALOG_PATH, catalog)
+    return ChannelCatalog(catalog["channels"])
+
+
+def split_rule(rule):
+    """Return (field, value) of 'arch:x86_64', the field defaults to the label."""
+    field, _, value = rule.partition(":")
+    if value and field in RULE_FIELDS:
+        return field, value
+    return "label", rule
+
+
+def value_matches(pattern, value):
+    if pattern.startswith("re:"):
+        return re.fullmatch(pattern[3:], value) is not None
+    return fnmatch.fnmatchcase(value, pattern)
+
+
+class ChannelCatalog:
+    """The vendor channels by label, parent, architecture and product."""
+
+    def __init__(self, channels):
+        self.by_label = channels
+        self.by_parent = {}
+        self.by_arch = {}
+        self.by_product = {}
+        for label, channel in channels.items():
+            if channel["parent"]:
+                self.by_parent.setdefault(channel["parent"], []).append(label)
+            self.by_arch.setdefault(channel["arch"], []).append(label)
+            for product in channel["products"]:
+                self.by_product.setdefault(product, []).append(label)
+
+    def __len__(self):
+        return len(self.by_label)
+
+    def matching(self, rule):
+        """Return the set of labels matching one rule, looked up in the index."""
+        field, pattern = split_rule(rule)
+        index = {"label": self.by_label, "parent": self.by_parent,
+                 "arch": self.by_arch, "product": self.by_product}[field]
+        if not pattern.startswith("re:") and not any(c in pattern for c in "*?["):
+            values = [pattern] if pattern in index else []
+        else:
+            values = [value for value in index if value_matches(pattern, value)]
+        labels = set()
+        for value in values:
+            labels.update([value] if field == "label" else index[value])
+        return labels
+
+    def select(self, rules):
+        """Return the labels in scope of rules (see read_rules), in catalog order."""
+        if rules["include"]:
+            included = set()
+            for rule in rules["include"]:
+                included |= self.matching(rule)
+            included |= {child for label in included for child in self.by_parent.get(label, [])}
+        else:
+            included = set(self.by_label)
+        for rule in rules["exclude"]:
+            included -= self.matching(rule)
+        return [label for label in self.by_label if label in included]
+
+    def vendor_channels(self, labels):
+        """Return the channels as listed by channel.listVendorChannels."""
+        return [{"id": self.by_label[label]["id"], "label": label, "name": self.by_label[label]["name"],
+                 "packages": self.by_label[label]["packages"]} for label in labels]
+
+    def parents(self, labels):
+        return {label: self.by_label[label]["parent"] for label in labels}
+
+    def hierarchy(self, labels):
+        """Return the channels as a parent -> [children] map, like suma_api.channel_hierarchy.
+
+        Children whose parent is not part of labels are left out, they can
+        not be imported without it.
+        """
+        parent_child_map = {label: [] for label in labels if not self.by_label[label]["parent"]}
+        for label in labels:
+            parent_label = self.by_label[label]["parent"]
+            if parent_label in parent_child_map:
+                parent_child_map[parent_label].append(label)
+        return parent_child_map
+
+
+def channels_in_scope(client, rules=None):
+    """Return (catalog, labels in scope of RULES_FILE or of rules)."""
+    catalog = get_catalog(client)
+    return catalog, catalog.select(read_rules() if rules is None else rules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cached catalog of the vendor channels.")
+    parser.add_argument("--refresh", action="store_true", help="refresh the catalog even if the cache is fresh")
+    parser.add_argument("--all", action="store_true", help="list every channel, ignoring the rules")
+    parser.add_argument("rules", nargs="*", metavar="RULE", help="include rules used instead of RULES_FILE")
+    args = parser.parse_args()
+
+    with suma_api.connect() as client:
+        catalog = get_catalog(client, refresh_now=args.refresh)
+    if args.all:
+        rules = {"include": [], "exclude": []}
+    elif args.rules:
+        rules = {"include": args.rules, "exclude": []}
+    else:
+        rules = read_rules()
+    labels = catalog.select(rules)
+    for label in labels:
+        channel = catalog.by_label[label]
+        print(f"{label}\t{channel['arch']}\t{channel['parent'] or '-'}\t{', '.join(channel['products'])}")
+    print(f"{len(labels)} of {len(catalog)} channels in scope.")
+
+
+if __name__ == "__main__":
+    main()
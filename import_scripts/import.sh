@@ -5,14 +5,48 @@
 #
 # Description: This script synchronizes files from a remote server using rsync,
 #              then processes the directories to perform specific import tasks.
+#              Every export run is a dated generation on the remote server,
+#              each generation not yet imported is transferred with
+#              --link-dest against the previous one, so files that did not
+#              change are not sent again, and imported in order. The imported
+#              generations are listed in $basedir/imported_generations and the
+#              last $keep_generations are kept.
+#
+#              Running exports (with a fresh heartbeat on the export server)
+#              are waited for (up to $wait_timeout seconds),
+#              each generation is verified against its signed manifest with
+#              import_manifest.py, only complete channels are imported, in
+#              parallel and parents first (import_scheduler.py), and every
+#              successful channel import is recorded, so a failed run resumes
+#              with the remaining channels. Every imported generation is
+#              acknowledged back to the export server, which keeps the
+#              generations not imported yet. A generation whose predecessor was
+#              never imported is refused, the packages of the missing one
+#              would be lost. The imported channels are then
+#              compared with the packages and errata listed by the exporter
+#              (verify_import.py), the script exits 1 when any channel differs.
 #              It reads configurations from a YAML file to retrieve host details
 #              and other necessary credentials.
 #
-# Usage: ./import_sync.sh
+#              Only one import runs at a time ($lock_file, shared with
+#              sync_orchestrator.py), a run started while another one is
+#              working exits right away.
+#
+# Usage: ./import_sync.sh [--no-wait]
+#        --no-wait imports the published generations without waiting for a
+#        running export and without the system update, used by
+#        sync_orchestrator.py which follows the export and may run it often.
+#        The inventory snapshot is only refreshed when a generation was
+#        imported.
 #
 # YAML Configuration Requirements:
 #   - host: The hostname or IP address of the remote server.
 #   - pass: The password for the XML-RPC user.
+#   - bwlimit: Optional transfer cap in KiB/s, 0 or missing for no limit.
+#   - target: Optional name of this server when the export server feeds
+#             several targets (export_targets.py), the generations are then
+#             read from its view /targets/<target> and every imported
+#             generation is acknowledged back to the export server.
 #
 # Example YAML Content:
 # ---
@@ -20,6 +54,8 @@
 # host: example.com
 # uname: org_name
 # pass: yourpassword
+# bwlimit: 20000
+# target: site-a
 #
 # Notes: Ensure the YAML file 'import.yaml' is located in the same
 #        directory as this script. Requires rsync, SSH access, and permissions
@@ -35,16 +71,29 @@ if [ ! -f "$yaml_file" ]; then
     exit 1
 fi
 host=$(awk '/^host:/ { print $2 }' "$yaml_file")
-uname=$(awk '/^uname:/ { print $2 }' "$yaml_file")
-pass=$(awk '/^pass:/ { print $2 }' "$yaml_file")
+bwlimit=$(awk '/^bwlimit:/ { print $2 }' "$yaml_file")
+target=$(awk '/^target:/ { print $2 }' "$yaml_file")
 basedir='/mnt/import'
+generations_dir="${basedir}/generations"
+imported_list="${basedir}/imported_generations"
+keep_generations=7
+keep_log_days=30
+wait_timeout=14400
+heartbeat_timeout=600
 log_dir="/mnt/logs"
+lock_file="${basedir}/.import.lock"
 log_file="${log_dir}/$(date +"%Y-%m-%d")-import.log"
+no_wait=0
+if [ "$1" = "--no-wait" ]; then
+  no_wait=1
+fi
 rsync_log="${log_dir}/$(date +"%Y-%m-%d")-rsync.log"
 
 if [ ! -d "$log_dir" ]; then
   mkdir -p "$log_dir"
 fi
+# Logs are kept for $keep_log_days days
+find "$log_dir" -maxdepth 1 -type f -name '*.log*' -mtime +"$keep_log_days" -delete
 
 log() {
     echo "$(date +"%Y-%m-%d %H:%M:%S") - $1" >> "$log_file"
@@ -57,37 +106,222 @@ update_system() {
   zypper -n update
 }
 
-# Clear source directory before rsync of new data.
-cleanup() {
-  log "Cleaning up directories."
-  rm -rf "$basedir"/updates/*
-  rm -rf "$basedir"/initial/*
-}
+mkdir -p "$basedir"
+exec 9> "$lock_file"
+if ! flock -n 9; then
+  log "Another import is running, exiting."
+  exit 0
+fi
 
-update_system
-cleanup
+if [ "$no_wait" -eq 0 ]; then
+  update_system
+fi
 
 # SSH Configuration variables.
 ssh_user='rsyncuser'
 ssh_key="id_rsa"
 ssh_options="-i /home/${ssh_user}/.ssh/${ssh_key}"
-rsync -avP -e "ssh ${ssh_options}" "${ssh_user}@${host}":/ "$basedir" >> "$rsync_log" 2>&1
+remote="${ssh_user}@${host}"
+# Generations served to this target only, see export_targets.py
+remote_root=""
+if [ -n "$target" ]; then
+  remote_root="/targets/${target}"
+fi
 
-process_directory() {
-  if [ -z "$(find "$1" -mindepth 1 -type d -print -quit)" ]; then
-    dir_name=$(basename "$1")
-    log "No imports at this time for $dir_name."
+# Generations are transferred with at most $bwlimit KiB/s and the rsync on
+# the export server reads them with a low CPU and I/O priority, so the
+# transfer does not slow down the export server.
+remote_rsync="ionice -c 2 -n 7 nice -n 10 rsync"
+throttle_options=(--bwlimit="${bwlimit:-0}" --rsync-path="$remote_rsync")
+
+mkdir -p "$generations_dir"
+touch "$imported_list"
+
+# The import scripts are shipped next to the generations.
+rsync -avP -e "ssh ${ssh_options}" "${remote}":/scripts "$basedir" >> "$rsync_log" 2>&1
+
+# Published generations on the export server, oldest first. Generations that
+# are still being written are hidden (.name) and not listed.
+remote_generations() {
+  rsync --list-only -e "ssh ${ssh_options}" "${remote}:${remote_root}/generations/" 2>> "$rsync_log" \
+    | awk '$1 ~ /^d/ && $NF !~ /^\./ { print $NF }' | sort
+}
+
+# Transfer one generation, files unchanged since the latest local generation
+# are hardlinked through --link-dest instead of being transferred again.
+transfer_generation() {
+  local gen=$1
+  local previous
+  previous=$(ls -1 "$generations_dir" | grep -vx "$gen" | sort | tail -n 1)
+  local link_dest=()
+  if [ -n "$previous" ]; then
+    link_dest=(--link-dest="$generations_dir/$previous")
+  fi
+  rsync -avPH "${link_dest[@]}" "${throttle_options[@]}" -e "ssh ${ssh_options}" \
+    "${remote}:${remote_root}/generations/${gen}/" "$generations_dir/$gen/" >> "$rsync_log" 2>&1
+}
+
+# Put deduplicated packages back in place from the content addressed pool,
+# see export_dedup.py. Entries are "<sha256>  <path relative to generation>".
+rehydrate() {
+  local gen_dir=$1
+  local manifest="$gen_dir/dedup.manifest"
+  if [ ! -f "$manifest" ]; then
     return
   fi
 
-  local options="--xmlRpcUser=$uname --xmlRpcPassword=$pass --logLevel=error"
-  for dir in "$1"/*; do
-    if [ -d "$dir" ]; then
-      inter-server-sync import --importDir="$dir" $options >> "$log_file" 2>&1
-      log "Import for directory $dir completed."
+  log "Restoring deduplicated packages."
+  local hash path
+  while read -r hash path; do
+    if [ ! -e "$gen_dir/$path" ]; then
+      mkdir -p "$(dirname "$gen_dir/$path")"
+      ln "$gen_dir/pool/${hash:0:2}/$hash" "$gen_dir/$path" || log "Pool file missing for $path."
+    fi
+  done < "$manifest"
+}
+
+# Unpack the channels the exporter bundled into compressed chunks, see
+# export_bundle.py. Channels that fail to unpack are left out by the
+# verification and retried on the next run.
+unbundle() {
+  local gen_dir=$1
+  if [ ! -d "$gen_dir/bundles" ]; then
+    return
+  fi
+
+  log "Unpacking bundled channels."
+  ./import_bundle.py "$gen_dir" >> "$log_file" 2>&1 || log "Some bundles of $(basename "$gen_dir") could not be unpacked."
+}
+
+# Import the verified channels of a generation that were not imported yet
+# with import_scheduler.py: parent channels before their children, independent
+# channels in parallel. Each successful import is recorded so a failed run
+# resumes where it stopped.
+import_generation() {
+  local gen_dir=$1
+  ./import_scheduler.py "$gen_dir" 2>> "$log_file"
+}
+
+# True while an export is running: it touches the heartbeat file of its
+# hidden generation (.<name>.running, see export_generations.py) every
+# minute. Hidden generations left behind by a crashed export have no fresh
+# heartbeat and are not waited for.
+export_running() {
+  local now perms size day time name
+  now=$(date +%s)
+  while read -r perms size day time name; do
+    if [[ $perms != d* && $name == .*.running ]] \
+        && (( now - $(date -d "${day//\//-} $time" +%s) < heartbeat_timeout )); then
+      return 0
+    fi
+  done < <(rsync --list-only -e "ssh ${ssh_options}" "${remote}":/generations/ 2>> "$rsync_log")
+  return 1
+}
+
+# Wait up to $wait_timeout seconds for exports that are still running, they
+# show up as hidden generations until their COMPLETE marker is written.
+wait_for_exports() {
+  local waited=0
+  while export_running; do
+    if [ "$waited" -ge "$wait_timeout" ]; then
+      log "Export still running after ${wait_timeout}s, importing the finished generations."
+      return
+    fi
+    log "Waiting for the running export to finish."
+    sleep 60
+    waited=$((waited + 60))
+  done
+}
+
+# Compare the channels imported from a generation with the packages and
+# errata they had on the export server, before the next generation changes them.
+verify_generation() {
+  local gen_dir=$1
+  if ! ./verify_import.py "$gen_dir" >> "$log_file" 2>&1; then
+    log "Channels of $(basename "$gen_dir") differ from the export, see verify_import.py above."
+    exit_status=1
+  fi
+}
+
+# Every generation only holds the changes since the previous one, importing
+# it after a generation that was never imported (removed on the export server
+# in the meantime) would silently leave those changes out. Re-export the
+# affected channels with initial_export.py, then add the missing generation
+# to $imported_list to go on.
+check_previous() {
+  local gen_dir=$1
+  local previous
+  previous=$(./import_manifest.py previous "$gen_dir" 2>/dev/null) || return 0
+  if [ -n "$previous" ] && [ -s "$imported_list" ] && ! grep -qx "$previous" "$imported_list"; then
+    log "Error: generation $previous before $(basename "$gen_dir") was never imported and is no longer on the export server, re-export its channels with initial_export.py and add it to $imported_list."
+    return 1
+  fi
+}
+
+# Tell the export server which channels of the generation were imported, it
+# keeps the generations not acknowledged yet (and records them in the ledger
+# of this target, see export_targets.py).
+acknowledge_generation() {
+  local gen=$1
+  rsync -e "ssh ${ssh_options}" "$generations_dir/$gen/.imported" \
+    "${remote}:${remote_root}/acks/${gen}" >> "$rsync_log" 2>&1 || log "Could not acknowledge generation $gen."
+}
+
+# Point current at the latest imported generation and keep only the last
+# $keep_generations imported ones, the latest is the next --link-dest.
+finish_generation() {
+  local gen=$1
+  echo "$gen" >> "$imported_list"
+  ln -sfn "generations/$gen" "$basedir/current.tmp"
+  mv -Tf "$basedir/current.tmp" "$basedir/current"
+
+  local old
+  for old in $(ls -1 "$generations_dir" | sort | head -n -"$keep_generations"); do
+    if grep -qx "$old" "$imported_list"; then
+      rm -rf "${generations_dir:?}/$old"
     fi
   done
 }
 
-process_directory "$basedir/updates"
-process_directory "$basedir/initial"
+if [ "$no_wait" -eq 0 ]; then
+  wait_for_exports
+fi
+
+exit_status=0
+imported=0
+
+for gen in $(remote_generations); do
+  if grep -qx "$gen" "$imported_list"; then
+    continue
+  fi
+
+  log "Transferring generation $gen."
+  if ! transfer_generation "$gen"; then
+    log "Transfer of generation $gen failed, stopping until the next run."
+    exit_status=1
+    break
+  fi
+
+  if ! check_previous "$generations_dir/$gen"; then
+    exit_status=1
+    break
+  fi
+
+  rehydrate "$generations_dir/$gen"
+  unbundle "$generations_dir/$gen"
+  if ! import_generation "$generations_dir/$gen"; then
+    log "Generation $gen is not fully imported, it is resumed on the next run."
+    exit_status=1
+    break
+  fi
+  verify_generation "$generations_dir/$gen"
+  finish_generation "$gen"
+  acknowledge_generation "$gen"
+  imported=1
+done
+
+# Refresh the inventory snapshot so queries right after the import see it
+if [ "$imported" -eq 1 ]; then
+  ./suma_inventory.py snapshot >> "$log_file" 2>&1
+fi
+exit "$exit_status"
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Unpacks the channel bundles of an export generation (see
+             export_bundle.py on the export server) back into the channel
+             directories `inter-server-sync import` reads.
+
+             The chunks of every bundle are checked against the SHA-256 listed
+             in its index.json while they are streamed, in order, through
+             `zstd -d | tar -x`, so a bundle is never written to disk in one
+             piece. Several bundles are unpacked at the same time. A channel is
+             unpacked into a hidden directory which is renamed once complete,
+             channels already unpacked are skipped, so the script can be run
+             again after a failure. The unpacked files are verified against
+             the generation manifest by import_manifest.py afterwards.
+
+             Works on any copy of a generation, e.g. one carried over on
+             removable media instead of rsync.
+
+Usage:
+             ./import_bundle.py GENERATION_DIR
+             Exits 1 when a bundle could not be unpacked.
+
+Constants:
+             UNPACK_WORKERS - Number of bundles unpacked at the same time.
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BUNDLE_DIR = "bundles"
+INDEX_NAME = "index.json"
+UNPACK_WORKERS = 4
+BLOCK_SIZE = 1024 * 1024
+
+
+def bundles(generation_dir):
+    """Return (kind, label) of every bundle in the generation."""
+    channels = []
+    root = os.path.join(generation_dir, BUNDLE_DIR)
+    for kind in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        for label in sorted(os.listdir(os.path.join(root, kind))):
+            if not label.startswith(".") and os.path.exists(os.path.join(root, kind, label, INDEX_NAME)):
+                channels.append((kind, label))
+    return channels
+
+
+def stream_chunks(bundle_dir, chunks, out):
+    """Write the chunks to out in order, raises ValueError on a bad chunk."""
+    for name, size, expected in chunks:
+        digest = hashlib.sha256()
+        written = 0
+        with open(os.path.join(bundle_dir, name), "rb") as f:
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                digest.update(block)
+                written += len(block)
+                out.write(block)
+        if written != size or digest.hexdigest() != expected:
+            raise ValueError(f"chunk {name} of {bundle_dir} is corrupt")
+
+
+def unpack(generation_dir, kind, label):
+    """Unpack one bundle, returns False when the channel was already unpacked."""
+    channel_dir = os.path.join(generation_dir, kind, label)
+    if os.path.isdir(channel_dir):
+        return False
+    bundle_dir = os.path.join(generation_dir, BUNDLE_DIR, kind, label)
+    with open(os.path.join(bundle_dir, INDEX_NAME), "r") as f:
+        index = json.load(f)
+
+    tmp_dir = os.path.join(generation_dir, kind, f".{label}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    zstd = subprocess.Popen(["zstd", "-q", "-d", "-c"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    tar = subprocess.Popen(["tar", "-xf", "-", "-C", tmp_dir], stdin=zstd.stdout)
+    zstd.stdout.close()
+    try:
+        stream_chunks(bundle_dir, index["chunks"], zstd.stdin)
+    except (OSError, ValueError):
+        zstd.kill()
+        tar.kill()
+        tar.wait()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    finally:
+        try:
+            zstd.stdin.close()
+        except BrokenPipeError:
+            pass
+        zstd.wait()
+        tar.wait()
+    if zstd.returncode != 0 or tar.returncode != 0:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise subprocess.CalledProcessError(zstd.returncode or tar.returncode, "zstd -d | tar -x")
+    os.rename(tmp_dir, channel_dir)
+    return True
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        exit(2)
+    generation_dir = sys.argv[1]
+
+    failed = 0
+    channels = bundles(generation_dir)
+    with ThreadPoolExecutor(max_workers=UNPACK_WORKERS) as executor:
+        futures = {executor.submit(unpack, generation_dir, kind, label): f"{kind}/{label}" for kind, label in channels}
+        for future, name in futures.items():
+            try:
+                if future.result():
+                    print(f"Unpacked {name}")
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                print(f"Error unpacking {name}: {e}", file=sys.stderr)
+                failed += 1
+    exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Verifies a transferred export generation against the manifest
+             written by the exporter (export_manifest.py) and keeps track of
+             the channels already imported from it, so a failed import run
+             resumes where it stopped instead of importing everything again.
+
+             A generation is only trusted when its COMPLETE marker matches the
+             manifest and, when KEY_FILE exists on this server, the manifest
+             signature is valid. The files of all channels are then checked
+             for size and SHA-256 in parallel, a channel is only handed to the
+             import when all of its files verified.
+
+Usage:
+             ./import_manifest.py verify GENERATION_DIR
+                 Prints the verified channels not yet imported, one
+                 '<kind>/<label>' per line. Exits 1 when the generation is
+                 incomplete or the signature does not match.
+             ./import_manifest.py done GENERATION_DIR CHANNEL
+                 Records CHANNEL ('<kind>/<label>') as imported.
+             ./import_manifest.py finished GENERATION_DIR
+                 Exits 0 when every channel of the generation was imported.
+             ./import_manifest.py previous GENERATION_DIR
+                 Prints the generation published before this one on the
+                 export server, empty for exports that do not name it.
+
+Constants:
+             KEY_FILE - Shared signing key, a copy of the key on the export server.
+             VERIFY_WORKERS - Number of files checked at the same time.
+             STATE_NAME - File in the generation listing the imported channels.
+"""
+
+import os
+import sys
+import hmac
+import json
+import hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+KEY_FILE = "/root/.disconnected_suma.key"
+MANIFEST_NAME = "manifest.json"
+SIGNATURE_NAME = "manifest.json.sig"
+COMPLETE_MARKER = "COMPLETE"
+STATE_NAME = ".imported"
+VERIFY_WORKERS = 8
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_text(path):
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def load_manifest(generation_dir):
+    """Return the manifest of a complete generation, raises ValueError otherwise."""
+    marker = os.path.join(generation_dir, COMPLETE_MARKER)
+    if not os.path.exists(marker):
+        raise ValueError(f"{generation_dir} has no {COMPLETE_MARKER} marker, the export is not finished")
+    with open(os.path.join(generation_dir, MANIFEST_NAME), "rb") as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != read_text(marker):
+        raise ValueError(f"{MANIFEST_NAME} of {generation_dir} does not match its {COMPLETE_MARKER} marker")
+    check_signature(data, os.path.join(generation_dir, SIGNATURE_NAME), f"{MANIFEST_NAME} of {generation_dir}")
+    return json.loads(data)
+
+
+def check_signature(data, signature_path, name):
+    """Raise ValueError unless data is signed, only checked when KEY_FILE exists."""
+    if not os.path.exists(KEY_FILE):
+        return
+    if not os.path.exists(signature_path):
+        raise ValueError(f"{name} is not signed")
+    with open(KEY_FILE, "rb") as f:
+        key = f.read().strip()
+    expected = hmac.new(key, data, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, read_text(signature_path)):
+        raise ValueError(f"{name} has an invalid signature")
+
+
+def channel_name(channel):
+    return f"{channel['kind']}/{channel['label']}"
+
+
+def check_inode(generation_dir, entries):
+    """Check the files sharing one inode, returns the paths that failed."""
+    path, size, digest = entries[0]
+    full_path = os.path.join(generation_dir, path)
+    try:
+        ok = os.path.getsize(full_path) == size and file_digest(full_path) == digest
+    except OSError:
+        ok = False
+    return [] if ok else [entry[0] for entry in entries]
+
+
+def verify_channels(generation_dir, channels):
+    """Return {channel name: [paths failing verification]}."""
+    by_inode = defaultdict(list)
+    failed = defaultdict(list)
+    owners = {}
+    for channel in channels:
+        for path, size, digest in channel["files"]:
+            owners[path] = channel_name(channel)
+            try:
+                st = os.stat(os.path.join(generation_dir, path))
+            except OSError:
+                failed[owners[path]].append(path)
+                continue
+            by_inode[(st.st_dev, st.st_ino, digest)].append((path, size, digest))
+
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        for paths in executor.map(lambda entries: check_inode(generation_dir, entries), by_inode.values()):
+            for path in paths:
+                failed[owners[path]].append(path)
+    return {channel_name(channel): failed.get(channel_name(channel), []) for channel in channels}
+
+
+def imported_channels(generation_dir):
+    try:
+        with open(os.path.join(generation_dir, STATE_NAME), "r") as f:
+            return {line.strip() for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def record_import(generation_dir, name):
+    with open(os.path.join(generation_dir, STATE_NAME), "a") as f:
+        f.write(name + "\n")
+
+
+def pending_channels(generation_dir, manifest):
+    """Verify the channels not yet imported, returns the names of the complete ones."""
+    done = imported_channels(generation_dir)
+    channels = [channel for channel in manifest["channels"] if channel_name(channel) not in done]
+    complete = []
+    for name, failed in verify_channels(generation_dir, channels).items():
+        if failed:
+            print(f"Incomplete channel {name}: {len(failed)} files failed verification", file=sys.stderr)
+        else:
+            complete.append(name)
+    return complete
+
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ("verify", "done", "finished", "previous") \
+            or (sys.argv[1] == "done" and len(sys.argv) < 4):
+        print(__doc__)
+        exit(2)
+    command, generation_dir = sys.argv[1], sys.argv[2]
+
+    if command == "done":
+        record_import(generation_dir, sys.argv[3])
+        return
+
+    try:
+        manifest = load_manifest(generation_dir)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        exit(1)
+
+    if command == "verify":
+        for name in pending_channels(generation_dir, manifest):
+            print(name)
+    elif command == "previous":
+        print(manifest.get("previous") or "")
+    else:
+        done = imported_channels(generation_dir)
+        exit(0 if all(channel_name(channel) in done for channel in manifest["channels"]) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Imports the channels of a transferred export generation with
+             `inter-server-sync import`, several at a time.
+
+             The channels come from the generation manifest (see
+             import_manifest.py), only verified channels that were not
+             imported yet are scheduled. The manifest records the parent of
+             every channel: the initial (parent) channels are imported first,
+             a channel only starts once its parent, when it is part of the
+             same generation, was imported, and the children of a parent that
+             failed its import or its verification are left for the next run. Independent channels run side
+             by side, up to MAX_WORKERS, largest first.
+
+             Every import writes to its own log file which is appended to the
+             daily import log when it completes, followed by a line with the
+             time it took and its exit code. The time, size and exit code of
+             every import are also written to a JSON and Prometheus run report
+             in /mnt/logs/reports, see run_report.py.
+
+Usage:
+             ./import_scheduler.py GENERATION_DIR
+             Exits 0 when every channel of the generation has been imported.
+
+Constants:
+             CONFIG_FILE - import.yaml holding the XML-RPC user and password.
+             LOG_DIR - Directory where logs are stored.
+             MAX_WORKERS - Number of imports running at the same time.
+             ISS_BIN - inter-server-sync command, SUMA_ISS_BIN in the
+                       environment overrides it.
+"""
+
+import os
+import sys
+import time
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import import_manifest
+import run_report
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import.yaml")
+LOG_DIR = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "logs")
+ISS_BIN = os.environ.get("SUMA_ISS_BIN", "inter-server-sync")
+MAX_WORKERS = 2
+
+
+def read_config(path):
+    """Read the flat 'key: value' lines of import.yaml."""
+    config = {}
+    with open(path, "r") as f:
+        for line in f:
+            key, sep, value = line.partition(":")
+            if sep and not line.startswith((" ", "#", "-")):
+                config[key.strip()] = value.strip()
+    return config
+
+
+def log(log_file_path, message):
+    with open(log_file_path, "a") as log_file:
+        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        log_file.write(f"{current_time} - {message}\n")
+
+
+def import_job(generation_dir, channel, config):
+    name = import_manifest.channel_name(channel)
+    command = [
+        ISS_BIN, "import",
+        f"--importDir={os.path.join(generation_dir, name)}",
+        f"--xmlRpcUser={config['uname']}",
+        f"--xmlRpcPassword={config['pass']}",
+        "--logLevel=error",
+    ]
+    return {
+        "name": name,
+        "label": channel["label"],
+        "parent": channel.get("parent"),
+        "initial": channel["kind"] == "initial",
+        "size": sum(size for _, size, _ in channel["files"]),
+        "command": command,
+    }
+
+
+def run_job(job, channel_log_dir):
+    channel_log = os.path.join(channel_log_dir, f"{job['label']}.log")
+    started = time.monotonic()
+    with open(channel_log, "w") as log_file:
+        result = subprocess.run(job["command"], stdout=log_file, stderr=subprocess.STDOUT)
+    return result.returncode, time.monotonic() - started, channel_log
+
+
+def blocked(job, jobs_by_label, results):
+    """True while the job has to wait for its parent or the initial channels."""
+    parent = jobs_by_label.get(job["parent"])
+    if parent is not None and parent["name"] not in results:
+        return True
+    if not job["initial"]:
+        return any(other["initial"] and other["name"] not in results for other in jobs_by_label.values())
+    return False
+
+
+def parent_failed(job, jobs_by_label, results):
+    parent = jobs_by_label.get(job["parent"])
+    return parent is not None and results.get(parent["name"], 0) != 0
+
+
+def record_result(generation_dir, job, result, log_file_path, report):
+    """Log and report a finished import, (returncode, seconds, channel log) from run_job()."""
+    returncode, elapsed, channel_log = result
+    run_report.add_channel(report, job["name"], returncode, elapsed, os.path.join(generation_dir, job["name"]))
+    with open(log_file_path, "a") as log_file, open(channel_log, "r", errors="replace") as channel_file:
+        for line in channel_file:
+            log_file.write(line)
+    os.remove(channel_log)
+    if returncode == 0:
+        import_manifest.record_import(generation_dir, job["name"])
+        log(log_file_path, f"Import for directory {job['name']} completed in {elapsed:.1f}s.")
+    else:
+        log(log_file_path, f"Import for directory {job['name']} failed in {elapsed:.1f}s with exit code {returncode}.")
+
+
+def schedule(generation_dir, jobs, log_file_path, report, max_workers=MAX_WORKERS, unverified=()):
+    """Run the import jobs in dependency order, returns {name: returncode}.
+
+    The jobs named in unverified failed verification, they are not run but
+    still hold back their children, which are skipped.
+    """
+    channel_log_dir = os.path.join(LOG_DIR, "channels")
+    os.makedirs(channel_log_dir, exist_ok=True)
+    jobs_by_label = {job["label"]: job for job in jobs}
+    waiting = sorted((job for job in jobs if job["name"] not in unverified), key=lambda job: job["size"], reverse=True)
+    results = {}
+    for job in jobs:
+        if job["name"] in unverified:
+            log(log_file_path, f"Import for directory {job['name']} skipped, it failed verification.")
+            results[job["name"]] = None
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while waiting or running:
+            for job in list(waiting):
+                if len(running) >= max_workers:
+                    break
+                if blocked(job, jobs_by_label, results):
+                    continue
+                waiting.remove(job)
+                if parent_failed(job, jobs_by_label, results):
+                    log(log_file_path, f"Import for directory {job['name']} skipped, parent channel {job['parent']} failed.")
+                    results[job["name"]] = None
+                    continue
+                running[executor.submit(run_job, job, channel_log_dir)] = job
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                result = future.result()
+                results[job["name"]] = result[0]
+                record_result(generation_dir, job, result, log_file_path, report)
+    return results
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(__doc__)
+        exit(2)
+    generation_dir = sys.argv[1]
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_file_path = os.path.join(LOG_DIR, f"{datetime.date.today()}-import.log")
+
+    try:
+        manifest = import_manifest.load_manifest(generation_dir)
+    except (OSError, ValueError) as e:
+        log(log_file_path, f"Generation {generation_dir} failed verification: {e}")
+        exit(1)
+
+    # The channels failing verification stay in the graph, their children wait for them
+    done = import_manifest.imported_channels(generation_dir)
+    channels = [channel for channel in manifest["channels"] if import_manifest.channel_name(channel) not in done]
+    pending = set(import_manifest.pending_channels(generation_dir, manifest))
+    unverified = {import_manifest.channel_name(channel) for channel in channels} - pending
+    if not pending:
+        log(log_file_path, f"No imports at this time for {os.path.basename(generation_dir)}.")
+
+    config = read_config(CONFIG_FILE)
+    report = run_report.new_report("import")
+    report["generation"] = os.path.basename(generation_dir)
+    jobs = [import_job(generation_dir, channel, config) for channel in channels]
+    schedule(generation_dir, jobs, log_file_path, report, unverified=unverified)
+    run_report.write_report(report)
+
+    done = import_manifest.imported_channels(generation_dir)
+    exit(0 if all(import_manifest.channel_name(channel) in done for channel in manifest["channels"]) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,9 @@ Script Description:
                     and retrieve the last build dates of all vendor channels managed by
                     the server. It outputs these dates along with the respective channel
                     labels. This is useful for administrators needing to track software
-                    channel updates.
+                    channel updates. The dates come from the inventory snapshot,
+                    which is collected again once it is older than its TTL, see
+                    suma_inventory.py.
 
 Usage:
                     Ensure the SUSE Manager login credentials are correctly set in the 
@@ -19,31 +21,10 @@ Ensure that this script has executable permissions:
 $ chmod +x last_update.py
 """
 
-import os
-import subprocess
-from xmlrpc.client import ServerProxy
-import ssl
-import socket
+import suma_inventory
 
-config_file_path = os.path.expanduser("/root/.mgr-sync")
-login_command = f"awk -F' = ' '$1==\"mgrsync.user\" {{print $2}}' {config_file_path}"
-password_command = f"awk -F' = ' '$1==\"mgrsync.password\" {{print $2}}' {config_file_path}"
+# Vendor channel build dates from the inventory snapshot, see suma_inventory.py
+snapshot = suma_inventory.get_snapshot()
 
-# Information needed to access and authenticate to SUSE Manager
-SUMA_FQDN = socket.getfqdn()
-MANAGER_LOGIN = subprocess.check_output(login_command, shell=True).decode().strip()
-MANAGER_PASSWORD = subprocess.check_output(password_command, shell=True).decode().strip()
-
-MANAGER_URL = "https://" + SUMA_FQDN + "/rpc/api"
-
-# Connect and log in to SUSE Manager using SSL
-context = ssl.create_default_context()
-client = ServerProxy(MANAGER_URL, context=context)
-key = client.auth.login(MANAGER_LOGIN, MANAGER_PASSWORD)
-
-# Collect vendor channel build date
-channel_list = client.channel.listVendorChannels(key)
-
-for channel in channel_list:
-    raw_date = client.channel.software.getChannelLastBuildById(key, channel["id"])
-    print(raw_date.split()[0] + " " + channel["label"])
+for label, channel in snapshot["channels"].items():
+    print(channel["last_build"].split()[0] + " " + label)
@@ -13,35 +13,85 @@ Description: The purpose of this script is to grab the number of packages per ch
 
 Usage:       Run this script directly with Python 3 interpreter on systems where SUMA client
              is configured. Ensure Python 3 and required libraries are installed.
+
+             ./package_count.py                        package count per channel, from the
+                                                       inventory snapshot (suma_inventory.py)
+             ./package_count.py --index FILE           write the package index of this server
+             ./package_count.py --compare SOURCE       compare SOURCE index to this server
+             ./package_count.py --compare SOURCE TARGET  compare two index files
+
+             The index holds (name, version, release, arch, checksum) per package, copy the
+             index of the source server across with the exports and compare it on the target
+             to list exactly which packages are missing or extra. Exits 1 when they differ.
+
+             Only the channels in scope of the rules in channels.yaml are counted and indexed,
+             see channel_catalog.py.
 """
 
-import os
-import configparser
-from xmlrpc.client import ServerProxy
-import ssl
-import socket
-
-def create_client():
-    config_path = os.path.expanduser('/root/.mgr-sync')
-    config = configparser.ConfigParser()
-    with open(config_path, 'r') as f:
-        config.read_string('[DEFAULT]\n' + f.read())
-    manager_login = config.get('DEFAULT', 'mgrsync.user')
-    manager_password = config.get('DEFAULT', 'mgrsync.password')
-    suma_fqdn = socket.getfqdn()
-    manager_url = f"https://{suma_fqdn}/rpc/api"
-    context = ssl.create_default_context()
-    client = ServerProxy(manager_url, context=context)
-    return client, client.auth.login(manager_login, manager_password)
-
-client, key = create_client()
-
-# Collect vendor channel build date
-if client and key:
-    channel_list = client.channel.listVendorChannels(key)
-    for channel in channel_list:
-        raw_packages = client.channel.software.listAllPackages(key, channel["label"])
-        pkg_count = len(raw_packages)
-        print(f"{str(pkg_count).ljust(5)}\t{channel['label']}")
-else:
-    print("Failed to authenticate with SUSE Manager.")
+import sys
+import argparse
+import channel_catalog
+import package_index
+import suma_api
+import suma_inventory
+
+def print_counts(snapshot, labels=None):
+    for label, channel in snapshot["channels"].items():
+        if labels is None or label in labels:
+            print(f"{str(channel['packages']).ljust(5)}\t{label}")
+
+def local_index(client, channel_list):
+    labels = [channel["label"] for channel in channel_list]
+    return {label: set(keys) for label, keys in package_index.iter_channel_indexes(client, labels)}
+
+def print_drift(source, target):
+    drift = package_index.compare(source, target)
+    for label, (missing, extra) in drift.items():
+        if label not in target:
+            print(f"{label}: channel missing on target")
+            continue
+        if label not in source:
+            print(f"{label}: channel not in source index")
+            continue
+        print(f"{label}: {len(missing)} missing, {len(extra)} extra")
+        for key in missing:
+            print(f"  missing  {package_index.package_name(key)}  {key[4]}")
+        for key in extra:
+            print(f"  extra    {package_index.package_name(key)}  {key[4]}")
+    if not drift:
+        print(f"All {len(source)} channels match.")
+    return 1 if drift else 0
+
+def main():
+    parser = argparse.ArgumentParser(description="SUSE Manager channel package counter")
+    parser.add_argument("--index", metavar="FILE", help="write the package index of this server to FILE")
+    parser.add_argument("--compare", nargs="+", metavar="INDEX", help="compare SOURCE index to this server, or to a TARGET index")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes a SOURCE and an optional TARGET index")
+    if args.compare and len(args.compare) == 2:
+        _, source = package_index.read_index(args.compare[0])
+        _, target = package_index.read_index(args.compare[1])
+        sys.exit(print_drift(source, target))
+    rules = channel_catalog.read_rules()
+    if not args.index and not args.compare:
+        labels = None
+        if rules["include"] or rules["exclude"]:
+            with suma_api.connect() as client:
+                labels = set(channel_catalog.channels_in_scope(client, rules)[1])
+        print_counts(suma_inventory.get_snapshot(packages=True), labels)
+        return
+
+    with suma_api.connect() as client:
+        catalog, labels = channel_catalog.channels_in_scope(client, rules)
+        channel_list = catalog.vendor_channels(labels)
+        if args.index:
+            count = package_index.write_index(args.index, client, [channel["label"] for channel in channel_list])
+            print(f"Wrote the package index of {count} channels to {args.index}")
+        else:
+            _, source = package_index.read_index(args.compare[0])
+            sys.exit(print_drift(source, local_index(client, channel_list)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Description: Compact per channel package index used to compare the packages of
+             two SUSE Manager servers.
+
+             Every package is reduced to (name, version, release, arch,
+             checksum). Channels are fetched INDEX_BATCH at a time and reduced
+             right away, so memory and API time stay bounded by the batch and
+             not by the whole server.
+
+             The index file is gzip compressed JSON lines, a header line with
+             the host and creation time followed by one line per channel. It is
+             small enough to be carried across the air gap next to the exports.
+
+             A content manifest (CONTENT_NAME) is an index whose channel lines
+             also list the advisory names of the channel errata. The exporter
+             writes one into every generation, verify_import.py compares the
+             channels imported from it with the import server. Channels are
+             fetched CONTENT_WORKERS batches at a time for it. The lists are
+             fetched once the exports finished, the packages and errata
+             modified after the exports started (reposync kept running) may
+             or may not be part of the export: they are listed apart as late
+             and neither required nor reported as extra on the import server.
+
+             An identical copy of this file lives in both export_scripts and
+             import_scripts, keep them in sync.
+
+Constants:
+             INDEX_BATCH - Number of channels fetched per batch.
+             CONTENT_NAME - Name of the content manifest in a generation.
+             CONTENT_WORKERS - Number of batches fetched at the same time.
+"""
+
+import os
+import gzip
+import json
+import socket
+import datetime
+from xmlrpc.client import Fault
+from concurrent.futures import ThreadPoolExecutor
+import suma_api
+
+INDEX_BATCH = 10
+CONTENT_NAME = "content.idx.gz"
+CONTENT_WORKERS = 4
+
+
+def package_key(package):
+    return (package["name"], package["version"], package["release"],
+            package.get("arch_label", ""), package.get("checksum", ""))
+
+
+def package_name(key):
+    name, version, release, arch, _ = key
+    return f"{name}-{version}-{release}.{arch}"
+
+
+def iter_channel_indexes(client, labels):
+    """Yield (label, sorted package keys) fetching INDEX_BATCH channels at a time."""
+    for start in range(0, len(labels), INDEX_BATCH):
+        batch = labels[start:start + INDEX_BATCH]
+        package_lists = suma_api.batch_call(client, "channel.software.listAllPackages", batch)
+        for label, packages in zip(batch, package_lists):
+            yield label, sorted({package_key(package) for package in packages})
+
+
+def erratum_name(erratum):
+    return erratum.get("advisory_name") or erratum.get("advisory", "")
+
+
+def modified_time(value):
+    """Return the datetime of an API date, None when it can not be read."""
+    if isinstance(value, datetime.datetime):
+        return value
+    text = str(value)  # xmlrpc.client.DateTime or a plain string
+    for date_format, length in (("%Y%m%dT%H:%M:%S", 17), ("%Y-%m-%d %H:%M:%S", 19)):
+        try:
+            return datetime.datetime.strptime(text[:length], date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def split_late(items, key, modified, started):
+    """Return (keys of the items modified before started, keys of the others)."""
+    keys, late = set(), set()
+    for item in items:
+        modified_at = modified_time(modified(item)) if started else None
+        (late if modified_at is not None and modified_at >= started else keys).add(key(item))
+    return keys, late
+
+
+def content_batch(client, labels, started=None):
+    """Return {label: (package keys, advisory names, late keys, late names) or the Fault of the channel}.
+
+    With started the packages and errata modified since are returned as late.
+    """
+    package_lists = suma_api.batch_call(client, "channel.software.listAllPackages", labels, faults=True)
+    errata_lists = suma_api.batch_call(client, "channel.software.listErrata", labels, faults=True)
+    contents = {}
+    for label, packages, errata in zip(labels, package_lists, errata_lists):
+        if isinstance(packages, Fault) or isinstance(errata, Fault):
+            contents[label] = packages if isinstance(packages, Fault) else errata
+            continue
+        package_keys, late_keys = split_late(packages, package_key, lambda package: package.get("last_modified"),
+                                             started)
+        names, late_names = split_late(errata, erratum_name, lambda erratum: erratum.get("last_modified_date")
+                                       or erratum.get("update_date") or erratum.get("date"), started)
+        contents[label] = (package_keys, names, late_keys, late_names)
+    return contents
+
+
+def channel_contents(client, labels, started=None):
+    """Return {label: content_batch() entry or Fault}, batches fetched side by side."""
+    batches = [labels[start:start + INDEX_BATCH] for start in range(0, len(labels), INDEX_BATCH)]
+    contents = {}
+    with ThreadPoolExecutor(max_workers=CONTENT_WORKERS) as executor:
+        for batch_contents in executor.map(lambda batch: content_batch(client, batch, started), batches):
+            contents.update(batch_contents)
+    return contents
+
+
+def write_content(path, client, labels, metadata_only=(), started=None):
+    """Write the content manifest of the given channels, returns the number of channels.
+
+    The channels of metadata_only were exported without their packages, they
+    are listed without any content and not compared after the import. The
+    packages and errata modified since started, the start of the exports, are
+    listed as late.
+    """
+    header = {"host": socket.getfqdn(), "created": datetime.datetime.now().isoformat(),
+              "started": started.isoformat() if started else None}
+    contents = channel_contents(client, [label for label in labels if label not in metadata_only], started)
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        f.write(json.dumps(header) + "\n")
+        for label in labels:
+            if label in metadata_only:
+                f.write(json.dumps({"label": label, "metadata_only": True}) + "\n")
+                continue
+            if isinstance(contents[label], Fault):
+                raise contents[label]
+            packages, errata, late_packages, late_errata = contents[label]
+            f.write(json.dumps({"label": label, "packages": sorted(packages), "errata": sorted(errata),
+                                "late_packages": sorted(late_packages), "late_errata": sorted(late_errata)}) + "\n")
+    os.replace(tmp_path, path)
+    return len(labels)
+
+
+def read_content(path):
+    """Return (header, {label: (package keys, advisory names, late keys, late names)}), all sets.
+
+    Channels exported without their packages map to None.
+    """
+    channels = {}
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        for line in f:
+            entry = json.loads(line)
+            if entry.get("metadata_only"):
+                channels[entry["label"]] = None
+                continue
+            channels[entry["label"]] = ({tuple(key) for key in entry["packages"]}, set(entry.get("errata", [])),
+                                        {tuple(key) for key in entry.get("late_packages", [])},
+                                        set(entry.get("late_errata", [])))
+    return header, channels
+
+
+def write_index(path, client, labels):
+    """Write the index of the given channels, returns the number of channels."""
+    header = {"host": socket.getfqdn(), "created": datetime.datetime.now().isoformat()}
+    count = 0
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt") as f:
+        f.write(json.dumps(header) + "\n")
+        for label, keys in iter_channel_indexes(client, labels):
+            f.write(json.dumps({"label": label, "packages": keys}) + "\n")
+            count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_index(path):
+    """Return (header, {label: set of package keys}) from an index file."""
+    channels = {}
+    with gzip.open(path, "rt") as f:
+        header = json.loads(f.readline())
+        for line in f:
+            entry = json.loads(line)
+            channels[entry["label"]] = {tuple(key) for key in entry["packages"]}
+    return header, channels
+
+
+def compare(source, target):
+    """Return {label: (missing on target, extra on target)} for differing channels."""
+    drift = {}
+    for label in sorted(set(source) | set(target)):
+        missing = source.get(label, set()) - target.get(label, set())
+        extra = target.get(label, set()) - source.get(label, set())
+        if missing or extra:
+            drift[label] = (sorted(missing), sorted(extra))
+    return drift
@@ -0,0 +1,187 @@
+"""
+Description: Machine readable report of an export or import run.
+
+             Every run collects, per channel, the wall time, the bytes and
+             package files of its directory, the exit code of the
+             `inter-server-sync` process and the throughput, plus the number
+             and latency of the API calls made through SumaClient. When the run
+             ends the report is written to REPORT_DIR twice:
+
+               <YYYYmmdd-HHMMSS>-<run>.json - one file per run, kept to follow
+                                              the performance over time.
+               <run>.prom                   - the latest run in the Prometheus
+                                              text format, point the
+                                              node_exporter textfile collector
+                                              at REPORT_DIR to scrape it.
+
+             An identical copy of this file lives in both export_scripts and
+             import_scripts, keep them in sync.
+
+Constants:
+             REPORT_DIR - Directory holding the run reports.
+             KEEP_REPORTS - Number of JSON reports kept per run name.
+             PACKAGE_SUFFIXES - File name endings counted as packages.
+"""
+
+import os
+import json
+import time
+import datetime
+import threading
+
+REPORT_DIR = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "logs", "reports")
+KEEP_REPORTS = 90
+PACKAGE_SUFFIXES = (".rpm", ".drpm", ".deb")
+METRIC_PREFIX = "disconnected_suma"
+
+_lock = threading.Lock()
+
+
+def new_report(run):
+    """Start the report of a run named run ('daily_export', 'import', ...)."""
+    return {
+        "run": run,
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "start_time": time.time(),
+        "channels": {},
+        "api": {},
+    }
+
+
+def dir_usage(path):
+    """Return (bytes, package files) below path, hardlinked files count once."""
+    seen = set()
+    size = packages = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            size += st.st_size
+            if name.endswith(PACKAGE_SUFFIXES):
+                packages += 1
+    return size, packages
+
+
+def add_channel(report, label, returncode, seconds, path=None, attempts=1):
+    """Record one channel export or import, path is the channel directory."""
+    size, packages = dir_usage(path) if path else (0, 0)
+    with _lock:
+        report["channels"][label] = {
+            "exit_code": returncode,
+            "seconds": round(seconds, 3),
+            "bytes": size,
+            "packages": packages,
+            "bytes_per_second": round(size / seconds) if seconds > 0 else 0,
+            "attempts": attempts,
+        }
+
+
+def finish(report, client=None):
+    """Close the report, client is the SumaClient whose API calls are included."""
+    report["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+    report["seconds"] = round(time.time() - report["start_time"], 3)
+    if client is not None:
+        report["api"] = client.api_stats()
+    channels = report["channels"].values()
+    report["failed"] = sum(1 for channel in channels if channel["exit_code"] != 0)
+    report["bytes"] = sum(channel["bytes"] for channel in channels)
+    return report
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_lines(report):
+    run = escape(report["run"])
+    lines = [
+        f"# HELP {METRIC_PREFIX}_run_seconds Wall time of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_seconds gauge",
+        f'{METRIC_PREFIX}_run_seconds{{run="{run}"}} {report["seconds"]}',
+        f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+        f'{METRIC_PREFIX}_run_timestamp_seconds{{run="{run}"}} {int(report["start_time"])}',
+        f"# HELP {METRIC_PREFIX}_run_failed_channels Channels that failed in the last run.",
+        f"# TYPE {METRIC_PREFIX}_run_failed_channels gauge",
+        f'{METRIC_PREFIX}_run_failed_channels{{run="{run}"}} {report["failed"]}',
+    ]
+    channel_metrics = (
+        ("seconds", "Wall time of the channel"),
+        ("bytes", "Bytes in the channel directory"),
+        ("packages", "Package files in the channel directory"),
+        ("bytes_per_second", "Throughput of the channel"),
+        ("exit_code", "Exit code of inter-server-sync for the channel"),
+        ("attempts", "Attempts needed for the channel"),
+    )
+    for key, description in channel_metrics:
+        lines.append(f"# HELP {METRIC_PREFIX}_channel_{key} {description}.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_channel_{key} gauge")
+        for label, channel in sorted(report["channels"].items()):
+            lines.append(f'{METRIC_PREFIX}_channel_{key}{{run="{run}",channel="{escape(label)}"}} {channel[key]}')
+    api_metrics = (
+        ("calls", "API calls made"),
+        ("requests", "HTTP requests made, a multicall batch is one request"),
+        ("faults", "API calls that returned a fault"),
+        ("seconds", "Time spent waiting for API responses"),
+        ("max_seconds", "Slowest API request"),
+    )
+    for key, description in api_metrics:
+        lines.append(f"# HELP {METRIC_PREFIX}_api_{key} {description}.")
+        lines.append(f"# TYPE {METRIC_PREFIX}_api_{key} gauge")
+        for method, stats in sorted(report["api"].items()):
+            lines.append(f'{METRIC_PREFIX}_api_{key}{{run="{run}",method="{escape(method)}"}} {stats[key]}')
+    return lines
+
+
+def write_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def prune_reports(run, report_dir, keep=KEEP_REPORTS):
+    suffix = f"-{run}.json"
+    reports = sorted(name for name in os.listdir(report_dir) if name.endswith(suffix))
+    for name in reports[:max(len(reports) - keep, 0)]:
+        os.remove(os.path.join(report_dir, name))
+
+
+def write_report(report, client=None, report_dir=None):
+    """Finish the report and write its JSON and Prometheus files, returns the JSON path."""
+    report_dir = report_dir or REPORT_DIR
+    finish(report, client)
+    try:
+        os.makedirs(report_dir, exist_ok=True)
+        stamp = datetime.datetime.fromtimestamp(report["start_time"]).strftime("%Y%m%d-%H%M%S")
+        json_path = os.path.join(report_dir, f"{stamp}-{report['run']}.json")
+        write_atomic(json_path, json.dumps(report, indent=1, sort_keys=True) + "\n")
+        write_atomic(os.path.join(report_dir, f"{report['run']}.prom"), "\n".join(prometheus_lines(report)) + "\n")
+        prune_reports(report["run"], report_dir)
+    except OSError as e:
+        print(f"Warning: could not write run report: {e}")
+        return None
+    return json_path
+
+
+def load_reports(run, report_dir=None):
+    """Return the JSON reports of run, oldest first."""
+    report_dir = report_dir or REPORT_DIR
+    suffix = f"-{run}.json"
+    try:
+        names = sorted(name for name in os.listdir(report_dir) if name.endswith(suffix))
+    except OSError:
+        return []
+    reports = []
+    for name in names:
+        try:
+            with open(os.path.join(report_dir, name), "r") as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return reports
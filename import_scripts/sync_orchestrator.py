@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Long running replacement of the cron driven import: instead of
+             starting import.sh at a fixed offset after the export, it follows
+             the export server and imports every channel as soon as its export
+             finished, so transfer and import of the first channels overlap with
+             the export of the others.
+
+             Every POLL_INTERVAL seconds the generations of the export server
+             are listed. While an export is running (a hidden `.<name>`
+             generation newer than every published one, with a fresh heartbeat
+             file), the ready markers of
+             its finished channels (see export_ready.py) are fetched, checked
+             against their signature and each new channel goes through its own
+             pipeline:
+
+               transfer - rsync of the channel directory, --link-dest against
+                          the previous local generation, TRANSFER_WORKERS at
+                          a time.
+               verify   - size and SHA-256 of every file against the marker.
+               import   - `inter-server-sync import`, parents before their
+                          children, import_scheduler.MAX_WORKERS at a time.
+
+             Imported channels are recorded in the generation like import.sh
+             does. Once the generation is published, import.sh --no-wait runs
+             as usual: it transfers the rest, verifies the whole generation
+             against its signed manifest and only imports the channels the
+             pipeline did not. Published generations that were not imported
+             yet are always handed to import.sh first. When import.sh fails or
+             leaves a generation unimported it is only run again after
+             IMPORT_RETRY_DELAY seconds, doubled after every further failure
+             up to IMPORT_RETRY_MAX, instead of on every poll.
+
+             The export server is polled over ssh, inotify can not watch a
+             remote directory. Both this script and import.sh take LOCK_FILE,
+             a cron started import.sh simply skips its run while the
+             orchestrator is working and the other way around.
+
+             With `target:` in import.yaml the generations come from the view
+             of this target (see export_targets.py on the export server), which
+             is only written once the export finished. The orchestrator then
+             runs import.sh as soon as a new view is published.
+
+Usage:
+             ./sync_orchestrator.py [--once]
+             Runs until stopped, --once does a single pass (for a timer).
+             Example systemd unit:
+
+               [Service]
+               WorkingDirectory=/mnt/import/scripts
+               ExecStart=/mnt/import/scripts/sync_orchestrator.py
+               Restart=always
+
+Constants:
+             IMPORT_DIR - Local directory of the transferred generations.
+             POLL_INTERVAL - Seconds between two looks at the export server.
+             TRANSFER_WORKERS - Channels transferred at the same time.
+             SSH_USER - User of the export server, as in import.sh.
+             SSH_KEY - Private key of SSH_USER.
+             REMOTE_RSYNC - rsync command on the export server, with a low
+                            CPU and I/O priority. The transfers are capped at
+                            `bwlimit` KiB/s of import.yaml, as in import.sh.
+             LOCK_FILE - Lock shared with import.sh.
+             HEARTBEAT_TIMEOUT - Seconds after which the heartbeat of an export
+                                 is stale, its hidden generation is ignored.
+             IMPORT_RETRY_DELAY - Seconds before import.sh runs again after a
+                                  failed run.
+             IMPORT_RETRY_MAX - Longest delay between two failed runs.
+"""
+
+import os
+import json
+import time
+import fcntl
+import argparse
+import datetime
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import import_manifest
+import import_scheduler
+import run_report
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_DIR = os.path.join(os.environ.get("SUMA_BASE_DIR", "/mnt"), "import")
+GENERATIONS_DIR = os.path.join(IMPORT_DIR, "generations")
+IMPORTED_LIST = os.path.join(IMPORT_DIR, "imported_generations")
+LOCK_FILE = os.path.join(IMPORT_DIR, ".import.lock")
+READY_DIR = "ready"
+POLL_INTERVAL = 60
+TRANSFER_WORKERS = 2
+SSH_USER = "rsyncuser"
+SSH_KEY = f"/home/{SSH_USER}/.ssh/id_rsa"
+REMOTE_RSYNC = "ionice -c 2 -n 7 nice -n 10 rsync"
+RUNNING_SUFFIX = ".running"
+HEARTBEAT_TIMEOUT = 600
+IMPORT_RETRY_DELAY = 300
+IMPORT_RETRY_MAX = 3600
+
+
+def log_file_path():
+    return os.path.join(import_scheduler.LOG_DIR, f"{datetime.date.today()}-import.log")
+
+
+def log(message):
+    import_scheduler.log(log_file_path(), message)
+
+
+def rsync(*args):
+    """Run rsync over ssh, raises OSError when it fails."""
+    result = subprocess.run(["rsync", "-e", f"ssh -i {SSH_KEY}", *args],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise OSError(f"rsync exited with {result.returncode}: {result.stderr.strip()}")
+    return result.stdout
+
+
+def remote_root(config):
+    """Directory of the generations served to this server on the export server."""
+    return f"/targets/{config['target']}" if config.get("target") else ""
+
+
+def remote_generations(remote, root=""):
+    """Return the generation directories of the export server.
+
+    Hidden generations are only listed while their export is running, i.e.
+    touches its heartbeat file (see export_generations.py).
+    """
+    names, heartbeats = [], set()
+    for line in rsync("--list-only", f"{remote}:{root}/generations/").splitlines():
+        fields = line.split()
+        if len(fields) < 5:
+            continue
+        if line.startswith("d"):
+            names.append(fields[-1])
+        elif fields[-1].endswith(RUNNING_SUFFIX):
+            touched = datetime.datetime.strptime(f"{fields[2]} {fields[3]}", "%Y/%m/%d %H:%M:%S")
+            if (datetime.datetime.now() - touched).total_seconds() < HEARTBEAT_TIMEOUT:
+                heartbeats.add(fields[-1][:-len(RUNNING_SUFFIX)])
+    return sorted(name for name in names if name.lstrip(".")[:1].isdigit()
+                  and (not name.startswith(".") or name in heartbeats))
+
+
+def imported_generations():
+    try:
+        with open(IMPORTED_LIST, "r") as f:
+            return {line.strip() for line in f if line.strip()}
+    except OSError:
+        return set()
+
+
+def running_generation(generations, imported):
+    """Return the hidden generation to follow, None while import.sh has work to do."""
+    published = [name for name in generations if not name.startswith(".")]
+    if any(name not in imported for name in published):
+        return None
+    running = [name for name in generations if name.startswith(".")]
+    if running and (not published or running[-1][1:] > published[-1]):
+        return running[-1]
+    return None
+
+
+class Pipeline:
+    """Transfer, verify and import the ready channels of one running generation."""
+
+    def __init__(self, remote, hidden_name, config):
+        self.name = hidden_name[1:]
+        self.remote_dir = f"{remote}:/generations/{hidden_name}"
+        self.generation_dir = os.path.join(GENERATIONS_DIR, self.name)
+        previous = [name for name in sorted(os.listdir(GENERATIONS_DIR)) if name != self.name]
+        self.previous_dir = os.path.join(GENERATIONS_DIR, previous[-1]) if previous else None
+        self.config = config
+        self.channels = {}
+        self.status = {name: "imported" for name in import_manifest.imported_channels(self.generation_dir)}
+        self.running = {}
+        self.transfers = ThreadPoolExecutor(max_workers=TRANSFER_WORKERS)
+        self.imports = ThreadPoolExecutor(max_workers=import_scheduler.MAX_WORKERS)
+        self.channel_log_dir = os.path.join(import_scheduler.LOG_DIR, "channels")
+        self.report = run_report.new_report("pipeline_import")
+        self.report["generation"] = self.name
+        os.makedirs(self.channel_log_dir, exist_ok=True)
+
+    def poll(self):
+        """Fetch the ready markers and start the transfer of the new channels."""
+        ready_dir = os.path.join(self.generation_dir, READY_DIR)
+        os.makedirs(ready_dir, exist_ok=True)
+        try:
+            rsync("-a", f"{self.remote_dir}/{READY_DIR}/", f"{ready_dir}/")
+        except OSError:
+            # No channel is finished yet, or the export was published in between
+            return
+        for kind in sorted(os.listdir(ready_dir)):
+            for marker in sorted(os.listdir(os.path.join(ready_dir, kind))):
+                if not marker.endswith(".json"):
+                    continue
+                path = os.path.join(ready_dir, kind, marker)
+                name = f"{kind}/{marker[:-len('.json')]}"
+                if name in self.channels:
+                    continue
+                try:
+                    with open(path, "rb") as f:
+                        data = f.read()
+                    import_manifest.check_signature(data, f"{path}.sig", f"Ready marker {name}")
+                    channel = json.loads(data)
+                except (OSError, ValueError) as e:
+                    log(f"Ignoring ready marker {name} of {self.name}: {e}")
+                    continue
+                self.channels[name] = channel
+                if self.status.get(name) != "imported":
+                    self.status[name] = "transferring"
+                    self.running[self.transfers.submit(self.transfer, channel)] = ("transfer", name)
+
+    def transfer(self, channel):
+        """Transfer and verify one channel, returns the paths failing verification."""
+        name = import_manifest.channel_name(channel)
+        link_dest = [f"--link-dest={os.path.join(self.previous_dir, name)}"] if self.previous_dir else []
+        target_dir = os.path.join(self.generation_dir, name)
+        os.makedirs(target_dir, exist_ok=True)
+        rsync("-aH", *link_dest, f"--bwlimit={self.config.get('bwlimit') or 0}", f"--rsync-path={REMOTE_RSYNC}",
+              f"{self.remote_dir}/{name}/", f"{target_dir}/")
+        return import_manifest.verify_channels(self.generation_dir, [channel])[name]
+
+    def parent_status(self, channel):
+        """Return the status of the parent of channel, None while it has to be waited for.
+
+        A parent that is not exported by the same run is already on this
+        server. One that is gets its own marker, until it was fetched (or
+        when it could not be written) the channel waits, import.sh imports
+        it after its parent once the generation is published.
+        """
+        if not channel.get("parent") or not channel.get("parent_in_run", True):
+            return "imported"
+        parents = [name for name in self.status if name.split("/", 1)[1] == channel["parent"]]
+        return self.status[parents[0]] if parents else None
+
+    def start_imports(self):
+        for name, status in sorted(self.status.items()):
+            if status != "transferred":
+                continue
+            channel = self.channels[name]
+            parent_status = self.parent_status(channel)
+            if parent_status in ("failed", "skipped"):
+                log(f"Import for directory {name} skipped, parent channel {channel['parent']} failed.")
+                self.status[name] = "skipped"
+            elif parent_status == "imported":
+                job = import_scheduler.import_job(self.generation_dir, channel, self.config)
+                self.status[name] = "importing"
+                self.running[self.imports.submit(import_scheduler.run_job, job, self.channel_log_dir)] = ("import", job)
+
+    def step(self, timeout):
+        """Wait up to timeout seconds for a stage to finish and move its channel on."""
+        self.start_imports()
+        if not self.running:
+            time.sleep(timeout)
+            return
+        done, _ = wait(self.running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            stage, item = self.running.pop(future)
+            if stage == "import":
+                result = future.result()
+                import_scheduler.record_result(self.generation_dir, item, result, log_file_path(), self.report)
+                self.status[item["name"]] = "imported" if result[0] == 0 else "failed"
+                continue
+            try:
+                failed = future.result()
+            except OSError as e:
+                log(f"Transfer of {item} failed: {e}")
+                self.status[item] = "failed"
+                continue
+            if failed:
+                log(f"Incomplete channel {item}: {len(failed)} files failed verification")
+                self.status[item] = "failed"
+            else:
+                self.status[item] = "transferred"
+        self.start_imports()
+
+    def busy(self):
+        return bool(self.running)
+
+    def close(self):
+        """Let the running stages finish, channels left over are imported by import.sh."""
+        while self.running:
+            self.step(POLL_INTERVAL)
+        self.transfers.shutdown()
+        self.imports.shutdown()
+        if self.report["channels"]:
+            run_report.write_report(self.report)
+
+
+def run_import_sh():
+    log("Handing the published generations to import.sh.")
+    return subprocess.run([os.path.join(SCRIPT_DIR, "import.sh"), "--no-wait"], cwd=SCRIPT_DIR).returncode
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import channels as soon as the export server finished them.")
+    parser.add_argument("--once", action="store_true", help="do a single pass and exit")
+    args = parser.parse_args()
+
+    config = import_scheduler.read_config(import_scheduler.CONFIG_FILE)
+    remote = f"{SSH_USER}@{config['host']}"
+    os.makedirs(GENERATIONS_DIR, exist_ok=True)
+    os.makedirs(import_scheduler.LOG_DIR, exist_ok=True)
+    pipeline = None
+    lock = open(LOCK_FILE, "w")
+    failures = 0
+    retry_at = 0
+
+    while True:
+        try:
+            generations = remote_generations(remote, remote_root(config))
+        except OSError as e:
+            log(f"Could not list the generations of {config['host']}: {e}")
+            generations = None
+
+        if generations is not None:
+            target = running_generation(generations, imported_generations())
+            if pipeline is not None and (target is None or target[1:] != pipeline.name):
+                # The generation was published (or discarded), finish what is running
+                pipeline.close()
+                pipeline = None
+                fcntl.flock(lock, fcntl.LOCK_UN)
+            pending = [name for name in generations
+                       if not name.startswith(".") and name not in imported_generations()]
+            if target is None and pending:
+                if time.monotonic() >= retry_at:
+                    if run_import_sh() == 0 and not set(pending) - imported_generations():
+                        failures = 0
+                    else:
+                        failures += 1
+                        delay = min(IMPORT_RETRY_DELAY * 2 ** (failures - 1), IMPORT_RETRY_MAX)
+                        retry_at = time.monotonic() + delay
+                        log(f"import.sh did not import every published generation, running it again in {delay}s.")
+            elif target is not None and pipeline is None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    pipeline = Pipeline(remote, target, config)
+                except BlockingIOError:
+                    log("import.sh is running, following the export on the next poll.")
+            if pipeline is not None:
+                pipeline.poll()
+
+        if args.once:
+            if pipeline is not None:
+                pipeline.close()
+            break
+        # Advance the pipeline while waiting for the next poll
+        deadline = time.monotonic() + POLL_INTERVAL
+        while time.monotonic() < deadline:
+            if pipeline is None or not pipeline.busy():
+                time.sleep(max(deadline - time.monotonic(), 0))
+                break
+            pipeline.step(max(deadline - time.monotonic(), 0))
+
+
+if __name__ == "__main__":
+    main()
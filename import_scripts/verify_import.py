@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""
+Description:
+             Checks after an import that the channels imported from a
+             generation hold the same packages and errata as on the export
+             server when they were exported.
+
+             Every generation carries a content manifest written by the
+             exporter (package_index.CONTENT_NAME): per exported channel the
+             (name, version, release, arch, checksum) of its packages and the
+             advisory names of its errata. Packages and errata modified while
+             the export ran may or may not be part of it, they are not
+             compared. Channels exported without their packages (the parents
+             of initial_export.py, exported with a packagesOnlyAfter date in
+             the future) are only listed and not compared. The manifest is only trusted when the generation
+             verifies (see import_manifest.py) and its size and SHA-256 match
+             the entry in the signed generation manifest.
+
+             The packages and errata of the imported channels are fetched from
+             this server in multicall batches, several batches side by side
+             (package_index.channel_contents), and compared to the manifest.
+             The drift of every channel is printed, missing and extra packages
+             and errata, the script exits 1 when any channel differs and 0 when
+             all match or the generation has no content manifest (exports made
+             before it was introduced).
+
+             import.sh runs it right after each generation is imported, before
+             the next one changes the channels again.
+
+Usage:
+             ./verify_import.py GENERATION_DIR [--all]
+             Only the channels recorded as imported from GENERATION_DIR are
+             checked, --all checks every channel of the content manifest.
+
+Constants:
+             SHOW_PACKAGES - Number of differing packages or errata listed per
+                             channel, the others are only counted.
+"""
+
+import os
+import sys
+import argparse
+from xmlrpc.client import Fault
+import import_manifest
+import package_index
+import suma_api
+
+SHOW_PACKAGES = 20
+
+
+def read_verified_content(generation_dir):
+    """Return the content of a verified generation, None without a content manifest.
+
+    Raises ValueError when the generation or its content manifest do not verify.
+    """
+    manifest = import_manifest.load_manifest(generation_dir)
+    if not manifest.get("content"):
+        return None
+    name, size, digest = manifest["content"]
+    path = os.path.join(generation_dir, name)
+    if not os.path.exists(path) or os.path.getsize(path) != size or import_manifest.file_digest(path) != digest:
+        raise ValueError(f"{name} of {generation_dir} does not match its manifest")
+    _, content = package_index.read_content(path)
+    return content
+
+
+def channel_drift(expected, actual):
+    """Return (missing packages, extra packages, missing errata, extra errata).
+
+    The late packages and errata of expected, modified while the export ran,
+    are neither missing nor extra.
+    """
+    packages, errata, late_packages, late_errata = expected
+    target_packages, target_errata = actual[:2]
+    return (sorted(packages - target_packages), sorted(target_packages - packages - late_packages),
+            sorted(errata - target_errata), sorted(target_errata - errata - late_errata))
+
+
+def format_package(key):
+    return f"{package_index.package_name(key)}  {key[4]}"
+
+
+def print_items(kind, items, format_item):
+    for item in items[:SHOW_PACKAGES]:
+        print(f"  {kind}  {format_item(item)}")
+    if len(items) > SHOW_PACKAGES:
+        print(f"  ... {len(items) - SHOW_PACKAGES} more")
+
+
+def verify(content, labels, client):
+    """Compare labels of content with this server, returns the number of drifting channels."""
+    actual = package_index.channel_contents(client, labels)
+    drifting = 0
+    for label in labels:
+        if isinstance(actual[label], Fault):
+            print(f"{label}: channel missing on this server ({actual[label].faultString})")
+            drifting += 1
+            continue
+        missing, extra, missing_errata, extra_errata = channel_drift(content[label], actual[label])
+        if not (missing or extra or missing_errata or extra_errata):
+            continue
+        drifting += 1
+        print(f"{label}: {len(missing)} packages missing, {len(extra)} extra, "
+              f"{len(missing_errata)} errata missing, {len(extra_errata)} extra")
+        print_items("missing", missing, format_package)
+        print_items("extra  ", extra, format_package)
+        print_items("missing", missing_errata, str)
+        print_items("extra  ", extra_errata, str)
+    return drifting
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify the imported channels against the export content.")
+    parser.add_argument("generation_dir")
+    parser.add_argument("--all", action="store_true", help="check every channel of the content manifest")
+    args = parser.parse_args()
+
+    try:
+        content = read_verified_content(args.generation_dir)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if content is None:
+        print(f"{args.generation_dir} has no content manifest, nothing to verify.")
+        return
+
+    if args.all:
+        labels = sorted(content)
+    else:
+        imported = {name.split("/", 1)[1] for name in import_manifest.imported_channels(args.generation_dir)}
+        labels = sorted(label for label in content if label in imported)
+    metadata_only = [label for label in labels if content[label] is None]
+    if metadata_only:
+        print(f"{len(metadata_only)} channels were exported without packages, not compared: {', '.join(metadata_only)}")
+        labels = [label for label in labels if content[label] is not None]
+    if not labels:
+        print(f"No channel of {args.generation_dir} to verify.")
+        return
+    with suma_api.connect() as client:
+        drifting = verify(content, labels, client)
+    if drifting:
+        print(f"{drifting} of {len(labels)} channels differ from the export.")
+        sys.exit(1)
+    print(f"All {len(labels)} channels match the export.")
+
+
+if __name__ == "__main__":
+    main()